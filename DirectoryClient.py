@@ -1,14 +1,39 @@
 import os
 
-from azure.storage.blob import BlobServiceClient
+# local
+import transfer
 
 
 # This class is Copyrighted by Microsoft using the MIT license
 # https://github.com/Azure/azure-sdk-for-python/blob/master/sdk/storage/azure-storage-blob/samples/blob_samples_directory_interface.py
+# The transfers themselves run concurrently in transfer.AzureTransfer, these methods only work out the paths.
 class DirectoryClient:
     def __init__(self, connection_string, container_name):
-        service_client = BlobServiceClient.from_connection_string(connection_string)
-        self.client = service_client.get_container_client(container_name)
+        self.connection_string = connection_string
+        self.container_name = container_name
+
+    def _run(self, method, *args):
+        """Run an AzureTransfer method on this container and wait for it"""
+
+        async def run():
+            async with transfer.AzureTransfer(
+                self.connection_string, self.container_name
+            ) as azure_transfer:
+                return await method(azure_transfer, *args)
+
+        return transfer.run(run())
+
+    def _iterate(self, method, *args):
+        """Yield the items of an AzureTransfer async generator on this container as they arrive"""
+
+        async def iterate():
+            async with transfer.AzureTransfer(
+                self.connection_string, self.container_name
+            ) as azure_transfer:
+                async for item in method(azure_transfer, *args):
+                    yield item
+
+        return transfer.iterate(iterate())
 
     def upload(self, source, dest):
         """
@@ -23,23 +48,15 @@ class DirectoryClient:
         """
         Upload a single file to a path inside the container
         """
-        print(f"Uploading {source} to {dest}")
-        with open(source, "rb") as data:
-            self.client.upload_blob(name=dest, data=data)
+        self._run(transfer.AzureTransfer.upload_file, source, dest)
 
     def upload_dir(self, source, dest):
         """
         Upload a directory to a path inside the container
         """
         prefix = "" if dest == "" else dest + "/"
-        prefix += os.path.basename(source) + "/"
-        for root, dirs, files in os.walk(source):
-            for name in files:
-                dir_part = os.path.relpath(root, source)
-                dir_part = "" if dir_part == "." else dir_part + "/"
-                file_path = os.path.join(root, name)
-                blob_path = prefix + dir_part + name
-                self.upload_file(file_path, blob_path)
+        prefix += os.path.basename(source)
+        return self._run(transfer.AzureTransfer.upload_dir, source, prefix)
 
     def download(self, source, dest):
         """
@@ -48,22 +65,16 @@ class DirectoryClient:
         if not dest:
             raise Exception("A destination must be provided")
 
-        blobs = self.ls_files(source, recursive=True)
-        if blobs:
-            # if source is a directory, dest must also be a directory
-            if not source == "" and not source.endswith("/"):
-                source += "/"
-            if not dest.endswith("/"):
-                dest += "/"
-            # append the directory name from source to the destination
-            dest += os.path.basename(os.path.normpath(source)) + "/"
-
-            blobs = [source + blob for blob in blobs]
-            for blob in blobs:
-                blob_dest = dest + os.path.relpath(blob, source)
-                self.download_file(blob, blob_dest)
-        else:
+        # if source is a directory, dest must also be a directory
+        prefix = source if source == "" or source.endswith("/") else source + "/"
+        dest_dir = dest if dest.endswith("/") else dest + "/"
+        # append the directory name from source to the destination
+        dest_dir += os.path.basename(os.path.normpath(source)) + "/"
+
+        failures = self._run(transfer.AzureTransfer.download_prefix, prefix, dest_dir)
+        if failures is None:
             self.download_file(source, dest)
+        return failures
 
     def download_file(self, source, dest):
         """
@@ -74,47 +85,69 @@ class DirectoryClient:
             dest += "/"
         blob_dest = dest + os.path.basename(source) if dest.endswith("/") else dest
 
-        print(f"Downloading {source} to {blob_dest}")
-        os.makedirs(os.path.dirname(blob_dest), exist_ok=True)
-        bc = self.client.get_blob_client(blob=source)
-        with open(blob_dest, "wb") as file:
-            data = bc.download_blob()
-            file.write(data.readall())
+        self._run(transfer.AzureTransfer.download_file, source, blob_dest)
 
-    def ls_files(self, path, recursive=False):
+    def iter_file_pages(self, path, recursive=False):
         """
-        List files under a path, optionally recursively
+        Yield the files under a path a page at a time, as the listing returns them, optionally recursively
         """
         if not path == "" and not path.endswith("/"):
             path += "/"
 
-        blob_iter = self.client.list_blobs(name_starts_with=path)
-        files = []
-        for blob in blob_iter:
-            relative_path = os.path.relpath(blob.name, path)
-            if recursive or not "/" in relative_path:
-                files.append(relative_path)
-        return files
+        # a delimited listing only returns the top level, instead of every blob below it
+        delimiter = None if recursive else "/"
+        for page in self._iterate(
+            transfer.AzureTransfer.list_pages, path, None, delimiter
+        ):
+            yield [
+                item.name[len(path) :]
+                for item in page
+                if recursive or not transfer.is_directory(item)
+            ]
 
-    def ls_dirs(self, path, recursive=False):
+    def iter_dir_pages(self, path, recursive=False):
         """
-        List directories under a path, optionally recursively
+        Yield the directories under a path a page at a time, each directory only once, optionally recursively
         """
         if not path == "" and not path.endswith("/"):
             path += "/"
 
-        blob_iter = self.client.list_blobs(name_starts_with=path)
-        dirs = []
-        for blob in blob_iter:
-            relative_dir = os.path.dirname(os.path.relpath(blob.name, path))
-            if (
-                relative_dir
-                and (recursive or not "/" in relative_dir)
-                and not relative_dir in dirs
+        if not recursive:
+            for page in self._iterate(
+                transfer.AzureTransfer.list_pages, path, None, "/"
             ):
-                dirs.append(relative_dir)
+                yield [
+                    item.name[len(path) :].rstrip("/")
+                    for item in page
+                    if transfer.is_directory(item)
+                ]
+            return
 
-        return dirs
+        dirs = set()
+        for page in self._iterate(transfer.AzureTransfer.list_pages, path):
+            new_dirs = []
+            for blob in page:
+                relative_dir = os.path.dirname(blob.name[len(path) :])
+                # the directories above it too, they may not have files of their own
+                above = []
+                while relative_dir and relative_dir not in dirs:
+                    dirs.add(relative_dir)
+                    above.append(relative_dir)
+                    relative_dir = os.path.dirname(relative_dir)
+                new_dirs.extend(reversed(above))
+            yield new_dirs
+
+    def ls_files(self, path, recursive=False):
+        """
+        List files under a path, optionally recursively
+        """
+        return [name for page in self.iter_file_pages(path, recursive) for name in page]
+
+    def ls_dirs(self, path, recursive=False):
+        """
+        List directories under a path, optionally recursively
+        """
+        return [name for page in self.iter_dir_pages(path, recursive) for name in page]
 
     def rm(self, path, recursive=False):
         """
@@ -123,21 +156,12 @@ class DirectoryClient:
         if recursive:
             self.rmdir(path)
         else:
-            print(f"Deleting:\t{path}")
-            self.client.delete_blob(path)
+            self._run(transfer.AzureTransfer.delete_blob, path)
 
     def rmdir(self, path):
         """
         Remove a directory and its contents recursively
         """
-        blobs = self.ls_files(path, recursive=True)
-        if not blobs:
-            return
-
         if not path == "" and not path.endswith("/"):
             path += "/"
-        blobs = [path + blob for blob in blobs]
-        print(f"Deleting {len(blobs)} files")
-        # self.client.delete_blobs(*blobs)
-        for blob in blobs:
-            self.rm(blob)
+        return self._run(transfer.AzureTransfer.delete_prefix, path)
@@ -0,0 +1,165 @@
+"""Persistent index of the files under a directory tree, e.g. albums/ or _build/.
+
+For every file it records the size, mtime, MD5, BLAKE2b and, for PNGs, the pixel dimensions. Refreshing only
+looks at files whose size or mtime changed since the last refresh, their digests come from the digest cache
+(see `digests.py`), which only reads files that changed since any tree holding them was refreshed, and PNG
+dimensions come straight from the IHDR header, so nothing is ever decoded. MD5 is what Azure (Content-MD5) and
+Spaces (ETag) report for uploads, so the hashes can be compared with remote listings directly.
+"""
+
+import os
+import sqlite3
+import struct
+from collections import namedtuple
+
+# local
+import metrics
+from digests import CACHE_DIR, DIGEST_DB, DigestCache
+
+INDEX_DB = os.path.join(CACHE_DIR, "album-index.sqlite3")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    blake2b TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    PRIMARY KEY (root, path)
+);
+"""
+
+IndexEntry = namedtuple("IndexEntry", "path size mtime_ns md5 blake2b width height")
+COLUMNS = ", ".join(IndexEntry._fields)
+
+
+def png_dimensions(path):
+    """Width and height of a PNG from its IHDR chunk, or (None, None) if it isn't a PNG."""
+    with open(path, "rb") as data:
+        header = data.read(24)
+    # signature, then the IHDR chunk: 4 byte length, b"IHDR", 4 byte width, 4 byte height
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        return None, None
+    return struct.unpack(">II", header[16:24])
+
+
+def scan_tree(root):
+    """Yield (relative path, os.stat_result) of every file under root, using os.scandir."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=True):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=True):
+                    relative_path = os.path.relpath(entry.path, root)
+                    yield relative_path.replace("\\", "/"), entry.stat()
+
+
+class AlbumIndex:
+    def __init__(self, db_file=INDEX_DB, digest_db=DIGEST_DB):
+        os.makedirs(os.path.dirname(db_file) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_file)
+        self.digest_db = digest_db
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(files)")]
+        if columns and "blake2b" not in columns:
+            # made before the index kept BLAKE2b, refreshing fills it again
+            self.conn.execute("DROP TABLE files")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def _root_key(root):
+        return os.path.abspath(root)
+
+    def refresh(self, root, workers=None):
+        """Bring the index of a tree up to date with the disk.
+
+        :param root: directory to index
+        :param workers: number of threads hashing changed files, 1 hashes on the calling thread
+        :return: (number of files (re-)indexed, number of files removed from the index)
+        """
+        key = self._root_key(root)
+        known = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self.conn.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE root = ?", (key,)
+            )
+        }
+
+        changed = []
+        for path, stat in scan_tree(root):
+            if known.pop(path, None) != (stat.st_size, stat.st_mtime_ns):
+                changed.append((path, stat))
+
+        if not (changed or known):
+            return 0, 0
+        entries = []
+        with metrics.phase("hashing"):
+            stats = {os.path.join(root, path): stat for path, stat in changed}
+            with DigestCache(self.digest_db) as cache:
+                digests = cache.digests(list(stats), stats, workers)
+                cache.forget(os.path.join(root, path) for path in known)
+            for path, stat in changed:
+                full_path = os.path.join(root, path)
+                digest = digests[full_path]
+                entries.append(
+                    IndexEntry(
+                        path,
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        digest.md5,
+                        digest.blake2b,
+                        *png_dimensions(full_path),
+                    )
+                )
+
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO files (root, {COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(key,) + tuple(entry) for entry in entries],
+            )
+            # whatever is left in known is not on disk anymore
+            self.conn.executemany(
+                "DELETE FROM files WHERE root = ? AND path = ?",
+                [(key, path) for path in known],
+            )
+        return len(entries), len(known)
+
+    def entries(self, root, suffix=None):
+        """All indexed files of a tree as {relative path: IndexEntry}, optionally only those ending in suffix."""
+        query = f"SELECT {COLUMNS} FROM files WHERE root = ?"
+        params = [self._root_key(root)]
+        if suffix:
+            query += " AND path LIKE ?"
+            params.append(f"%{suffix}")
+        return {row[0]: IndexEntry(*row) for row in self.conn.execute(query, params)}
+
+    def get(self, root, path):
+        row = self.conn.execute(
+            f"SELECT {COLUMNS} FROM files WHERE root = ? AND path = ?",
+            (self._root_key(root), path.replace("\\", "/")),
+        ).fetchone()
+        return IndexEntry(*row) if row else None
+
+
+def refreshed_index(root, db_file=INDEX_DB):
+    """Open the index with the given tree already refreshed."""
+    index = AlbumIndex(db_file)
+    hashed, removed = index.refresh(root)
+    if hashed or removed:
+        print(f"Indexed {root}: {hashed} new or changed files, {removed} removed")
+    return index
@@ -0,0 +1,100 @@
+# Hands out the next free NNNN.png filename of an album.
+# Keep this importable from Python 2 as well, so the GIMP plugin can use it.
+#
+# Each album keeps a persistent counter, so picking a name doesn't need to glob the album, and names are never
+# reused when a file gets deleted. Counters are created (or rebuilt) from what is on disk when needed.
+
+import os
+import re
+import sqlite3
+
+ALLOCATOR_DB = "allocator.sqlite3"
+IMAGE_NAME = re.compile(r"^(\d+)\.png$", re.IGNORECASE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    album TEXT PRIMARY KEY,
+    next INTEGER NOT NULL
+);
+"""
+
+
+def format_filename(image_num):
+    return "{:0>4}.png".format(image_num)
+
+
+def scan_next_image_num(album_dir):
+    """One more than the highest numbered image in an album, 1 for an empty album."""
+    highest = 0
+    if os.path.isdir(album_dir):
+        for filename in os.listdir(album_dir):
+            match = IMAGE_NAME.match(filename)
+            if match:
+                highest = max(highest, int(match.group(1)))
+    return highest + 1
+
+
+class FilenameAllocator(object):
+    def __init__(self, albums_dir):
+        self.albums_dir = albums_dir
+        # exports from GIMP and the render commands can run at the same time
+        self.conn = sqlite3.connect(os.path.join(albums_dir, ALLOCATOR_DB), timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _key(self, album_dir):
+        # the same albums are used from Windows (GIMP) and Linux (CI), so always store "/" separators
+        relative = os.path.relpath(
+            os.path.abspath(album_dir), os.path.abspath(self.albums_dir)
+        )
+        return relative.replace("\\", "/")
+
+    def allocate(self, album_dir, count=1):
+        """Reserve the next `count` filenames of an album.
+
+        :param album_dir: path to the album
+        :param count: number of filenames needed
+        :return: list of file paths inside the album
+        """
+        key = self._key(album_dir)
+        with self.conn:
+            # take the write lock first, so two exports never get the same name
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT next FROM counters WHERE album = ?", (key,)
+            ).fetchone()
+            image_num = row[0] if row else scan_next_image_num(album_dir)
+
+            # only needed if files were added behind the allocator's back: start again past any name in the
+            # block that is taken, until the whole block is free
+            num = image_num
+            while num < image_num + count:
+                if os.path.exists(os.path.join(album_dir, format_filename(num))):
+                    image_num = num + 1
+                num += 1
+
+            self.conn.execute(
+                "INSERT OR REPLACE INTO counters (album, next) VALUES (?, ?)",
+                (key, image_num + count),
+            )
+        return [
+            os.path.join(album_dir, format_filename(num))
+            for num in range(image_num, image_num + count)
+        ]
+
+    def next_filepath(self, album_dir):
+        return self.allocate(album_dir)[0]
+
+    def rebuild(self):
+        """Throw away all counters, they are recreated from the albums on disk on next use."""
+        with self.conn:
+            self.conn.execute("DELETE FROM counters")
@@ -0,0 +1,199 @@
+"""Benchmark and visual check of sigal_plugins/fast_resize.py against sigal's own image processing.
+
+Generates full page RGBA stains, processes them with sigal's process_image and with the plugin's, using the
+settings of each config file, and reports:
+
+* CPU time per image of both
+* the PSNR and largest channel difference between their outputs (resized images and thumbnails), with the
+  colours premultiplied by alpha, as they show on the page
+
+It fails if any output differs visibly (PSNR below --min-psnr), or if the plugin is slower than sigal by more
+than --tolerance. Outputs that are straight copies of the source (use_orig) are identical by construction and
+only timed. Only the configs that enable the plugin are checked: sigal.conf.img.py doesn't, most of its time
+goes into encoding the optimized PNG and the stains are only about 3 times img_size, so the plugin was slower
+there. Run it from the repository root:
+
+    python benchmarks/resize.py
+    python benchmarks/resize.py --images 8 --size 2550x3300 --min-psnr 45
+"""
+
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# third party
+import click
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+CONFIGS = ("sigal.conf.py", "sigal.conf.img.py")
+
+
+def generate_stains(directory, images, size, seed=0):
+    """Noisy RGBA stains with soft edges, roughly like the GIMP exports."""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    width, height = size
+    yy, xx = np.mgrid[0:height, 0:width]
+    paths = []
+    for num in range(1, images + 1):
+        cx, cy = rng.uniform(0.3, 0.7) * width, rng.uniform(0.3, 0.7) * height
+        distance = np.hypot((xx - cx) / width, (yy - cy) / height) * 2.5
+        alpha = np.clip((1 - distance) * 255, 0, 255).astype(np.uint8)
+        # smooth colour gradients with some grain, noise alone would make every resize look the same
+        rgb = np.dstack(
+            [
+                (xx * 255 // width),
+                (yy * 255 // height),
+                ((xx + yy) * 127 // (width + height)) + 64,
+            ]
+        ) + rng.integers(-12, 13, (height, width, 3))
+        pixels = np.dstack([np.clip(rgb, 0, 255).astype(np.uint8), alpha])
+        path = os.path.join(directory, f"{num:04d}.png")
+        Image.fromarray(pixels, "RGBA").save(path)
+        paths.append(path)
+    return paths
+
+
+def process_all(process_image, sources, outpath, settings):
+    """CPU seconds per image of process_image over all sources."""
+    os.makedirs(os.path.join(outpath, settings["thumb_dir"]), exist_ok=True)
+    started = time.process_time()
+    for source in sources:
+        if process_image(source, outpath, settings) != 0:
+            raise click.ClickException(f"{process_image.__module__} failed on {source}")
+    return (time.process_time() - started) / len(sources)
+
+
+def visible_pixels(image):
+    """RGBA as it shows: colours premultiplied by alpha.
+
+    The colour of a nearly transparent pixel can't be seen, and rounding makes it jump around, e.g. from black
+    to red at alpha 1, so it isn't compared as such.
+    """
+    import numpy as np
+
+    pixels = np.asarray(image.convert("RGBA"), dtype=np.float64)
+    pixels[..., :3] *= pixels[..., 3:] / 255
+    return pixels
+
+
+def compare_images(path_a, path_b):
+    """(PSNR in dB, largest channel difference) of two images, PSNR is inf if they're identical."""
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(path_a) as image_a, Image.open(path_b) as image_b:
+        if image_a.size != image_b.size:
+            raise click.ClickException(
+                f"{path_b} is {image_b.size}, but sigal made {image_a.size}"
+            )
+        a = visible_pixels(image_a)
+        b = visible_pixels(image_b)
+    mse = np.mean((a - b) ** 2)
+    psnr = math.inf if mse == 0 else 20 * math.log10(255 / math.sqrt(mse))
+    return psnr, int(np.abs(a - b).max())
+
+
+def compared_outputs(settings, filenames):
+    from sigal.settings import get_thumb
+
+    outputs = []
+    if not settings["use_orig"]:
+        outputs.extend(filenames)
+    if settings["make_thumbs"]:
+        outputs.extend(get_thumb(settings, filename) for filename in filenames)
+    return outputs
+
+
+@click.command()
+@click.option("--images", default=4, show_default=True, help="Number of stains.")
+@click.option(
+    "--size",
+    default="2550x3300",
+    show_default=True,
+    help="Size of the stains, WIDTHxHEIGHT (a letter page at 300 dpi).",
+)
+@click.option(
+    "--min-psnr",
+    default=40.0,
+    show_default=True,
+    help="Fail below this PSNR in dB. Differences above 40 dB are invisible.",
+)
+@click.option(
+    "--tolerance",
+    default=0.1,
+    show_default=True,
+    help="Fail when fast_resize is slower than sigal by more than this fraction.",
+)
+@click.option(
+    "--keep",
+    default=False,
+    is_flag=True,
+    help="Keep the generated stains and outputs, and print where they are.",
+)
+def main(images, size, min_psnr, tolerance, keep):
+    from sigal.image import process_image as sigal_process_image
+    from sigal.settings import read_settings
+
+    from sigal_plugins.fast_resize import process_image as fast_process_image
+
+    width, height = (int(value) for value in size.lower().split("x"))
+    work_dir = tempfile.mkdtemp(prefix="resize-bench-")
+    failed = False
+    try:
+        source_dir = os.path.join(work_dir, "source")
+        os.makedirs(source_dir)
+        print(f"Generating {images} {width}x{height} stains")
+        sources = generate_stains(source_dir, images, (width, height))
+        filenames = [os.path.basename(source) for source in sources]
+
+        for config in CONFIGS:
+            settings = read_settings(os.path.join(REPO_DIR, config))
+            if "sigal_plugins.fast_resize" not in settings["plugins"]:
+                print(f"{config}: doesn't use fast_resize, skipped")
+                continue
+            name = os.path.splitext(config)[0]
+            sigal_dir = os.path.join(work_dir, name, "sigal")
+            fast_dir = os.path.join(work_dir, name, "fast_resize")
+            sigal_seconds = process_all(
+                sigal_process_image, sources, sigal_dir, settings
+            )
+            fast_seconds = process_all(fast_process_image, sources, fast_dir, settings)
+
+            worst_psnr, worst_diff = math.inf, 0
+            for output in compared_outputs(settings, filenames):
+                psnr, diff = compare_images(
+                    os.path.join(sigal_dir, output), os.path.join(fast_dir, output)
+                )
+                worst_psnr, worst_diff = min(worst_psnr, psnr), max(worst_diff, diff)
+                if psnr < min_psnr:
+                    print(f"  {output} differs visibly: PSNR {psnr:.1f} dB")
+                    failed = True
+            if fast_seconds > sigal_seconds * (1 + tolerance):
+                print("  fast_resize is slower than sigal")
+                failed = True
+
+            print(
+                f"{config}: sigal {sigal_seconds * 1000:.0f} ms/image,"
+                f" fast_resize {fast_seconds * 1000:.0f} ms/image"
+                f" ({sigal_seconds / fast_seconds:.1f}x),"
+                f" min PSNR {worst_psnr:.1f} dB, max channel difference {worst_diff}"
+            )
+    finally:
+        if keep:
+            print(f"Kept {work_dir}")
+        else:
+            shutil.rmtree(work_dir)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Startup time benchmark for the cheap run.py commands.
+
+Runs each command with `python -X importtime` and fails if it imports one of the heavy backends, or if its
+imports take longer than the threshold. Run it from the repository root:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --max-ms 150 --repeat 5
+"""
+
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+# third party
+import click
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# none of these are needed to parse the command line or run a cheap command
+HEAVY_MODULES = ("boto3", "botocore", "azure", "sigal", "numpy", "PIL", "dotenv")
+# import time:       self [us] | cumulative | imported package
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+def cheap_commands(tmp_dir):
+    return [
+        ["--help"],
+        ["sigal-clean", "--dir", os.path.join(tmp_dir, "_build")],
+        ["count-images", "--albums-dir", tmp_dir],
+    ]
+
+
+def import_profile(args):
+    """Run Python under -X importtime and return ({top level module: cumulative us}, [all imported modules])."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + args,
+        cwd=REPO_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    top_level = {}
+    modules = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        modules.append(name)
+        if not indent:
+            top_level[name] = int(cumulative)
+    return top_level, modules
+
+
+@click.command()
+@click.option(
+    "--max-ms",
+    default=100.0,
+    show_default=True,
+    help="Fail if a command spends longer than this importing modules.",
+)
+@click.option(
+    "--repeat",
+    "-r",
+    default=3,
+    show_default=True,
+    help="Runs per command. The fastest run is used, to filter out noise.",
+)
+def main(max_ms, repeat):
+    """Check that cheap run.py commands stay cheap to start."""
+    failures = []
+    # whatever the interpreter imports on its own (site, encodings...) is not our startup time
+    interpreter_modules, _ = import_profile(["-c", "pass"])
+    run_py = os.path.join(REPO_DIR, "run.py")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for args in cheap_commands(tmp_dir):
+            name = " ".join(args[:1])
+            runs = []
+            for _ in range(repeat):
+                top_level, modules = import_profile([run_py] + args)
+                for module in interpreter_modules:
+                    top_level.pop(module, None)
+                runs.append((top_level, modules))
+            best_ms = min(sum(top_level.values()) for top_level, _ in runs) / 1000
+            top_level, modules = runs[0]
+
+            heavy = sorted(
+                {module.split(".")[0] for module in modules}.intersection(HEAVY_MODULES)
+            )
+            slowest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)
+            slowest = ", ".join(f"{mod} {us / 1000:.1f}ms" for mod, us in slowest[:3])
+            print(f"{name:<14} {best_ms:7.1f}ms  (slowest: {slowest})")
+
+            if heavy:
+                failures.append(f"{name} imports {', '.join(heavy)}")
+            if best_ms > max_ms:
+                failures.append(
+                    f"{name} spends {best_ms:.1f}ms importing, over {max_ms}ms"
+                )
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
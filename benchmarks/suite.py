@@ -0,0 +1,431 @@
+"""Offline benchmark suite for the archive, index, build and storage code paths.
+
+Generates synthetic albums shaped like ours (themes x 12 locations, N PNGs each), then times:
+
+* zipdir and unzip_file
+* count-images, with a cold and a warm album index
+* the sigal build
+* azure_upload_dir, azure_backup_container and DirectoryClient.rmdir against Azurite
+* do_upload_dir against a local S3 stand-in (moto_server or MinIO)
+
+Storage operations that have no stand-in running are skipped. Start them with e.g.
+
+    azurite-blob --silent --location /tmp/azurite
+    moto_server -p 5000
+
+and run from the repository root:
+
+    python benchmarks/suite.py
+    python benchmarks/suite.py --images 20 --save-baseline
+    python benchmarks/suite.py --check
+
+Results are compared with benchmarks/baseline.json when it exists. Baselines only make sense on the machine
+that recorded them, so each machine keeps its own.
+"""
+
+import contextlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+# third party
+import click
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# local
+import metrics  # noqa: E402
+from stains import LOCATION_SLUGS, THEME_SLUGS, location_album  # noqa: E402
+
+BASELINE_FILE = os.path.join(REPO_DIR, "benchmarks", "baseline.json")
+# the well known development account of Azurite
+AZURITE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTtjbpg==;"
+    "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+)
+S3_ENDPOINT = "http://127.0.0.1:5000"
+CONTAINER = "bench-web"
+BACKUP_CONTAINER = "bench-backup"
+BUCKET = "bench-space"
+
+
+def generate_albums(albums_dir, themes, images, size, seed=0):
+    """Write themes x locations albums of noisy RGBA stains, which compress about as badly as the real ones."""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    # a soft blob for the alpha channel, like a watercolor stain
+    distance = np.hypot(xx - size / 2, yy - size / 2) / (size / 2)
+    alpha = np.clip((1 - distance) * 255, 0, 255).astype(np.uint8)
+
+    for theme in THEME_SLUGS[:themes]:
+        for location in LOCATION_SLUGS:
+            album_dir = location_album(albums_dir, theme, location)
+            os.makedirs(album_dir, exist_ok=True)
+            with open(os.path.join(album_dir, "index.md"), "w") as index_file:
+                index_file.write(f"Title: {location}\n")
+            for num in range(1, images + 1):
+                rgb = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+                pixels = np.dstack([rgb, alpha])
+                Image.fromarray(pixels, "RGBA").save(
+                    os.path.join(album_dir, f"{num:0>4}.png")
+                )
+
+
+def quietly(func, *args):
+    """Call func without its per file output."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return func(*args)
+
+
+def tree_size(root):
+    objects = 0
+    size = 0
+    for dir_path, _, files in os.walk(root):
+        for filename in files:
+            objects += 1
+            size += os.path.getsize(os.path.join(dir_path, filename))
+    return objects, size
+
+
+def reachable(url):
+    parsed = urlparse(url)
+    try:
+        with socket.create_connection((parsed.hostname, parsed.port or 80), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def azure_endpoint(connection_string):
+    for part in connection_string.split(";"):
+        if part.startswith("BlobEndpoint="):
+            return part.split("=", 1)[1]
+    return None
+
+
+class Suite:
+    def __init__(self, work_dir, azure_connection_string, s3_endpoint):
+        self.work_dir = work_dir
+        self.albums_dir = os.path.join(work_dir, "albums")
+        self.archive = os.path.join(work_dir, "albums.zip")
+        self.build_dir = os.path.join(work_dir, "_build")
+        self.azure_connection_string = azure_connection_string
+        self.s3_endpoint = s3_endpoint
+        self.results = {}
+
+    def measure(self, name, func, objects=0, size=0):
+        """Time func() and record its throughput and the request latencies it caused."""
+        run_metrics = metrics.reset(command=name)
+        started = time.perf_counter()
+        quietly(func)
+        seconds = time.perf_counter() - started
+        report = run_metrics.report()
+        result = {
+            "seconds": round(seconds, 4),
+            "objects": objects,
+            "bytes": size,
+            "objects_per_second": round(objects / seconds, 1) if seconds else 0.0,
+            "mb_per_second": round(size / 1024 / 1024 / seconds, 2) if seconds else 0.0,
+        }
+        for stage, latency in report["latencies"].items():
+            result.setdefault("latency", {})[stage] = {
+                key: latency[key]
+                for key in ("count", "p50_seconds", "p95_seconds", "max_seconds")
+            }
+        if report["counters"].get("objects.failed"):
+            result["failed"] = report["counters"]["objects.failed"]
+        self.results[name] = result
+        print(
+            f"{name:<24} {seconds:8.2f}s  {result['objects_per_second']:8.1f} obj/s"
+            f"  {result['mb_per_second']:7.2f} MB/s"
+        )
+
+    def skip(self, name, reason):
+        print(f"{name:<24} skipped: {reason}")
+
+    def run_local(self):
+        from utils import unzip_file, zipdir
+
+        objects, size = tree_size(self.albums_dir)
+        cwd = os.getcwd()
+        try:
+            # zipdir stores paths as given and unzip_file extracts into the working directory
+            os.chdir(self.work_dir)
+            self.measure(
+                "zipdir", lambda: zipdir("albums/", self.archive), objects, size
+            )
+            extract_dir = os.path.join(self.work_dir, "unzipped")
+            os.makedirs(extract_dir)
+            os.chdir(extract_dir)
+            self.measure(
+                "unzip_file",
+                lambda: unzip_file(self.archive),
+                objects,
+                os.path.getsize(self.archive),
+            )
+        finally:
+            os.chdir(cwd)
+
+        # both run from the work directory, so they use an album index in its .cache/
+        count_images = [
+            sys.executable,
+            os.path.join(REPO_DIR, "run.py"),
+            "count-images",
+            "--albums-dir",
+            self.albums_dir,
+        ]
+
+        def run_count_images():
+            subprocess.run(
+                count_images, cwd=self.work_dir, stdout=subprocess.DEVNULL, check=True
+            )
+
+        self.measure("count-images (cold)", run_count_images, objects, size)
+        self.measure("count-images (warm)", run_count_images, objects, 0)
+
+        sigal_build = [
+            sys.executable,
+            "-c",
+            "import sigal; sigal.main()",
+            "build",
+            "--config",
+            os.path.join(REPO_DIR, "sigal.conf.py"),
+            "--quiet",
+            self.albums_dir,
+            self.build_dir,
+        ]
+        # plugin_paths in sigal.conf.py is relative to the working directory, so put our plugins on the path
+        env = dict(os.environ, PYTHONPATH=REPO_DIR)
+
+        def run_sigal_build():
+            subprocess.run(
+                sigal_build,
+                cwd=self.work_dir,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+
+        self.measure("sigal build", run_sigal_build, objects, size)
+
+    def run_azure(self):
+        names = ("azure_upload_dir", "azure_backup_container", "DirectoryClient.rmdir")
+        endpoint = azure_endpoint(self.azure_connection_string)
+        if not endpoint or not reachable(endpoint):
+            for name in names:
+                self.skip(name, f"no Azurite at {endpoint}")
+            return
+
+        os.environ["AZURE_STORAGE_CONNECTION_STRING"] = self.azure_connection_string
+        import clients
+        import utils
+        from DirectoryClient import DirectoryClient
+
+        utils.AZURE_STORAGE_CONNECTION_STRING = self.azure_connection_string
+        service = clients.azure_service_client(self.azure_connection_string)
+        for container in (CONTAINER, BACKUP_CONTAINER):
+            if not list(service.list_containers(name_starts_with=container)):
+                service.create_container(container)
+        for container in (CONTAINER, BACKUP_CONTAINER):
+            quietly(DirectoryClient(self.azure_connection_string, container).rmdir, "")
+
+        objects, size = tree_size(self.albums_dir)
+        self.measure(
+            "azure_upload_dir",
+            lambda: utils.azure_upload_dir(self.albums_dir, CONTAINER),
+            objects,
+            size,
+        )
+        self.measure(
+            "azure_backup_container",
+            lambda: utils.azure_backup_container(CONTAINER, BACKUP_CONTAINER),
+            objects,
+            size,
+        )
+        self.measure(
+            "DirectoryClient.rmdir",
+            lambda: DirectoryClient(self.azure_connection_string, CONTAINER).rmdir(""),
+            objects,
+        )
+        quietly(
+            DirectoryClient(self.azure_connection_string, BACKUP_CONTAINER).rmdir, ""
+        )
+
+    def run_s3(self):
+        if not reachable(self.s3_endpoint):
+            self.skip("do_upload_dir", f"no S3 stand-in at {self.s3_endpoint}")
+            return
+
+        os.environ.update(
+            DO_ENDPOINT=self.s3_endpoint,
+            DO_REGION="us-east-1",
+            DO_SPACE=BUCKET,
+            DO_ACCESS_KEY_ID=os.getenv("BENCH_S3_ACCESS_KEY_ID", "testing"),
+            DO_SECRET_ACCESS_KEY=os.getenv("BENCH_S3_SECRET_ACCESS_KEY", "testing"),
+        )
+        import utils
+
+        utils.DO_SPACE = BUCKET
+        utils.DO_ACCESS_KEY_ID = os.environ["DO_ACCESS_KEY_ID"]
+        utils.DO_SECRET_ACCESS_KEY = os.environ["DO_SECRET_ACCESS_KEY"]
+        client = utils.do_get_client()
+        buckets = [bucket["Name"] for bucket in client.list_buckets()["Buckets"]]
+        if BUCKET not in buckets:
+            client.create_bucket(Bucket=BUCKET)
+        quietly(utils.do_delete_dir, "albums/")
+
+        objects, size = tree_size(self.albums_dir)
+        self.measure(
+            "do_upload_dir",
+            lambda: utils.do_upload_dir(self.albums_dir, "albums"),
+            objects,
+            size,
+        )
+        # everything exists now, so this is only the head_object checks
+        self.measure(
+            "do_upload_dir (no-op)",
+            lambda: utils.do_upload_dir(self.albums_dir, "albums"),
+            objects,
+            0,
+        )
+        quietly(utils.do_delete_dir, "albums/")
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against the baseline and return the operations that got slower than tolerance allows."""
+    regressions = []
+    print(f"\n{'operation':<24} {'baseline':>9} {'now':>9} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["seconds"]
+        now = result["seconds"]
+        change = (now - before) / before if before else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  SLOWER"
+        print(f"{name:<24} {before:8.2f}s {now:8.2f}s {change:+7.0%}{flag}")
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--themes", default=2, show_default=True, help="Number of themes to generate."
+)
+@click.option("--images", default=5, show_default=True, help="PNGs per location album.")
+@click.option(
+    "--size", default=512, show_default=True, help="Width and height of each PNG."
+)
+@click.option(
+    "--azure-connection-string",
+    default=lambda: os.getenv(
+        "BENCH_AZURE_CONNECTION_STRING", AZURITE_CONNECTION_STRING
+    ),
+    help="Azure Blob Storage stand-in. Defaults to Azurite on localhost.",
+)
+@click.option(
+    "--s3-endpoint",
+    default=lambda: os.getenv("BENCH_S3_ENDPOINT", S3_ENDPOINT),
+    help="S3 stand-in. Defaults to moto_server on localhost:5000.",
+)
+@click.option(
+    "--baseline",
+    default=BASELINE_FILE,
+    show_default=True,
+    type=click.Path(dir_okay=False),
+    help="Baseline results to compare with.",
+)
+@click.option(
+    "--save-baseline",
+    default=False,
+    is_flag=True,
+    help="Store these results as the baseline.",
+)
+@click.option(
+    "--check",
+    default=False,
+    is_flag=True,
+    help="Exit with an error if an operation is slower than the baseline allows.",
+)
+@click.option(
+    "--tolerance",
+    default=0.25,
+    show_default=True,
+    help="Allowed slowdown against the baseline, as a fraction.",
+)
+@click.option(
+    "--keep",
+    default=False,
+    is_flag=True,
+    help="Keep the generated files, and print where they are.",
+)
+def main(
+    themes,
+    images,
+    size,
+    azure_connection_string,
+    s3_endpoint,
+    baseline,
+    save_baseline,
+    check,
+    tolerance,
+    keep,
+):
+    """Benchmark archive, index, build and storage operations on synthetic albums."""
+    work_dir = tempfile.mkdtemp(prefix="watercolor-bench-")
+    try:
+        suite = Suite(work_dir, azure_connection_string, s3_endpoint)
+        print(
+            f"Generating {themes} themes x {len(LOCATION_SLUGS)} locations x {images} images of {size}px"
+        )
+        generate_albums(suite.albums_dir, themes, images, size)
+        objects, total = tree_size(suite.albums_dir)
+        print(f"{objects} files, {total / 1024 / 1024:.1f} MB\n")
+
+        suite.run_local()
+        suite.run_azure()
+        suite.run_s3()
+    finally:
+        if keep:
+            print(f"\nGenerated files are in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    config = {"themes": themes, "images": images, "size": size}
+    regressions = []
+    if os.path.exists(baseline):
+        with open(baseline, "r") as read_file:
+            stored = json.load(read_file)
+        if stored.get("config") != config:
+            print(
+                f"\nBaseline {baseline} was recorded with {stored.get('config')}, not comparing."
+            )
+        else:
+            regressions = compare(suite.results, stored["results"], tolerance)
+
+    if save_baseline:
+        with open(baseline, "w") as write_file:
+            json.dump(
+                {"config": config, "results": suite.results}, write_file, indent=2
+            )
+        print(f"\nSaved baseline to {baseline}")
+
+    if check and regressions:
+        print(f"FAIL: slower than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Process-wide registry of cloud storage clients.
+
+Every client keeps its own HTTP connection pool, so creating a new one for each operation means new TLS
+handshakes and credential setup every time. Clients are created here on first use, cached per endpoint and
+credentials, and shared by everything in the process. Both SDKs' clients are safe to share between threads.
+Async Azure clients belong to the event loop they were made in, so they are cached per loop, see
+`transfer.event_loop()`, and closed with it.
+
+Connection pool sizes can be tuned with environment variables (or .env):
+
+* AZURE_POOL_SIZE - connections kept open to Azure Blob Storage (default 32), by the sync and async clients
+* DO_POOL_SIZE - connections kept open to Digital Ocean Spaces (default 32)
+* DO_REGION and DO_ENDPOINT - Digital Ocean Spaces region and endpoint (default nyc3), the endpoint can also
+  be a local S3 stand-in like moto or MinIO, as used by benchmarks/suite.py
+"""
+
+import asyncio
+import os
+import threading
+
+DEFAULT_POOL_SIZE = 32
+DO_REGION = "nyc3"
+DO_ENDPOINT = "https://nyc3.digitaloceanspaces.com"
+
+_clients = {}
+_lock = threading.RLock()
+
+
+def pool_size(env_var):
+    return int(os.getenv(env_var) or DEFAULT_POOL_SIZE)
+
+
+def _get_or_create(key, factory):
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = factory()
+    return client
+
+
+def clear():
+    """Forget all clients, e.g. after the credentials changed."""
+    with _lock:
+        _clients.clear()
+
+
+def _azure_transport(size):
+    # imported here so that only commands talking to Azure pay for it
+    import requests
+    from azure.core.pipeline.transport import RequestsTransport
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # session_owner=False keeps the transport from replacing our adapter with its default sized one
+    return RequestsTransport(session=session, session_owner=False)
+
+
+def azure_service_client(connection_string):
+    """Shared BlobServiceClient for a storage account."""
+
+    def create():
+        from azure.storage.blob import BlobServiceClient
+
+        return BlobServiceClient.from_connection_string(
+            connection_string,
+            transport=_azure_transport(pool_size("AZURE_POOL_SIZE")),
+        )
+
+    return _get_or_create(("azure", connection_string), create)
+
+
+def azure_aio_service_client(connection_string):
+    """Shared async BlobServiceClient for a storage account, for the running event loop.
+
+    Its retries are left to transfer.py, which needs to see the throttled responses itself.
+    """
+    loop = asyncio.get_running_loop()
+
+    def create():
+        import aiohttp
+        from azure.core.pipeline.transport import AioHttpTransport
+        from azure.storage.blob.aio import BlobServiceClient
+
+        # the same session options as the SDK's own, with a connector of our size
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size("AZURE_POOL_SIZE")),
+            cookie_jar=aiohttp.DummyCookieJar(),
+            trust_env=True,
+            auto_decompress=False,
+        )
+        return BlobServiceClient.from_connection_string(
+            connection_string,
+            transport=AioHttpTransport(session=session),
+            retry_total=0,
+        )
+
+    return _get_or_create(("azure-aio", loop, connection_string), create)
+
+
+async def close_aio_clients(loop):
+    """Close the async clients made in an event loop, before the loop is closed."""
+    with _lock:
+        keys = [key for key in _clients if key[0] == "azure-aio" and key[1] is loop]
+        aio_clients = [_clients.pop(key) for key in keys]
+    for client in aio_clients:
+        await client.close()
+
+
+def azure_container_client(connection_string, container):
+    """Container client sharing the service client's connection pool."""
+    return _get_or_create(
+        ("azure", connection_string, container),
+        lambda: azure_service_client(connection_string).get_container_client(container),
+    )
+
+
+def _boto3_session(access_key_id, secret_access_key):
+    def create():
+        from boto3 import Session
+
+        return Session(
+            aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key
+        )
+
+    return _get_or_create(("boto3", access_key_id, secret_access_key), create)
+
+
+def _botocore_config():
+    from botocore.config import Config
+
+    # transfer.py retries through retry.py, which needs to see the throttled responses itself
+    return Config(
+        max_pool_connections=pool_size("DO_POOL_SIZE"), retries={"max_attempts": 0}
+    )
+
+
+def _do_location(region_name, endpoint_url):
+    # read when a client is made, so that values loaded from .env after importing this module count
+    return (
+        region_name or os.getenv("DO_REGION") or DO_REGION,
+        endpoint_url or os.getenv("DO_ENDPOINT") or DO_ENDPOINT,
+    )
+
+
+def s3_client(access_key_id, secret_access_key, region_name=None, endpoint_url=None):
+    """Shared S3 client, by default for Digital Ocean Spaces."""
+    region_name, endpoint_url = _do_location(region_name, endpoint_url)
+
+    def create():
+        session = _boto3_session(access_key_id, secret_access_key)
+        return session.client(
+            "s3",
+            region_name=region_name,
+            endpoint_url=endpoint_url,
+            config=_botocore_config(),
+        )
+
+    return _get_or_create(
+        ("s3", region_name, endpoint_url, access_key_id, secret_access_key), create
+    )
+
+
+def s3_resource(access_key_id, secret_access_key, region_name=None, endpoint_url=None):
+    """Shared S3 resource, by default for Digital Ocean Spaces.
+
+    Unlike clients, boto3 resources are not thread safe, so only use this from one thread.
+    """
+    region_name, endpoint_url = _do_location(region_name, endpoint_url)
+
+    def create():
+        session = _boto3_session(access_key_id, secret_access_key)
+        return session.resource(
+            "s3",
+            region_name=region_name,
+            endpoint_url=endpoint_url,
+            config=_botocore_config(),
+        )
+
+    return _get_or_create(
+        ("s3-resource", region_name, endpoint_url, access_key_id, secret_access_key),
+        create,
+    )
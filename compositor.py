@@ -0,0 +1,342 @@
+"""Headless stain compositor.
+
+This does what `gimp-save-all-dnd-stains.py` does inside GIMP, without GIMP: every theme variant of a stain
+is that theme's background texture, cut out by the stain's mask. Instead of toggling layers and flattening a
+duplicate of the image once per theme, the mask is applied to each texture with one vectorised NumPy multiply.
+
+Inputs (see `stains.py` for the layout):
+
+albums/
+|--- _textures/
+|    |--- dmg.png       <- full page background of each theme, exported once from its GIMP layer
+|    |--- phb.png
+|--- _masks/
+|    |--- bottom/
+|    |    |--- bottom_0001.png  <- greyscale layer mask, white is where the stain is
+|--- mapping.sqlite3    <- which stains are the same stain in different themes, see `mapping_store.py`
+|--- rendered.json      <- mask and texture hashes behind every output of `render_theme`
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+
+# third party
+import numpy as np
+from PIL import Image
+
+# local
+import metrics
+from allocator import FilenameAllocator
+from mapping_store import open_mapping_store
+from stains import (
+    MASKS_DIR,
+    THEME_SLUGS,
+    create_theme_dirs_if_needed,
+    location_album,
+    mask_path,
+    mkdir_p,
+    parse_mask_name,
+    texture_path,
+)
+
+RENDERED_FILE = "rendered.json"
+
+# textures are loaded once per worker process, not once per mask
+_TEXTURES = {}
+
+
+def load_texture(path):
+    with Image.open(path) as img:
+        return np.asarray(img.convert("RGBA"))
+
+
+def load_mask(path):
+    with Image.open(path) as img:
+        return np.asarray(img.convert("L"))
+
+
+def composite(texture, mask):
+    """Cut a theme texture out with a mask.
+
+    :param texture: (height, width, 4) uint8 RGBA array
+    :param mask: (height, width) uint8 array, 255 is fully opaque stain
+    :return: (height, width, 4) uint8 RGBA array
+    """
+    if texture.shape[:2] != mask.shape:
+        raise ValueError(
+            f"Mask is {mask.shape[1]}x{mask.shape[0]} but texture is {texture.shape[1]}x{texture.shape[0]}"
+        )
+    stain = texture.copy()
+    alpha = texture[..., 3].astype(np.uint16) * mask
+    # (a * m + 127) // 255 is a rounded a * m / 255 without going through floats
+    stain[..., 3] = (alpha + 127) // 255
+    return stain
+
+
+def save_png(array, filepath):
+    Image.fromarray(array).save(filepath)
+
+
+def _init_worker(texture_paths):
+    _TEXTURES.clear()
+    for theme, path in texture_paths.items():
+        _TEXTURES[theme] = load_texture(path)
+
+
+def _render_job(job):
+    """Composite one mask for every theme it is needed in.
+
+    :param job: (mask file, [(theme, output file), ...])
+    :return: the mask file, so the caller can report progress
+    """
+    mask_file, outputs = job
+    mask = load_mask(mask_file).astype(np.uint16)
+    for theme, filepath in outputs:
+        save_png(composite(_TEXTURES[theme], mask), filepath)
+    return mask_file
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as data:
+        for chunk in iter(lambda: data.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_texture_paths(albums_dir, themes):
+    texture_paths = {}
+    for theme in themes:
+        path = texture_path(albums_dir, theme)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"No texture for theme '{theme}': {path}")
+        texture_paths[theme] = path
+    return texture_paths
+
+
+def load_rendered(albums_dir):
+    rendered_file = os.path.join(albums_dir, RENDERED_FILE)
+    if not os.path.exists(rendered_file):
+        return {}
+    with open(rendered_file, "r") as read_file:
+        return json.load(read_file)
+
+
+def save_rendered(albums_dir, rendered):
+    rendered_file = os.path.join(albums_dir, RENDERED_FILE)
+    with open(rendered_file, "w") as write_file:
+        json.dump(rendered, write_file, indent=2, sort_keys=True)
+
+
+def get_mask_set(albums_dir):
+    """All saved masks, as a list of (location slug, mask id, mask file)."""
+    masks = []
+    for mask_file in sorted(glob(os.path.join(albums_dir, MASKS_DIR, "*", "*.png"))):
+        try:
+            location_slug, mask_id = parse_mask_name(mask_file)
+        except ValueError:
+            print(f"Skipping {mask_file}, it is not named like <location>_NNNN.png")
+            continue
+        masks.append((location_slug, mask_id, mask_file))
+    return masks
+
+
+def run_jobs(jobs, texture_paths, workers=None, on_done=None):
+    """Run `_render_job` over all jobs in a process pool.
+
+    If a job fails, the jobs that haven't started are cancelled, the running ones are finished, and then the
+    error is raised.
+
+    :param on_done: called with the position of each job in jobs as soon as its outputs are written
+    """
+    if not jobs:
+        return
+    if metrics.profiling():
+        # render in this process, where the profiler can see it
+        with metrics.phase("rendering"):
+            _init_worker(texture_paths)
+            for num, job in enumerate(jobs):
+                print(f"Rendered {num + 1}/{len(jobs)}:\t{_render_job(job)}")
+                metrics.count("images.rendered", len(job[1]))
+                if on_done:
+                    on_done(num)
+        return
+    error = None
+    rendered = 0
+    with metrics.phase("rendering"), ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(texture_paths,)
+    ) as executor:
+        futures = {
+            executor.submit(_render_job, job): num for num, job in enumerate(jobs)
+        }
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                if error is None:
+                    error = future.exception()
+                    for pending in futures:
+                        pending.cancel()
+                continue
+            rendered += 1
+            print(f"Rendered {rendered}/{len(jobs)}:\t{future.result()}")
+            num = futures[future]
+            metrics.count("images.rendered", len(jobs[num][1]))
+            if on_done:
+                on_done(num)
+    if error is not None:
+        raise error
+
+
+def remove_outputs(jobs, nums):
+    """Delete what the jobs at these positions wrote before they failed."""
+    for num in nums:
+        for _, filepath in jobs[num][1]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+
+def render_masks(albums_dir, location_slug, masks, themes=None, workers=None):
+    """Save every theme variant of new stains, like the GIMP plugin does for one stain.
+
+    Each mask is copied into the mask set under its entry number in the mapping store, so that mask ids keep
+    lining up with their entries. A stain is added to the mapping as soon as its variants are saved, and if
+    rendering fails the variants of the stains that weren't added are deleted, so no stain is left out of it.
+
+    :param albums_dir: top level albums directory
+    :param location_slug: location of all the masks, e.g. "bottom-right"
+    :param masks: mask image files
+    :param themes: theme slugs to save, defaults to all of them
+    :param workers: number of processes, defaults to the number of CPUs
+    :return: list of equivalences that were added to the mapping
+    """
+    themes = list(themes or THEME_SLUGS)
+    texture_paths = get_texture_paths(albums_dir, themes)
+    create_theme_dirs_if_needed(albums_dir, themes)
+
+    with FilenameAllocator(albums_dir) as allocator:
+        filepaths = {
+            theme: allocator.allocate(
+                location_album(albums_dir, theme, location_slug), count=len(masks)
+            )
+            for theme in themes
+        }
+
+    jobs = []
+    equivalences = []
+    for i, mask in enumerate(masks):
+        equivalence = {}
+        outputs = []
+        for theme in themes:
+            filepath = filepaths[theme][i]
+            equivalence[theme] = os.path.basename(filepath)
+            outputs.append((theme, filepath))
+
+        jobs.append((mask, outputs))
+        equivalences.append(equivalence)
+
+    added = set()
+    with open_mapping_store(albums_dir) as store:
+
+        def add(num):
+            mask = masks[num]
+            entry = store.add_equivalence(location_slug, equivalences[num])
+            archived_mask = mask_path(albums_dir, location_slug, entry)
+            mkdir_p(os.path.dirname(archived_mask))
+            if os.path.abspath(mask) != os.path.abspath(archived_mask):
+                shutil.copyfile(mask, archived_mask)
+            added.add(num)
+
+        try:
+            run_jobs(jobs, texture_paths, workers=workers, on_done=add)
+        except BaseException:
+            remove_outputs(jobs, set(range(len(jobs))) - added)
+            raise
+    return equivalences
+
+
+def render_theme(albums_dir, theme, workers=None, force=False):
+    """(Re-)render one theme's variant of every saved mask.
+
+    Stains that are already in the mapping store for this theme are overwritten in place, so their filenames
+    don't change on the website. Masks the theme doesn't have yet get the next filename in their album, which is
+    added to the mapping as soon as the stain is saved. If rendering fails, the new stains that weren't saved are
+    deleted, so the next run doesn't leave them behind under other filenames.
+    Outputs whose mask and texture are unchanged since they were last rendered are skipped.
+
+    :param albums_dir: top level albums directory
+    :param theme: theme slug
+    :param workers: number of processes, defaults to the number of CPUs
+    :param force: render everything, even if nothing changed
+    :return: number of stains rendered
+    """
+    texture_paths = get_texture_paths(albums_dir, [theme])
+    texture_hash = file_hash(texture_paths[theme])
+    create_theme_dirs_if_needed(albums_dir, [theme])
+    store = open_mapping_store(albums_dir)
+    allocator = FilenameAllocator(albums_dir)
+    rendered = load_rendered(albums_dir)
+    theme_rendered = rendered.setdefault(theme, {})
+
+    jobs = []
+    # (output, state, (location slug, mask id, filename) if the filename is new) of each job
+    results = []
+    for location_slug, mask_id, mask_file in get_mask_set(albums_dir):
+        equivalence = store.get_equivalence(location_slug, mask_id)
+        if not equivalence:
+            print(f"Skipping {mask_file}, it has no entry in the mapping")
+            continue
+        album = location_album(albums_dir, theme, location_slug)
+
+        filename = equivalence.get(theme)
+        new_filename = None
+        if filename is None:
+            filename = os.path.basename(allocator.next_filepath(album))
+            new_filename = (location_slug, mask_id, filename)
+
+        filepath = os.path.join(album, filename)
+        output = os.path.relpath(filepath, albums_dir).replace("\\", "/")
+        state = {"mask": file_hash(mask_file), "texture": texture_hash}
+        if (
+            not force
+            and theme_rendered.get(output) == state
+            and os.path.exists(filepath)
+        ):
+            continue
+
+        jobs.append((mask_file, [(theme, filepath)]))
+        results.append((output, state, new_filename))
+
+    allocator.close()
+
+    done = set()
+
+    def record(num):
+        output, state, new_filename = results[num]
+        if new_filename is not None:
+            location_slug, mask_id, filename = new_filename
+            store.set_filename(location_slug, mask_id, theme, filename)
+        theme_rendered[output] = state
+        done.add(num)
+
+    print(f"Rendering {len(jobs)} {theme} stains")
+    with store:
+        try:
+            run_jobs(jobs, texture_paths, workers=workers, on_done=record)
+        except BaseException:
+            remove_outputs(
+                jobs,
+                [
+                    num
+                    for num in range(len(jobs))
+                    if num not in done and results[num][2] is not None
+                ],
+            )
+            raise
+        finally:
+            save_rendered(albums_dir, rendered)
+    return len(jobs)
@@ -0,0 +1,151 @@
+"""Persistent cache of file digests, so a file is only read again after it changes.
+
+Every digest is stored in .cache/digests.sqlite3 with the inode, size and mtime of the file it was computed from,
+and is only used while all three still match. Each file is read once for both digests:
+
+* MD5 - what Azure (Content-MD5) and Spaces (ETag) report, for comparing with remote listings
+* BLAKE2b - faster, for keys that never leave this repository, e.g. the build cache and the album zips
+
+Missing digests are computed in a thread pool, hashlib releases the GIL while hashing large buffers. Files are
+read in large chunks into one reused buffer, big files are memory-mapped instead.
+
+The album index (see `album_index.py`) gets the digests of a tree from here, other code asks for single files
+with `file_digest`.
+"""
+
+import hashlib
+import mmap
+import os
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# local
+import metrics
+
+CACHE_DIR = ".cache"
+DIGEST_DB = os.path.join(CACHE_DIR, "digests.sqlite3")
+READ_SIZE = 4 * 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    blake2b TEXT NOT NULL
+);
+"""
+
+Digest = namedtuple("Digest", "md5 blake2b")
+
+
+def hash_file(path):
+    """Digest of a file, read once for both hashes."""
+    md5 = hashlib.md5()
+    blake2b = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as data:
+        size = os.fstat(data.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for start in range(0, size, READ_SIZE):
+                        with view[start : start + READ_SIZE] as chunk:
+                            md5.update(chunk)
+                            blake2b.update(chunk)
+        else:
+            buffer = bytearray(min(READ_SIZE, size) or 1)
+            with memoryview(buffer) as view:
+                while True:
+                    length = data.readinto(buffer)
+                    if not length:
+                        break
+                    md5.update(view[:length])
+                    blake2b.update(view[:length])
+    return Digest(md5.hexdigest(), blake2b.hexdigest())
+
+
+def _stat_key(stat):
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class DigestCache:
+    def __init__(self, db_file=DIGEST_DB):
+        os.makedirs(os.path.dirname(db_file) or ".", exist_ok=True)
+        # sigal's worker processes look files up concurrently
+        self.conn = sqlite3.connect(db_file, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def digests(self, paths, stats=None, workers=None):
+        """Digests of files, computing only the ones that aren't cached or whose file changed.
+
+        :param paths: file paths
+        :param stats: optional {path: os.stat_result} of the files, saves statting them again
+        :param workers: number of threads hashing files, 1 hashes on the calling thread
+        :return: {path: Digest}
+        """
+        keys = {}
+        for path in paths:
+            stat = stats[path] if stats and path in stats else os.stat(path)
+            keys[path] = (os.path.abspath(path), _stat_key(stat))
+
+        results = {}
+        missing = []
+        for path, (key, stat_key) in keys.items():
+            row = self.conn.execute(
+                "SELECT inode, size, mtime_ns, md5, blake2b FROM digests WHERE path = ?",
+                (key,),
+            ).fetchone()
+            if row is not None and tuple(row[:3]) == stat_key:
+                results[path] = Digest(*row[3:])
+            else:
+                missing.append(path)
+        if not missing:
+            return results
+
+        if workers is None and metrics.profiling():
+            workers = 1
+        if workers == 1 or len(missing) == 1:
+            computed = [hash_file(path) for path in missing]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                computed = list(executor.map(hash_file, missing))
+        metrics.count("files.hashed", len(missing))
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO digests (path, inode, size, mtime_ns, md5, blake2b)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (keys[path][0],) + keys[path][1] + tuple(digest)
+                    for path, digest in zip(missing, computed)
+                ],
+            )
+        results.update(zip(missing, computed))
+        return results
+
+    def forget(self, paths):
+        """Drop the digests of files that are gone."""
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM digests WHERE path = ?",
+                [(os.path.abspath(path),) for path in paths],
+            )
+
+
+def file_digest(path, db_file=DIGEST_DB):
+    """Digest of one file, from the cache when the file didn't change."""
+    with DigestCache(db_file) as cache:
+        return cache.digests([path])[path]
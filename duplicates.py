@@ -0,0 +1,226 @@
+"""Find duplicate and near-identical stains with perceptual hashes.
+
+Every theme variant of a stain is the same mask cut out of a different texture, so stains are compared by their
+alpha channel, i.e. the shape of the stain, and only within a theme: the same shape in two themes is expected,
+the same shape twice in one theme is a duplicate.
+
+Two 64 bit hashes are computed per image, on a small greyscale copy of the alpha channel:
+
+* dHash - whether each pixel is brighter than its right neighbour, on a 9x8 thumbnail
+* pHash - whether each of the lowest 8x8 DCT frequencies of a 32x32 thumbnail is above their median
+
+Hashes are cached by MD5 in the album index database (see `album_index.py`), so only new or changed images are
+decoded, in a process pool. Near-duplicates are pairs of hashes at most a few bits apart, found with a blocked
+NumPy XOR and popcount over all pairs of a theme.
+"""
+
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+# third party
+import numpy as np
+from PIL import Image
+
+# local
+import metrics
+from album_index import INDEX_DB, refreshed_index
+from stains import split_stain_path
+
+HASH_ALGORITHMS = ("phash", "dhash")
+DEFAULT_THRESHOLD = 6
+# rows of the distance matrix computed at once, so memory stays at BLOCK_SIZE * images
+BLOCK_SIZE = 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS perceptual_hashes (
+    md5 TEXT PRIMARY KEY,
+    dhash TEXT NOT NULL,
+    phash TEXT NOT NULL
+);
+"""
+
+# number of set bits of every byte value
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II matrix, so the 2D DCT of x is D @ x @ D.T"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_32 = _dct_matrix(32)
+
+
+def _bits_to_hex(bits):
+    return "%016x" % int("".join("1" if bit else "0" for bit in bits.flatten()), 2)
+
+
+def shape_channel(img):
+    """The alpha channel of an image with transparency, the greyscale image otherwise."""
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        return img.convert("RGBA").getchannel("A")
+    return img.convert("L")
+
+
+def dhash(channel):
+    pixels = np.asarray(channel.resize((9, 8), Image.BOX), dtype=np.int16)
+    return _bits_to_hex(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(channel):
+    pixels = np.asarray(channel.resize((32, 32), Image.BOX), dtype=np.float64)
+    low = (DCT_32 @ pixels @ DCT_32.T)[:8, :8]
+    # the DC term is the average brightness and says nothing about the shape
+    return _bits_to_hex(low > np.median(low.flatten()[1:]))
+
+
+def hash_image(path):
+    """(dHash, pHash) of an image as 16 digit hex strings."""
+    with Image.open(path) as img:
+        # decode at a reduced size where the format allows it, the hashes only need 32x32
+        img.draft("L", (64, 64))
+        channel = shape_channel(img)
+    return dhash(channel), phash(channel)
+
+
+def hamming_distances(hashes, rows):
+    """Bit distances between hashes[rows] and every hash, as a (len(rows), len(hashes)) array.
+
+    :param hashes: uint64 array
+    """
+    xor = hashes[rows, None] ^ hashes[None, :]
+    return POPCOUNT[xor.view(np.uint8)].reshape(xor.shape + (8,)).sum(axis=2)
+
+
+def near_duplicate_groups(hashes, threshold=DEFAULT_THRESHOLD):
+    """Group the indexes of hashes at most threshold bits apart, transitively.
+
+    :param hashes: list of 16 digit hex strings
+    :return: list of sorted lists of indexes, only groups of two or more
+    """
+    values = np.array([int(value, 16) for value in hashes], dtype=np.uint64)
+    parent = list(range(len(values)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for start in range(0, len(values), BLOCK_SIZE):
+        rows = np.arange(start, min(start + BLOCK_SIZE, len(values)))
+        distances = hamming_distances(values, rows)
+        for row, column in zip(*np.nonzero(distances <= threshold)):
+            i, j = rows[row], column
+            # every pair shows up twice, and every hash matches itself
+            if i < j:
+                parent[find(i)] = find(j)
+
+    groups = {}
+    for i in range(len(values)):
+        groups.setdefault(find(i), []).append(i)
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+
+class HashCache:
+    """Perceptual hashes by MD5, next to the album index."""
+
+    def __init__(self, db_file=INDEX_DB):
+        os.makedirs(os.path.dirname(db_file) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_file)
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.close()
+
+    def get_all(self):
+        return {
+            md5: {"dhash": dhash_, "phash": phash_}
+            for md5, dhash_, phash_ in self.conn.execute(
+                "SELECT md5, dhash, phash FROM perceptual_hashes"
+            )
+        }
+
+    def add(self, rows):
+        """:param rows: list of (md5, dhash, phash)"""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO perceptual_hashes (md5, dhash, phash) VALUES (?, ?, ?)",
+                rows,
+            )
+
+
+def hash_stains(albums_dir, workers=None):
+    """Perceptual hashes of every stain, computing the ones that aren't cached yet.
+
+    :return: list of (path, theme, location, {"dhash": ..., "phash": ...})
+    """
+    with refreshed_index(albums_dir) as index:
+        images = index.entries(albums_dir, suffix=".png")
+
+    stains = []
+    for path, entry in sorted(images.items()):
+        album = split_stain_path(path)
+        if album:
+            stains.append((path, entry.md5) + album)
+
+    with HashCache() as cache:
+        hashes = cache.get_all()
+        todo = {}
+        for path, md5, _, _ in stains:
+            if md5 not in hashes:
+                todo.setdefault(md5, os.path.join(albums_dir, path))
+        if todo:
+            print(f"Hashing {len(todo)} images")
+        with metrics.phase("hashing"):
+            if workers == 1 or metrics.profiling() or len(todo) < 2:
+                results = [hash_image(path) for path in todo.values()]
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = list(
+                        executor.map(hash_image, todo.values(), chunksize=16)
+                    )
+        rows = [(md5,) + result for md5, result in zip(todo, results)]
+        if rows:
+            cache.add(rows)
+            metrics.count("images.hashed", len(rows))
+        for md5, dhash_, phash_ in rows:
+            hashes[md5] = {"dhash": dhash_, "phash": phash_}
+
+    return [
+        (path, theme, location, hashes[md5]) for path, md5, theme, location in stains
+    ]
+
+
+def find_duplicates(
+    albums_dir, algorithm="phash", threshold=DEFAULT_THRESHOLD, workers=None
+):
+    """Near-duplicate stains of every theme.
+
+    :param algorithm: "phash" or "dhash"
+    :param threshold: most bits two hashes may differ in, 0 only finds (visually) identical stains
+    :param workers: number of processes hashing new images, defaults to the number of CPUs
+    :return: {theme: [[(location, path), ...], ...]}, the groups sorted by their first location and path
+    """
+    by_theme = {}
+    for path, theme, location, hashes in hash_stains(albums_dir, workers):
+        by_theme.setdefault(theme, []).append((location, path, hashes[algorithm]))
+
+    report = {}
+    with metrics.phase("searching"):
+        for theme, stains in sorted(by_theme.items()):
+            groups = near_duplicate_groups([hash_ for _, _, hash_ in stains], threshold)
+            groups = [
+                sorted((stains[i][0], stains[i][1]) for i in group) for group in groups
+            ]
+            if groups:
+                report[theme] = sorted(groups)
+    return report
@@ -5,9 +5,8 @@
 
 # Standard Library
 import errno
-import glob
-import json
 import os
+import sys
 import time
 
 # third party
@@ -43,6 +42,14 @@ THEME_LIST = [
 ]
 
 
+def import_repo_module(albums_dir, name):
+    # this file gets copied into GIMP's plug-ins folder, so look for the shared modules next to the albums
+    repo_dir = os.path.dirname(os.path.normpath(albums_dir))
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    return __import__(name)
+
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -85,17 +92,8 @@ def create_theme_dirs_if_needed(albums_dir):
                 file_.write(file_contents)
 
 
-def get_next_filepath_needed(album):
-    os.chdir(album)
-    images = glob.glob("*.png")
-    num_images = len(images)
-    next_image_num = num_images + 1
-
-    # msg = "{} has {} images.".format(album, num_images)
-    # pdb.gimp_message(msg)
-
-    filename = "{:0>4}.png".format(next_image_num)
-    filepath = "{}\\{}".format(album, filename)
+def get_next_filepath_needed(allocator, album):
+    filepath = allocator.next_filepath(album)
 
     # msg = "{} has been saved".format(filepath)
     # pdb.gimp_message(msg)
@@ -212,9 +210,10 @@ def save_stains(
         "ice2": ice2,
     }
 
-    mapping_file = "{}\\mapping.json".format(albums_dir)
-    with open(mapping_file, "r") as read_file:
-        mapping_data = json.load(read_file)
+    mapping_store = import_repo_module(albums_dir, "mapping_store")
+    allocator = import_repo_module(albums_dir, "allocator").FilenameAllocator(
+        albums_dir
+    )
 
     create_theme_dirs_if_needed(albums_dir)
 
@@ -226,18 +225,21 @@ def save_stains(
             continue
         enable_theme_layer_for_image(image, theme)
         album = "{}\\{}\\{}_{}".format(albums_dir, theme, theme, location_slug)
-        filepath = get_next_filepath_needed(album)
+        filepath = get_next_filepath_needed(allocator, album)
         equivalence[theme] = os.path.basename(filepath)
         save_image(image, filepath)
 
+    allocator.close()
+
     set_all_layers_visible(image)
     backup_mask(image, location_slug)
 
     # Generate mapping report
-    mapping_data[location_slug].append(equivalence)
-    with open(mapping_file, "w") as write_file:
-        json.dump(mapping_data, write_file, indent=2)
-        # json.dump(mapping_data, write_file)
+    store = mapping_store.open_mapping_store(albums_dir)
+    try:
+        store.add_equivalence(location_slug, equivalence)
+    finally:
+        store.close()
 
     # reset for next mask
     pdb.gimp_image_set_active_layer(image, image.layers[0])
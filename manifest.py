@@ -0,0 +1,128 @@
+"""What a deploy or backup put into a container, kept in the container itself.
+
+Every deploy and backup writes `.manifest.json` next to the files: for every path its size, MD5 and content
+type. The next run reads that one blob and diffs the local files against it, instead of listing the whole
+container. The local MD5s come from the album index (see `album_index.py`), so unchanged files aren't read either.
+
+The manifest can only be trusted while nothing else changed the container. Every run remembers the ETag of the
+manifest it wrote in `.cache/manifests.json`, and falls back to listing the container when the manifest is
+missing, or its ETag isn't the one remembered, i.e. another machine or a manual change wrote it since. The
+listing then becomes the new manifest.
+
+Changes that don't go through the manifest at all, e.g. `run.py watch` pushing files, at worst make the next
+deploy upload a few files again. `run.py azure-audit` lists the container and compares it with its manifest, to
+catch anything else.
+"""
+
+import json
+import os
+
+# local
+from album_index import CACHE_DIR, refreshed_index
+
+MANIFEST_NAME = ".manifest.json"
+MANIFEST_VERSION = 1
+MANIFEST_ETAGS = os.path.join(CACHE_DIR, "manifests.json")
+FIELDS = ("size", "md5", "content_type")
+
+
+def dumps(files):
+    """Manifest content, {path: [size, md5, content type]} sorted by path."""
+    return json.dumps(
+        {
+            "version": MANIFEST_VERSION,
+            "fields": FIELDS,
+            "files": {path: list(files[path]) for path in sorted(files)},
+        },
+        separators=(",", ":"),
+    )
+
+
+def loads(content):
+    """{path: (size, md5, content type)}, or None if the manifest is from an unknown version."""
+    data = json.loads(content)
+    if data.get("version") != MANIFEST_VERSION:
+        return None
+    return {path: tuple(values) for path, values in data["files"].items()}
+
+
+def local_files(local_directory, content_type_for):
+    """{path: (size, md5, content type)} of a local directory, hashed through the album index."""
+    with refreshed_index(local_directory) as index:
+        entries = index.entries(local_directory)
+    return {
+        path: (
+            entry.size,
+            entry.md5,
+            content_type_for(os.path.join(local_directory, path)),
+        )
+        for path, entry in entries.items()
+    }
+
+
+def blob_files(blobs):
+    """{path: (size, md5, content type)} from a container listing, md5 is None for blobs without Content-MD5."""
+    files = {}
+    for blob in blobs:
+        if blob.name == MANIFEST_NAME:
+            continue
+        content_md5 = blob.content_settings.content_md5
+        files[blob.name] = (
+            blob.size,
+            bytes(content_md5).hex() if content_md5 else None,
+            blob.content_settings.content_type,
+        )
+    return files
+
+
+def diff(local, remote):
+    """What makes remote the same as local.
+
+    :return: (sorted paths to upload, sorted paths to delete)
+    """
+    uploads = sorted(path for path, state in local.items() if remote.get(path) != state)
+    deletes = sorted(path for path in remote if path not in local)
+    return uploads, deletes
+
+
+def compare(expected, actual):
+    """Differences between a manifest and a listing of the container.
+
+    :return: dict of sorted lists of paths: missing - in the manifest only, extra - in the container only,
+        changed - size, MD5 or content type differ
+    """
+    return {
+        "missing": sorted(path for path in expected if path not in actual),
+        "extra": sorted(path for path in actual if path not in expected),
+        "changed": sorted(
+            path
+            for path, state in expected.items()
+            if path in actual and actual[path] != state
+        ),
+    }
+
+
+def _load_etags():
+    if not os.path.isfile(MANIFEST_ETAGS):
+        return {}
+    with open(MANIFEST_ETAGS, "r") as read_file:
+        return json.load(read_file)
+
+
+def known_etag(url):
+    """ETag of the manifest this machine last wrote (or checked) in the container at url, or None."""
+    return _load_etags().get(url)
+
+
+def remember_etag(url, etag):
+    """Record the ETag of the manifest in the container at url, None forgets it."""
+    etags = _load_etags()
+    if etag is None:
+        etags.pop(url, None)
+    else:
+        etags[url] = etag
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_file = MANIFEST_ETAGS + ".tmp"
+    with open(tmp_file, "w") as write_file:
+        json.dump(etags, write_file, indent=2, sort_keys=True)
+    os.replace(tmp_file, MANIFEST_ETAGS)
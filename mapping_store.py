@@ -0,0 +1,185 @@
+# SQLite backed store of which stains are the same stain in different themes.
+# Keep this importable from Python 2 as well, so the GIMP plugin can use it.
+#
+# mapping.json used to be the only copy of this, loaded and rewritten in full on every save. Now every save is
+# one small transaction. mapping.json is only exported from here where it is read: by `run.py export-mapping`,
+# and before do-backup ships the albums and sigal-build builds them.
+
+import json
+import os
+import sqlite3
+
+from stains import LOCATION_SLUGS, MAPPING_FILE
+
+MAPPING_DB = "mapping.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stains (
+    location TEXT NOT NULL,
+    entry INTEGER NOT NULL,
+    theme TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (location, entry, theme)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS stains_by_filename ON stains (theme, location, filename);
+CREATE INDEX IF NOT EXISTS stains_by_theme ON stains (theme);
+"""
+
+
+def replace_file(src, dst):
+    # os.replace is Python 3 only, and os.rename won't overwrite on Windows
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class MappingStore(object):
+    """Equivalent stains across themes.
+
+    Each location has a list of entries numbered from 1, in the order they were saved. An entry maps theme slugs
+    to the filename of that stain in the theme's album. Entry numbers are the same as the mask ids in
+    albums/_masks and the position in mapping.json.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # the GIMP plugin and render commands may write at the same time
+        self.conn = sqlite3.connect(db_file, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM stains LIMIT 1").fetchone() is None
+
+    def count(self, location):
+        row = self.conn.execute(
+            "SELECT MAX(entry) FROM stains WHERE location = ?", (location,)
+        ).fetchone()
+        return row[0] or 0
+
+    def add_equivalence(self, location, equivalence):
+        """Append an entry to a location and return its number."""
+        with self.conn:
+            # BEGIN IMMEDIATE takes the write lock before reading the last entry number
+            self.conn.execute("BEGIN IMMEDIATE")
+            entry = self.count(location) + 1
+            self.conn.executemany(
+                "INSERT INTO stains (location, entry, theme, filename) VALUES (?, ?, ?, ?)",
+                [
+                    (location, entry, theme, filename)
+                    for theme, filename in equivalence.items()
+                ],
+            )
+        return entry
+
+    def set_filename(self, location, entry, theme, filename):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stains (location, entry, theme, filename) VALUES (?, ?, ?, ?)",
+                (location, entry, theme, filename),
+            )
+
+    def get_equivalence(self, location, entry):
+        rows = self.conn.execute(
+            "SELECT theme, filename FROM stains WHERE location = ? AND entry = ?",
+            (location, entry),
+        )
+        return dict(rows)
+
+    def find_entry(self, theme, location, filename):
+        """Entry number of a stain, or None if it isn't in the mapping."""
+        row = self.conn.execute(
+            "SELECT entry FROM stains WHERE theme = ? AND location = ? AND filename = ?",
+            (theme, location, filename),
+        ).fetchone()
+        return row[0] if row else None
+
+    def equivalent(self, theme, location, filename, other_theme):
+        """Filename of the same stain in another theme, e.g. which dmg stain equals this phb one.
+
+        :return: filename or None if the other theme doesn't have it
+        """
+        row = self.conn.execute(
+            "SELECT other.filename FROM stains AS this JOIN stains AS other"
+            " ON other.location = this.location AND other.entry = this.entry"
+            " WHERE this.theme = ? AND this.location = ? AND this.filename = ? AND other.theme = ?",
+            (theme, location, filename, other_theme),
+        ).fetchone()
+        return row[0] if row else None
+
+    def theme_filenames(self, theme):
+        """All (location, entry, filename) of one theme."""
+        return self.conn.execute(
+            "SELECT location, entry, filename FROM stains WHERE theme = ? ORDER BY location, entry",
+            (theme,),
+        ).fetchall()
+
+    def to_dict(self):
+        """Same structure as mapping.json: {location: [{theme: filename}, ...]}"""
+        mapping_data = dict((location, []) for location in LOCATION_SLUGS)
+        rows = self.conn.execute(
+            "SELECT location, entry, theme, filename FROM stains ORDER BY location, entry"
+        )
+        for location, entry, theme, filename in rows:
+            equivalences = mapping_data.setdefault(location, [])
+            # keep list positions lined up with entry numbers, even if an entry is missing
+            while len(equivalences) < entry:
+                equivalences.append({})
+            equivalences[entry - 1][theme] = filename
+        return mapping_data
+
+    def import_json(self, mapping_file):
+        with open(mapping_file, "r") as read_file:
+            mapping_data = json.load(read_file)
+        rows = []
+        for location, equivalences in mapping_data.items():
+            for entry, equivalence in enumerate(equivalences, start=1):
+                for theme, filename in equivalence.items():
+                    rows.append((location, entry, theme, filename))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO stains (location, entry, theme, filename) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def export_json(self, mapping_file):
+        """Write mapping.json, without ever leaving a half written file behind."""
+        # one per process, shards building on one machine export at the same time
+        tmp_file = "%s.%d.tmp" % (mapping_file, os.getpid())
+        with open(tmp_file, "w") as write_file:
+            json.dump(self.to_dict(), write_file, indent=2)
+            write_file.flush()
+            os.fsync(write_file.fileno())
+        replace_file(tmp_file, mapping_file)
+
+
+def open_mapping_store(albums_dir):
+    """Open the store in an albums directory, seeding it from mapping.json the first time."""
+    store = MappingStore(os.path.join(albums_dir, MAPPING_DB))
+    mapping_file = os.path.join(albums_dir, MAPPING_FILE)
+    if store.is_empty() and os.path.exists(mapping_file):
+        store.import_json(mapping_file)
+    return store
+
+
+def export_mapping(albums_dir, mapping_file=None):
+    with open_mapping_store(albums_dir) as store:
+        store.export_json(mapping_file or os.path.join(albums_dir, MAPPING_FILE))
+
+
+def refresh_mapping_json(albums_dir):
+    """Export mapping.json if the albums have a mapping store, so it is current before it is read."""
+    if os.path.exists(os.path.join(albums_dir, MAPPING_DB)):
+        export_mapping(albums_dir)
@@ -0,0 +1,218 @@
+"""Timing and throughput instrumentation for run.py commands.
+
+Everything in the process records into one registry:
+
+* phases - wall time of named steps, e.g. "zip", "upload" or "hashing" (phases can nest)
+* counters - objects and bytes transferred, requests, retries, throttles...
+* latencies - a histogram of request durations per stage, e.g. "azure.upload" or "s3.head"
+
+`run.py --metrics-out FILE <command>` writes all of it as JSON, so build, backup and deploy times can be compared
+across CI runs, and a short summary is printed after every command that did any transfers.
+
+Only the standard library is used (and json only when writing), so importing this doesn't slow down the CLI.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        bucket = len(LATENCY_BUCKETS)
+        for i, upper in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper:
+                bucket = i
+                break
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (the maximum for the last bucket)."""
+        rank = math.ceil(q * self.count)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+        return 0.0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 6),
+            "mean_seconds": round(self.total / self.count, 6) if self.count else 0.0,
+            "max_seconds": round(self.max, 6),
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "p99_seconds": self.quantile(0.99),
+            "buckets": {
+                str(upper): count
+                for upper, count in zip(LATENCY_BUCKETS + ("inf",), self.counts)
+            },
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.command = None
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self.latencies = {}
+        self.profiled_phase = None
+        self.profiler = None
+        self._profiling_depth = 0
+
+    def profile_phase(self, name, profiler):
+        """Run profiler whenever the phase with this name is running, see profiling.py.
+
+        With name None the profiler is only attached, for a profile that covers the whole command.
+        """
+        self.profiled_phase = name
+        self.profiler = profiler
+
+    @contextmanager
+    def phase(self, name):
+        profile = self.profiler is not None and name == self.profiled_phase
+        if profile:
+            # the same phase may be nested in itself, e.g. an upload inside a deploy
+            self._profiling_depth += 1
+            if self._profiling_depth == 1:
+                self.profiler.start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - started)
+            if profile:
+                self._profiling_depth -= 1
+                if self._profiling_depth == 0:
+                    self.profiler.stop()
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "count": 0})
+            phase["seconds"] += seconds
+            phase["count"] += 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.latencies.setdefault(stage, Histogram()).observe(seconds)
+
+    def has_transfers(self):
+        return bool(self.counters or self.latencies)
+
+    def wall_seconds(self):
+        return time.perf_counter() - self._started
+
+    def report(self):
+        wall_seconds = self.wall_seconds()
+        with self._lock:
+            throughput = {
+                name.replace("bytes.", "")
+                + "_bytes_per_second": round(value / wall_seconds, 1)
+                for name, value in self.counters.items()
+                if name.startswith("bytes.") and wall_seconds
+            }
+            return {
+                "command": self.command,
+                "started_at": time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)
+                ),
+                "wall_seconds": round(wall_seconds, 6),
+                "phases": {
+                    name: {
+                        "seconds": round(phase["seconds"], 6),
+                        "count": phase["count"],
+                    }
+                    for name, phase in self.phases.items()
+                },
+                "counters": dict(self.counters),
+                "throughput": throughput,
+                "latencies": {
+                    stage: histogram.to_dict()
+                    for stage, histogram in self.latencies.items()
+                },
+            }
+
+    def write_report(self, path):
+        import json
+
+        with open(path, "w") as write_file:
+            json.dump(self.report(), write_file, indent=2)
+
+    def summary(self):
+        report = self.report()
+        lines = [f"--- {report['command']}: {report['wall_seconds']:.1f}s ---"]
+        if report["phases"]:
+            phases = ", ".join(
+                f"{name} {phase['seconds']:.1f}s"
+                for name, phase in report["phases"].items()
+                if name != report["command"]
+            )
+            if phases:
+                lines.append(f"phases: {phases}")
+        for name, value in sorted(report["counters"].items()):
+            if name.startswith("bytes."):
+                mb = value / 1024 / 1024
+                rate = mb / report["wall_seconds"] if report["wall_seconds"] else 0
+                lines.append(f"{name}: {mb:.1f} MB ({rate:.1f} MB/s)")
+            else:
+                lines.append(f"{name}: {value}")
+        for stage, latency in sorted(report["latencies"].items()):
+            lines.append(
+                f"{stage}: {latency['count']} requests, p50 <= {latency['p50_seconds']}s,"
+                f" p95 <= {latency['p95_seconds']}s, max {latency['max_seconds']:.2f}s"
+            )
+        return "\n".join(lines)
+
+
+_metrics = Metrics()
+
+
+def get():
+    """The process-wide registry."""
+    return _metrics
+
+
+def reset(command=None):
+    global _metrics
+    _metrics = Metrics()
+    _metrics.command = command
+    return _metrics
+
+
+def phase(name):
+    return _metrics.phase(name)
+
+
+def profiling():
+    """Whether the command is being profiled, so work should stay on the main thread where it's visible."""
+    return _metrics.profiler is not None
+
+
+def count(name, value=1):
+    _metrics.count(name, value)
+
+
+def observe(stage, seconds):
+    _metrics.observe(stage, seconds)
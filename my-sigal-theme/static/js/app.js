@@ -34,3 +34,104 @@ $(document).bind('cbox_open', function(){
     excludedElements: $.fn.swipe.defaults.excludedElements + ", #colorbox"
   }).unbind("click");
 });
+
+// Prefetch the images next to the one on show, mostly in the direction the
+// visitor is browsing, so next/previous don't wait for a full size PNG.
+// Prefetches that are no longer wanted, because the visitor skipped past or
+// turned around, are aborted. The service worker keeps what was fetched.
+var prefetcher = (function () {
+  var AHEAD = 3;
+  var BEHIND = 1;
+  var MAX_IN_FLIGHT = 2;
+  var inFlight = {};
+  var done = {};
+  var queue = [];
+  var lastIndex = null;
+  var direction = 1;
+
+  function urls() {
+    return $(".gallery").not("[inline]").map(function () {
+      return this.getAttribute("href");
+    }).get();
+  }
+
+  function prefetch(url) {
+    var controller = window.AbortController ? new AbortController() : null;
+    inFlight[url] = controller;
+    fetch(url, { signal: controller && controller.signal, credentials: "same-origin" })
+      .then(function (response) { return response.blob(); })
+      .then(function () { done[url] = true; }, function () {})
+      .then(function () {
+        delete inFlight[url];
+        start();
+      });
+  }
+
+  function start() {
+    while (queue.length && Object.keys(inFlight).length < MAX_IN_FLIGHT) {
+      prefetch(queue.shift());
+    }
+  }
+
+  function wanted(list, index) {
+    // wrap around like colorbox does, nearest first, the browsing direction first
+    var order = [];
+    for (var step = 1; step <= Math.max(AHEAD, BEHIND); step++) {
+      if (step <= AHEAD) {
+        order.push(list[(index + direction * step + list.length) % list.length]);
+      }
+      if (step <= BEHIND) {
+        order.push(list[(index - direction * step + list.length) % list.length]);
+      }
+    }
+    return order.filter(function (url, i) {
+      return url !== list[index] && order.indexOf(url) === i;
+    });
+  }
+
+  function update(current) {
+    if (!window.fetch) {
+      return;
+    }
+    var list = urls();
+    var index = list.indexOf(current);
+    if (index === -1) {
+      return;
+    }
+    if (lastIndex !== null && index !== lastIndex) {
+      var forward = (index - lastIndex + list.length) % list.length;
+      direction = forward <= list.length / 2 ? 1 : -1;
+    }
+    lastIndex = index;
+
+    var next = wanted(list, index);
+    Object.keys(inFlight).forEach(function (url) {
+      // the one on show is being loaded by colorbox as well, let it finish
+      if (url !== current && next.indexOf(url) === -1 && inFlight[url]) {
+        inFlight[url].abort();
+      }
+    });
+    queue = next.filter(function (url) {
+      return !done[url] && !(url in inFlight);
+    });
+    start();
+  }
+
+  function stop() {
+    queue = [];
+    lastIndex = null;
+    direction = 1;
+    Object.keys(inFlight).forEach(function (url) {
+      if (inFlight[url]) {
+        inFlight[url].abort();
+      }
+    });
+  }
+
+  return { update: update, stop: stop };
+})();
+
+$(document).bind("cbox_complete", function () {
+  prefetcher.update($.colorbox.element().attr("href"));
+});
+$(document).bind("cbox_closed", prefetcher.stop);
@@ -0,0 +1,188 @@
+// Stain lookup from the static index written by sigal_plugins/search_index.py.
+// Words that are a theme pick the theme, the others match locations or filenames,
+// e.g. "bottom-right xgte" or "phb 0003". Only the shards a lookup needs are fetched.
+(function () {
+  var form = document.getElementById("search");
+  if (!form || !window.fetch) {
+    return;
+  }
+  var input = form.querySelector("input");
+  var results = document.getElementById("search-results");
+  var indexUrl = new URL(form.getAttribute("data-index"), document.baseURI);
+  var rootUrl = new URL("..", indexUrl);
+  var SEARCH_INDEX_VERSION = 1;
+  var MAX_RESULTS = 60;
+  var manifest = null;
+  var shards = {};
+  var latest = 0;
+
+  function getJSON(url) {
+    return fetch(url).then(function (response) {
+      if (!response.ok) {
+        throw new Error(response.status + " " + url);
+      }
+      return response.json();
+    });
+  }
+
+  function loadManifest() {
+    if (!manifest) {
+      manifest = getJSON(indexUrl).then(function (data) {
+        if (data.version !== SEARCH_INDEX_VERSION) {
+          throw new Error("Unknown search index version " + data.version);
+        }
+        return data;
+      });
+    }
+    return manifest;
+  }
+
+  function loadShard(shard) {
+    if (!shards[shard.file]) {
+      shards[shard.file] = getJSON(new URL(shard.file, indexUrl));
+    }
+    return shards[shard.file];
+  }
+
+  function parseQuery(text, index) {
+    var query = { themes: [], locations: null, words: [] };
+    text.toLowerCase().split(/[\s,]+/).forEach(function (word) {
+      if (!word || word === "in") {
+        return;
+      }
+      if (index.themes.indexOf(word) !== -1) {
+        query.themes.push(word);
+        return;
+      }
+      var locations = index.locations.filter(function (location) {
+        return location === word;
+      });
+      if (!locations.length) {
+        locations = index.locations.filter(function (location) {
+          return location.indexOf(word) !== -1;
+        });
+      }
+      if (locations.length) {
+        query.locations = locations;
+      } else {
+        query.words.push(word);
+      }
+    });
+    return query;
+  }
+
+  function shardMatches(shard, query) {
+    if (query.themes.length && query.themes.indexOf(shard.theme) === -1) {
+      return false;
+    }
+    if (!query.locations) {
+      return true;
+    }
+    // records are sorted by location, so a shard holds every location between its first and last
+    return query.locations.some(function (location) {
+      return shard.first <= location && location <= shard.last;
+    });
+  }
+
+  function recordMatches(record, query) {
+    if (query.locations && query.locations.indexOf(record[0]) === -1) {
+      return false;
+    }
+    return query.words.every(function (word) {
+      return record[1].toLowerCase().indexOf(word) !== -1;
+    });
+  }
+
+  function albumUrl(index, theme, location) {
+    return new URL(index.albums[theme][location] + index.index, rootUrl).href;
+  }
+
+  function imageUrl(index, theme, location, filename) {
+    return new URL(index.albums[theme][location] + filename, rootUrl).href;
+  }
+
+  function link(href, text) {
+    var a = document.createElement("a");
+    a.href = href;
+    a.textContent = text;
+    return a;
+  }
+
+  function renderResult(index, theme, record) {
+    var location = record[0];
+    var filename = record[1];
+    var item = document.createElement("li");
+    var image = document.createElement("a");
+    image.href = imageUrl(index, theme, location, filename);
+    var thumb = document.createElement("img");
+    thumb.src = new URL(index.albums[theme][location] + record[2], rootUrl).href;
+    thumb.alt = theme + " " + location + " " + filename;
+    thumb.loading = "lazy";
+    image.appendChild(thumb);
+    item.appendChild(image);
+
+    var caption = document.createElement("span");
+    caption.appendChild(link(albumUrl(index, theme, location), theme + " / " + location));
+    caption.appendChild(document.createTextNode(" " + filename));
+    var others = Object.keys(record[3]);
+    if (others.length) {
+      caption.appendChild(document.createTextNode(" - also in "));
+      others.forEach(function (other, i) {
+        if (i) {
+          caption.appendChild(document.createTextNode(", "));
+        }
+        caption.appendChild(link(imageUrl(index, other, location, record[3][other]), other));
+      });
+    }
+    item.appendChild(caption);
+    return item;
+  }
+
+  function search(text) {
+    var current = ++latest;
+    if (!text.trim()) {
+      results.innerHTML = "";
+      return;
+    }
+    loadManifest().then(function (index) {
+      var query = parseQuery(text, index);
+      var needed = index.shards.filter(function (shard) {
+        return shardMatches(shard, query);
+      });
+      return Promise.all(needed.map(loadShard)).then(function (loaded) {
+        if (current !== latest) {
+          return;  // a newer lookup was typed in the meantime
+        }
+        var list = document.createElement("ol");
+        var found = 0;
+        loaded.forEach(function (records, i) {
+          records.forEach(function (record) {
+            if (found < MAX_RESULTS && recordMatches(record, query)) {
+              list.appendChild(renderResult(index, needed[i].theme, record));
+              found += 1;
+            }
+          });
+        });
+        results.innerHTML = "";
+        if (found) {
+          results.appendChild(list);
+        } else {
+          results.textContent = "No stains found.";
+        }
+      });
+    }).catch(function (error) {
+      results.textContent = "Search is not available.";
+      console.error(error);
+    });
+  }
+
+  var timer = null;
+  input.addEventListener("input", function () {
+    clearTimeout(timer);
+    timer = setTimeout(function () { search(input.value); }, 150);
+  });
+  form.addEventListener("submit", function (event) {
+    event.preventDefault();
+    search(input.value);
+  });
+})();
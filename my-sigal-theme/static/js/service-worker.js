@@ -0,0 +1,158 @@
+// Service worker of the gallery. sigal_plugins/service_worker.py copies it to
+// the top of the site as sw.js, so it can serve every page, and defines
+// CACHE_VERSION, MEDIA_VERSION, SHELL_FILES (the theme's static files) and
+// THUMB_DIR above this.
+//
+// * the theme shell is cached at install and served from the cache
+// * pages come from the network, and from the cache when offline
+// * images are served from the cache, and only fetched when they aren't in it,
+//   so an image prefetched by app.js is downloaded once. Only the MAX_IMAGES
+//   most recently fetched ones are kept, and the MAX_THUMBNAILS most recent
+//   thumbnails, so album pages don't push them out
+// * every cached image is stored with the MEDIA_VERSION it was fetched under.
+//   MEDIA_VERSION changes whenever an image of the gallery may have, then an
+//   image cached under an older one is checked with a conditional request the
+//   next time it is viewed: only a changed image is downloaded again, and
+//   images that weren't are kept, with the new version
+
+var SHELL_CACHE = "shell-" + CACHE_VERSION;
+var PAGE_CACHE = "pages";
+var IMAGE_CACHE = "images";
+var THUMBNAIL_CACHE = "thumbnails";
+var CURRENT_CACHES = [SHELL_CACHE, PAGE_CACHE, IMAGE_CACHE, THUMBNAIL_CACHE];
+var MAX_PAGES = 50;
+var MAX_IMAGES = 200;
+var MAX_THUMBNAILS = 1000;
+var IMAGE_EXTENSIONS = /\.(png|jpe?g|gif|webp)$/i;
+var VERSION_HEADER = "X-Media-Version";
+
+self.addEventListener("install", function (event) {
+  event.waitUntil(
+    caches.open(SHELL_CACHE).then(function (cache) {
+      return cache.addAll(SHELL_FILES);
+    }).then(function () {
+      return self.skipWaiting();
+    })
+  );
+});
+
+self.addEventListener("activate", function (event) {
+  // shells of older versions of the theme
+  event.waitUntil(
+    caches.keys().then(function (names) {
+      return Promise.all(names.filter(function (name) {
+        return CURRENT_CACHES.indexOf(name) === -1;
+      }).map(function (name) {
+        return caches.delete(name);
+      }));
+    }).then(function () {
+      return self.clients.claim();
+    })
+  );
+});
+
+function trim(cacheName, maxEntries) {
+  // keys() lists entries in the order they were put, so the oldest go first
+  return caches.open(cacheName).then(function (cache) {
+    return cache.keys().then(function (keys) {
+      return Promise.all(keys.slice(0, Math.max(keys.length - maxEntries, 0)).map(function (key) {
+        return cache.delete(key);
+      }));
+    });
+  });
+}
+
+function store(cacheName, maxEntries, request, response) {
+  if (!response.ok) {
+    return Promise.resolve();
+  }
+  return caches.open(cacheName).then(function (cache) {
+    return cache.delete(request).then(function () {
+      return cache.put(request, response);
+    });
+  }).then(function () {
+    return trim(cacheName, maxEntries);
+  });
+}
+
+function networkFirst(event, cacheName, maxEntries) {
+  return fetch(event.request).then(function (response) {
+    event.waitUntil(store(cacheName, maxEntries, event.request, response.clone()));
+    return response;
+  }).catch(function () {
+    return caches.match(event.request).then(function (cached) {
+      return cached || Response.error();
+    });
+  });
+}
+
+function storeVersioned(cacheName, maxEntries, request, response) {
+  // a copy of the response that says which MEDIA_VERSION it is current for
+  var headers = new Headers(response.headers);
+  headers.set(VERSION_HEADER, MEDIA_VERSION);
+  return response.blob().then(function (body) {
+    return store(cacheName, maxEntries, request, new Response(body, {
+      status: response.status,
+      statusText: response.statusText,
+      headers: headers
+    }));
+  });
+}
+
+function revalidate(event, cacheName, maxEntries, cached) {
+  var headers = {};
+  if (cached.headers.has("ETag")) {
+    headers["If-None-Match"] = cached.headers.get("ETag");
+  }
+  if (cached.headers.has("Last-Modified")) {
+    headers["If-Modified-Since"] = cached.headers.get("Last-Modified");
+  }
+  // by URL, as the headers can't be added to the no-cors request of an <img>
+  return fetch(event.request.url, {headers: headers}).then(function (response) {
+    if (response.status === 304) {
+      event.waitUntil(storeVersioned(cacheName, maxEntries, event.request, cached.clone()));
+      return cached;
+    }
+    event.waitUntil(storeVersioned(cacheName, maxEntries, event.request, response.clone()));
+    return response;
+  }, function () {
+    // offline, the cached image is the best there is
+    return cached;
+  });
+}
+
+function cacheFirst(event, cacheName, maxEntries) {
+  return caches.open(cacheName).then(function (cache) {
+    return cache.match(event.request);
+  }).then(function (cached) {
+    if (cached && cached.headers.get(VERSION_HEADER) === MEDIA_VERSION) {
+      return cached;
+    }
+    if (cached) {
+      return revalidate(event, cacheName, maxEntries, cached);
+    }
+    return fetch(event.request).then(function (response) {
+      event.waitUntil(storeVersioned(cacheName, maxEntries, event.request, response.clone()));
+      return response;
+    });
+  });
+}
+
+self.addEventListener("fetch", function (event) {
+  var request = event.request;
+  var url = new URL(request.url);
+  if (request.method !== "GET" || url.origin !== self.location.origin) {
+    return;
+  }
+  if (request.mode === "navigate") {
+    event.respondWith(networkFirst(event, PAGE_CACHE, MAX_PAGES));
+  } else if (IMAGE_EXTENSIONS.test(url.pathname) && url.pathname.indexOf("/" + THUMB_DIR + "/") !== -1) {
+    event.respondWith(cacheFirst(event, THUMBNAIL_CACHE, MAX_THUMBNAILS));
+  } else if (IMAGE_EXTENSIONS.test(url.pathname)) {
+    event.respondWith(cacheFirst(event, IMAGE_CACHE, MAX_IMAGES));
+  } else {
+    event.respondWith(caches.match(request).then(function (cached) {
+      return cached || fetch(request);
+    }));
+  }
+});
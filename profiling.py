@@ -0,0 +1,86 @@
+"""Profiling hook for run.py commands.
+
+`python run.py --profile <command>` profiles the whole command, `--profile-phase NAME` only the time spent in
+one of the phases recorded by metrics.py (e.g. "listing", "hashing", "rendering", "build", "resizing" or
+"uploading").
+pyinstrument is used when it is installed, since a sampling profiler barely slows the command down. Otherwise
+it falls back to cProfile.
+
+Either way a stats file is written (`.html` for pyinstrument, `.prof` for cProfile, which can be opened with
+snakeviz or `python -m pstats`) and a summary of the top hotspots is printed.
+
+Only code on the main thread is profiled, so commands hand their work to in-process code while profiling
+where they can, e.g. the sigal build runs on one CPU.
+"""
+
+import io
+
+DEFAULT_TOP = 20
+
+
+class CProfileProfiler:
+    name = "cProfile"
+    extension = ".prof"
+
+    def __init__(self):
+        import cProfile
+
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path, top=DEFAULT_TOP):
+        """Write the stats file and return the top hotspots as text."""
+        import pstats
+
+        self.profile.dump_stats(path)
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(top)
+        return stream.getvalue()
+
+
+class PyinstrumentProfiler:
+    name = "pyinstrument"
+    extension = ".html"
+
+    def __init__(self):
+        from pyinstrument import Profiler
+
+        self.profiler = Profiler()
+        self.session = None
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self):
+        # pyinstrument keeps adding to the same session when it's started again, e.g. for a repeated phase
+        self.session = self.profiler.stop()
+
+    def write(self, path, top=DEFAULT_TOP):
+        from pyinstrument.renderers import ConsoleRenderer, HTMLRenderer
+
+        with open(path, "w", encoding="utf-8") as write_file:
+            write_file.write(HTMLRenderer().render(self.session))
+        text = ConsoleRenderer(unicode=False, color=False, show_all=False).render(
+            self.session
+        )
+        return "\n".join(text.splitlines()[: top + 10])
+
+
+def create_profiler():
+    """pyinstrument's sampling profiler if it is installed, cProfile otherwise."""
+    try:
+        return PyinstrumentProfiler()
+    except ImportError:
+        return CProfileProfiler()
+
+
+def report(profiler, path, top=DEFAULT_TOP):
+    summary = profiler.write(path, top)
+    print(f"--- {profiler.name} hotspots (full profile in {path}) ---")
+    print(summary)
@@ -0,0 +1,195 @@
+"""Retries and adaptive concurrency shared by everything in transfer.py.
+
+Azure and Spaces both answer with 503 (or 429) when a storage account gets more requests than it allows, and
+connections sometimes just drop. Requests that fail like that are retried with exponential backoff and full
+jitter, waiting at least as long as the server's Retry-After header asks for. Anything else (404, 403, 409, ...)
+fails straight away.
+
+How many requests are in flight is decided by an AIMD controller, like TCP congestion control: every throttled
+response halves the limit, and every round of clean responses raises it by one, up to the configured maximum.
+
+Neither SDK is imported here, errors are recognised by their status code, error code and class names.
+"""
+
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+# local
+import metrics
+
+MAX_ATTEMPTS = 6
+BASE_DELAY = 0.5
+MAX_DELAY = 30
+MAX_RETRY_AFTER = 120
+
+THROTTLE_STATUSES = {429, 503}
+TRANSIENT_STATUSES = {408, 500, 502, 504}
+# Azure error codes and S3 error codes that mean "slow down"
+THROTTLE_CODES = {
+    "ServerBusy",
+    "OperationTimedOut",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequests",
+    "RequestLimitExceeded",
+    "ServiceUnavailable",
+}
+# error codes of failures that are worth another try, e.g. for single keys of an S3 batch delete
+TRANSIENT_CODES = {"InternalError", "RequestTimeout"}
+# connection problems from the standard library, azure-core, aiohttp and botocore
+TRANSIENT_ERRORS = {
+    "ConnectionError",
+    "TimeoutError",
+    "ServiceRequestError",
+    "ServiceResponseError",
+    "ClientConnectionError",
+    "ServerDisconnectedError",
+    "EndpointConnectionError",
+    "ConnectionClosedError",
+    "ConnectTimeoutError",
+    "ReadTimeoutError",
+}
+
+
+def status_code(ex):
+    """HTTP status of a failed Azure or boto3 request, or None."""
+    # azure.core HttpResponseError
+    code = getattr(ex, "status_code", None)
+    if code is None:
+        # botocore ClientError
+        response = getattr(ex, "response", None)
+        if isinstance(response, dict):
+            code = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code
+
+
+def error_code(ex):
+    code = getattr(ex, "error_code", None)
+    if code is None:
+        response = getattr(ex, "response", None)
+        if isinstance(response, dict):
+            code = response.get("Error", {}).get("Code")
+    return code
+
+
+def response_headers(ex):
+    response = getattr(ex, "response", None)
+    if isinstance(response, dict):
+        return response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    return getattr(response, "headers", None) or {}
+
+
+def retry_after(ex):
+    """Seconds the server asked us to wait in a Retry-After header, or None."""
+    for name, value in response_headers(ex).items():
+        if name.lower() != "retry-after":
+            continue
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0), MAX_RETRY_AFTER)
+    return None
+
+
+def is_throttle(ex):
+    return status_code(ex) in THROTTLE_STATUSES or error_code(ex) in THROTTLE_CODES
+
+
+def is_transient(ex):
+    if is_throttle(ex) or status_code(ex) in TRANSIENT_STATUSES:
+        return True
+    if error_code(ex) in TRANSIENT_CODES:
+        return True
+    return any(cls.__name__ in TRANSIENT_ERRORS for cls in type(ex).__mro__)
+
+
+def backoff_delay(attempt, ex=None):
+    """How long to wait before retry number `attempt` (starting at 0): full jitter, never below Retry-After."""
+    delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2**attempt))
+    server_delay = retry_after(ex) if ex is not None else None
+    if server_delay is not None:
+        delay = max(delay, server_delay)
+    return delay
+
+
+class AIMDController:
+    """Limits requests in flight, halving the limit on throttling and growing it by one per clean round.
+
+    Use as `async with controller: ...` around each request, and report the outcome with
+    on_success() or on_throttle(). Create it inside the event loop that uses it.
+    """
+
+    def __init__(self, maximum, initial=None, minimum=1, decrease=0.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or max(minimum, maximum // 2))
+        self.decrease = decrease
+        self.in_flight = 0
+        self.clean = 0
+        self._last_decrease = float("-inf")
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self.clean += 1
+        if self.clean >= int(self.limit) and self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.clean = 0
+
+    def on_throttle(self, started=None):
+        """Halve the limit, unless the request started before the last decrease.
+
+        Throttled requests that were already in flight when the limit dropped say nothing new.
+        """
+        metrics.count("throttles")
+        self.clean = 0
+        if started is not None and started < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        print(f"Throttled, lowering concurrency to {int(self.limit)}")
+
+    async def call(self, make_request, stage="request", max_attempts=MAX_ATTEMPTS):
+        """Await make_request() inside the limit, retrying transient failures.
+
+        :param make_request: function returning a new awaitable for each attempt
+        :param stage: name the latency of each attempt is recorded under, e.g. "azure.upload"
+        :return: the result of the first successful attempt
+        """
+        for attempt in range(max_attempts):
+            try:
+                async with self:
+                    started = time.monotonic()
+                    metrics.count("requests")
+                    try:
+                        result = await make_request()
+                    finally:
+                        metrics.observe(stage, time.monotonic() - started)
+            except Exception as ex:
+                if is_throttle(ex):
+                    self.on_throttle(started)
+                if not is_transient(ex) or attempt == max_attempts - 1:
+                    raise
+                metrics.count("retries")
+                # wait outside the limit, so the slot goes to a request that can run now
+                await asyncio.sleep(backoff_delay(attempt, ex))
+            else:
+                self.on_success()
+                return result
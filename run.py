@@ -1,37 +1,86 @@
-import glob
-import os
 import shutil
-from distutils.dir_util import copy_tree
 from pathlib import Path
 
 # third party
 import click
-from sigal import build
 
-from utils import (
-    azure_backup_container,
-    azure_create_container,
-    azure_delete_dir,
-    azure_get_containers,
-    azure_upload_dir,
-    do_delete_dir,
-    do_download_file,
-    do_upload_dir,
-    do_upload_file,
-    remove_empty_folders,
-    unzip_file,
-    zipdir,
-)
+# local
+import metrics
+from stains import LOCATION_SLUGS, MASKS_DIR, TEXTURES_DIR, THEME_SLUGS
+
+# Everything else (sigal, the boto3 and Azure SDKs, NumPy...) is imported inside the commands that use it,
+# so that cheap commands start fast. benchmarks/startup.py keeps it that way.
 
 
 @click.group()
+@click.option(
+    "--metrics-out",
+    default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write timings, transfer counts and request latencies of the command to this JSON file.",
+)
+@click.option(
+    "--profile",
+    default=False,
+    is_flag=True,
+    help="Profile the command, with pyinstrument if it is installed or else cProfile.",
+)
+@click.option(
+    "--profile-phase",
+    default=None,
+    help="Only profile this phase of the command, e.g. listing, hashing, rendering, build, resizing or uploading.",
+)
+@click.option(
+    "--profile-out",
+    default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Stats file to write. Defaults to <command>.html (pyinstrument) or <command>.prof (cProfile).",
+)
+@click.option(
+    "--profile-top",
+    default=20,
+    show_default=True,
+    help="Number of hotspots to print.",
+)
 @click.pass_context
-def cli(ctx):
+def cli(ctx, metrics_out, profile, profile_phase, profile_out, profile_top):
     """Helper commands for managing the website and backend data.
 
     They are used both in the continuous integration pipeline as well as manually from time to time.
     """
     ctx.ensure_object(dict)
+    run_metrics = metrics.reset(command=ctx.invoked_subcommand)
+
+    profiler = None
+    if profile or profile_phase:
+        from profiling import create_profiler
+
+        profiler = create_profiler()
+        run_metrics.profile_phase(profile_phase, profiler)
+        if not profile_phase:
+            profiler.start()
+
+    def finish():
+        if profiler:
+            from profiling import report
+
+            if not profile_phase:
+                profiler.stop()
+            if (
+                run_metrics.profiled_phase
+                and run_metrics.profiled_phase not in run_metrics.phases
+            ):
+                print(f"Phase '{profile_phase}' never ran, nothing was profiled.")
+            else:
+                out = profile_out or f"{run_metrics.command}{profiler.extension}"
+                report(profiler, out, profile_top)
+        run_metrics.add_phase(run_metrics.command, run_metrics.wall_seconds())
+        if metrics_out:
+            run_metrics.write_report(metrics_out)
+        if metrics_out or run_metrics.has_transfers():
+            print(run_metrics.summary())
+
+    ctx.call_on_close(finish)
 
 
 @cli.command()
@@ -59,8 +108,12 @@ def cli(ctx):
 )
 def do_download(local, remote, force):
     """Download and unzip albums.zip from Digital Ocean."""
-    do_download_file(remote_file=remote, local_file=local, force=force)
-    unzip_file(local)
+    from utils import do_download_file, unzip_file
+
+    with metrics.phase("downloading"):
+        do_download_file(remote_file=remote, local_file=local, force=force)
+    with metrics.phase("unzipping"):
+        unzip_file(local)
 
 
 @cli.command()
@@ -77,12 +130,70 @@ def do_backup(file):
     I run this command locally on the machine where I use GIMP to create new files to put into the albums.
     It zips up the albums/ directory and uploads it to (currently) Digital Ocean Spaces.
     """
+    from mapping_store import refresh_mapping_json
+    from utils import do_upload_file, zipdir
+
+    refresh_mapping_json("albums")
     # upload_location is going to be top level of the DO Space/Azure container at the moment
     upload_location = file
     Path(file).unlink(missing_ok=True)
-    zipdir("albums/", file)
+    with metrics.phase("zipping"):
+        zipdir("albums/", file)
     # this will overwrite what is in Digital Ocean!
-    do_upload_file(file, upload_location)
+    with metrics.phase("uploading"):
+        do_upload_file(file, upload_location)
+
+
+@cli.command()
+@click.option(
+    "--container",
+    "-c",
+    default="originals",
+    show_default=True,
+    help="Azure Blob Storage container to copy into.",
+)
+@click.option(
+    "--prefix",
+    "-p",
+    default="",
+    help="Only mirror objects whose key starts with this. If not provided, mirrors the whole Space.",
+)
+@click.option(
+    "--dest-prefix",
+    default="",
+    help="Prefix the blob names get instead of --prefix.",
+)
+@click.option(
+    "--relay",
+    default=False,
+    show_default=True,
+    is_flag=True,
+    help="Stream every object through this machine instead of letting Azure copy from a presigned URL.",
+)
+@click.pass_context
+def do_mirror(ctx, container, prefix, dest_prefix, relay):
+    """Mirror Digital Ocean Spaces into Azure Blob Storage.
+
+    Azure copies each object straight from a presigned Spaces URL. Objects it can't fetch are streamed through
+    here in blocks, so nothing is written to disk either way. Objects whose ETag hasn't changed since the last
+    mirror are skipped.
+    """
+    from utils import azure_create_container, azure_get_containers, do_mirror_to_azure
+
+    with metrics.phase("listing"):
+        containers = azure_get_containers(prefix=container)
+        container_names = [found["name"] for found in containers]
+
+    if container not in container_names:
+        print(f"Container '{container}' not found. Creating.")
+        azure_create_container(container)
+
+    with metrics.phase("mirroring"):
+        failures = do_mirror_to_azure(
+            container, prefix, dest_prefix, server_copy=not relay
+        )
+    if failures:
+        ctx.exit(1)
 
 
 @cli.command()
@@ -109,21 +220,33 @@ def do_backup(file):
     is_flag=True,
     help="Delete Azure Storage container contents first.",
 )
+@click.option(
+    "--full-listing",
+    default=False,
+    show_default=True,
+    is_flag=True,
+    help="List the container instead of trusting its manifest.",
+)
 @click.pass_context
-def azure_deploy(ctx, container, dir_, fresh_start):
+def azure_deploy(ctx, container, dir_, fresh_start, full_listing):
     """Deploy built static files to Azure.
 
-    This command simulates a Travis CI deployment which uploads the _build directory to Azure Blob Storage.
-    It is useful for local development without doing a git commit/push.
+    Only new and changed files are uploaded, and files that are gone from the build are deleted. What is in the
+    container comes from the manifest the last deploy left there, so it isn't listed unless the manifest is
+    missing or was changed elsewhere. Run azure-audit now and then to check the manifest against a listing.
     """
+    from utils import azure_deploy_dir
 
     # destination = "travis-builds"
     # do_upload_dir(dir_, destination)
 
     if fresh_start:
         ctx.invoke(azure_clear, container=container, prefix="")
-    azure_upload_dir(dir_, container)
+    with metrics.phase("deploying"):
+        failures = azure_deploy_dir(dir_, container, full_listing)
     # azure_upload_dir("albums", "stains")
+    if failures:
+        ctx.exit(1)
 
 
 @cli.command()
@@ -142,10 +265,13 @@ def azure_deploy(ctx, container, dir_, fresh_start):
 )
 def azure_clear(container, prefix):
     """Delete directory from Azure Storage."""
+    from utils import azure_delete_dir
+
     # destination = "travis-builds/"
     # do_delete_dir(destination)
 
-    azure_delete_dir(container, prefix)
+    with metrics.phase("deleting"):
+        azure_delete_dir(container, prefix)
 
 
 @cli.command()
@@ -163,22 +289,146 @@ def azure_clear(container, prefix):
     show_default=True,
     help="Azure backup container.",
 )
+@click.option(
+    "--full-listing",
+    default=False,
+    show_default=True,
+    is_flag=True,
+    help="List both containers instead of trusting their manifests.",
+)
 @click.pass_context
-def azure_backup_website(ctx, source_container, backup_container):
-    """Backup website on Azure Storage."""
-    containers = azure_get_containers(prefix=backup_container)
-    container_names = [container["name"] for container in containers]
+def azure_backup_website(ctx, source_container, backup_container, full_listing):
+    """Backup website on Azure Storage.
+
+    The backup container is made a copy of the website, copying only the blobs that changed since the last
+    backup and deleting the ones that are gone, as their manifests tell.
+    """
+    from utils import (
+        azure_backup_container,
+        azure_create_container,
+        azure_get_containers,
+    )
+
+    with metrics.phase("listing"):
+        containers = azure_get_containers(prefix=backup_container)
+        container_names = [container["name"] for container in containers]
 
-    # either create a fresh backup container, or clear out the old one
     if backup_container not in container_names:
         print(f"Backup container '{backup_container}' not found. Creating.")
         azure_create_container(backup_container)
-    else:
-        ctx.invoke(azure_clear, container=backup_container, prefix="")
 
-    azure_backup_container(
-        src_container=source_container, dest_container=backup_container
+    with metrics.phase("copying"):
+        failures = azure_backup_container(
+            src_container=source_container,
+            dest_container=backup_container,
+            full_listing=full_listing,
+        )
+    if failures:
+        ctx.exit(1)
+
+
+@cli.command()
+@click.option(
+    "--container",
+    "-c",
+    default="$web",
+    show_default=True,
+    help="Azure Blob Storage container.",
+)
+@click.option(
+    "--repair",
+    default=False,
+    show_default=True,
+    is_flag=True,
+    help="Replace the manifest with what the listing found.",
+)
+@click.pass_context
+def azure_audit(ctx, container, repair):
+    """Check the manifest of an Azure container against a full listing of it.
+
+    Deploys and backups trust the manifest instead of listing the container, this catches anything that changed
+    the container behind their back. Exits with an error if they differ, unless --repair is given.
+    """
+    from utils import azure_audit as audit
+
+    with metrics.phase("auditing"):
+        report = audit(container, repair)
+
+    if report is None:
+        print(f"{container} has no manifest" + (", wrote one" if repair else ""))
+        if not repair:
+            ctx.exit(1)
+        return
+
+    labels = {"missing": "Missing", "extra": "Extra", "changed": "Changed"}
+    for key, label in labels.items():
+        for path in report[key]:
+            print(f"{label}:\t{path}")
+    print(
+        ", ".join(f"{len(report[key])} {key}" for key in labels)
+        + f" (manifest vs {container})"
     )
+    if any(report.values()):
+        if repair:
+            print("Replaced the manifest with the listing")
+        else:
+            ctx.exit(1)
+
+
+@cli.command()
+@click.option(
+    "--container",
+    "-c",
+    default="$web",
+    show_default=True,
+    help="Azure Blob Storage container.",
+)
+@click.option(
+    "--dir",
+    "-d",
+    "dir_",
+    default="_build",
+    show_default=True,
+    help="Local directory that was deployed.",
+)
+@click.option(
+    "--allow-extra",
+    default=False,
+    show_default=True,
+    is_flag=True,
+    help="Don't fail because of blobs that aren't in the local directory.",
+)
+@click.pass_context
+def azure_verify(ctx, container, dir_, allow_extra):
+    """Check that an Azure container matches the local build.
+
+    Compares the MD5 of every local file with the Content-MD5 of its blob, from a single listing of the container,
+    so nothing is downloaded. Exits with an error if anything is missing, extra or different.
+    """
+    from utils import azure_verify as verify
+
+    with metrics.phase("verifying"):
+        report = verify(dir_, container)
+
+    labels = {
+        "missing": "Missing",
+        "extra": "Extra",
+        "mismatched": "Mismatched",
+        "unverified": "Unverified",
+    }
+    for key, label in labels.items():
+        for path in report[key]:
+            print(f"{label}:\t{path}")
+    print(
+        ", ".join(f"{len(report[key])} {key}" for key in labels)
+        + f" ({dir_} vs {container})"
+    )
+
+    failed = report["missing"] or report["mismatched"]
+    if report["extra"] and not allow_extra:
+        failed = True
+    if failed:
+        ctx.exit(1)
 
 
 @click.option(
@@ -195,12 +445,126 @@ def sigal_clean(dir_):
     shutil.rmtree(dir_, ignore_errors=True)
 
 
+def parse_shard_option(ctx, param, value):
+    from shards import parse_shard
+
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@cli.command()
+@click.option(
+    "--shard",
+    default=None,
+    metavar="I/N",
+    callback=parse_shard_option,
+    help="Only build the I-th of N shards of the albums, into the existing build directory.",
+)
+@click.pass_context
+def sigal_build(ctx, shard):
+    """Build the website using Sigal.
+
+    With --shard the albums are split into N shards of about the same pixel count, the same way on every machine,
+    and only the I-th is built: its images and album pages. Once every shard is in the build directory, sigal-merge
+    writes the rest of the site.
+    """
+    from mapping_store import refresh_mapping_json
+
+    # the source of sigal.conf.py
+    refresh_mapping_json("albums")
+    if shard is not None:
+        from shards import build_shard
+        from watch import load_settings
+
+        ncpu = 1 if metrics.profiling() else None
+        if build_shard(load_settings("sigal.conf.py"), *shard, ncpu=ncpu):
+            ctx.exit(1)
+        return
+
+    from sigal import build
+
+    with metrics.phase("clean"):
+        ctx.invoke(sigal_clean)
+    with metrics.phase("build"):
+        if metrics.profiling():
+            # resize in this process, where the profiler can see it
+            ctx.invoke(build, ncpu=1)
+        else:
+            ctx.invoke(build)
+
+
 @cli.command()
 @click.pass_context
-def sigal_build(ctx):
-    """Build the website using Sigal."""
-    ctx.invoke(sigal_clean)
-    ctx.invoke(build)
+def sigal_merge(ctx):
+    """Finish a sharded build: album list pages, search index, service worker...
+
+    Run it once the output of every `sigal-build --shard` is in the build directory, e.g. after downloading the
+    build of each CI job into it.
+    """
+    from shards import merge
+    from watch import load_settings
+
+    missing = merge(load_settings("sigal.conf.py"))
+    if missing:
+        print(f"Outputs of {len(missing)} albums are missing, e.g. {missing[0]}:")
+        print("build every shard into the build directory before merging")
+        ctx.exit(1)
+
+
+@cli.command()
+@click.option(
+    "--config",
+    default="sigal.conf.py",
+    show_default=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Sigal configuration file.",
+)
+@click.option(
+    "--container",
+    "-c",
+    default="$web",
+    show_default=True,
+    help="Azure Blob Storage container to push rebuilt files to.",
+)
+@click.option(
+    "--no-push",
+    default=False,
+    show_default=True,
+    is_flag=True,
+    help="Only rebuild, don't upload anything.",
+)
+@click.option(
+    "--debounce",
+    default=2.0,
+    show_default=True,
+    type=float,
+    help="Seconds without changes before a rebuild starts.",
+)
+def watch(config, container, no_push, debounce):
+    """Rebuild and deploy albums as stains are saved into them.
+
+    Watches the albums for new or changed PNGs and index.md files, then rebuilds only the changed albums and the
+    albums above them, and uploads just the files that changed. Run a full sigal-build once before starting.
+    """
+    from watch import load_settings
+    from watch import watch as watch_albums
+
+    settings = load_settings(config)
+    push = None
+    if not no_push:
+        from utils import azure_upload_files
+
+        def push(outputs):
+            azure_upload_files(settings["destination"], outputs, container)
+
+    try:
+        watch_albums(settings, push, debounce=debounce)
+    except KeyboardInterrupt:
+        print("Stopped watching")
 
 
 @cli.command()
@@ -221,11 +585,22 @@ def sigal_build(ctx):
 @click.pass_context
 def sigal_compress(ctx, compressed_dir, albums_dir):
     """Compress images using Sigal, and merge with main albums directory."""
+    from distutils.dir_util import copy_tree
+
+    from sigal import build
+
+    from utils import remove_empty_folders
+
     ctx.invoke(sigal_clean, dir_=compressed_dir)
-    ctx.invoke(build, config="sigal.conf.img.py", destination=compressed_dir)
-    remove_empty_folders(compressed_dir)
-    copy_tree(compressed_dir, albums_dir)
-    shutil.rmtree(compressed_dir)
+    with metrics.phase("build"):
+        ncpu = 1 if metrics.profiling() else None
+        ctx.invoke(
+            build, config="sigal.conf.img.py", destination=compressed_dir, ncpu=ncpu
+        )
+    with metrics.phase("merge"):
+        remove_empty_folders(compressed_dir)
+        copy_tree(compressed_dir, albums_dir)
+        shutil.rmtree(compressed_dir)
 
 
 @cli.command()
@@ -238,18 +613,212 @@ def sigal_compress(ctx, compressed_dir, albums_dir):
 )
 def count_images(albums_dir):
     """Count images in album directory."""
-    templates_dir = Path(albums_dir) / "templates"
-    template_images = len(glob.glob1(templates_dir, "*.png"))
+    from album_index import refreshed_index
+
+    with refreshed_index(albums_dir) as index:
+        images = index.entries(albums_dir, suffix=".png")
 
+    template_images = 0
     total_images = 0
-    for root, dirs, files in os.walk(albums_dir):
-        for file in files:
-            if file.endswith(".png"):
-                total_images += 1
+    for path in images:
+        top_dir, _, rest = path.partition("/")
+        # masks and textures are inputs for render-stains, not stains
+        if top_dir in (MASKS_DIR, TEXTURES_DIR):
+            continue
+        if top_dir == "templates" and "/" not in rest:
+            template_images += 1
+        total_images += 1
 
     stain_images = total_images - template_images
     print(f"There are {stain_images} stains and {template_images} templates.")
 
 
+@cli.command()
+@click.option(
+    "--albums-dir",
+    "-a",
+    default="albums",
+    show_default=True,
+    help="Main directory of albums.",
+)
+@click.option(
+    "--hash",
+    "algorithm",
+    default="phash",
+    show_default=True,
+    type=click.Choice(["phash", "dhash"]),
+    help="Perceptual hash to compare.",
+)
+@click.option(
+    "--threshold",
+    "-t",
+    default=6,
+    show_default=True,
+    type=click.IntRange(0, 64),
+    help="Most bits two hashes may differ in to count as near-duplicates.",
+)
+@click.option(
+    "--workers",
+    "-w",
+    default=None,
+    type=int,
+    help="Number of processes hashing new images. Defaults to the number of CPUs.",
+)
+@click.option(
+    "--output",
+    "-o",
+    default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Also write the groups as JSON to this file.",
+)
+def find_duplicates(albums_dir, algorithm, threshold, workers, output):
+    """Find duplicate and near-identical stains within each theme.
+
+    Stains are compared by shape (their alpha channel) with perceptual hashes, which are cached in .cache/ so only
+    new or changed images are read.
+    """
+    import json
+
+    from duplicates import find_duplicates as find
+
+    report = find(albums_dir, algorithm, threshold, workers)
+    for theme, groups in report.items():
+        print(f"{theme}: {len(groups)} groups of near-duplicates")
+        for group in groups:
+            locations = sorted({location for location, _ in group})
+            print(f"  {', '.join(locations)}:")
+            for _, path in group:
+                print(f"    {path}")
+    duplicates = sum(len(group) - 1 for groups in report.values() for group in groups)
+    print(f"{duplicates} stains look like a duplicate of another one.")
+
+    if output:
+        with open(output, "w") as write_file:
+            json.dump(
+                {
+                    theme: [[path for _, path in group] for group in groups]
+                    for theme, groups in report.items()
+                },
+                write_file,
+                indent=2,
+            )
+
+
+@cli.command()
+@click.argument("masks", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option(
+    "--location",
+    "-l",
+    required=True,
+    type=click.Choice(LOCATION_SLUGS),
+    help="Location of the stains on the page.",
+)
+@click.option(
+    "--theme",
+    "-t",
+    "themes",
+    multiple=True,
+    type=click.Choice(THEME_SLUGS),
+    help="Theme to save. Can be given several times. Defaults to all themes.",
+)
+@click.option(
+    "--albums-dir",
+    "-a",
+    default="albums",
+    show_default=True,
+    help="Main directory of albums.",
+)
+@click.option(
+    "--workers",
+    "-w",
+    default=None,
+    type=int,
+    help="Number of processes to use. Defaults to the number of CPUs.",
+)
+def render_stains(masks, location, themes, albums_dir, workers):
+    """Save every theme variant of new stains without GIMP.
+
+    Takes greyscale masks exported from GIMP and cuts each theme texture in albums/_textures/ out with them.
+    The results are saved into the albums and the mapping store just like the GIMP plugin does.
+    """
+    from compositor import render_masks
+
+    render_masks(albums_dir, location, masks, themes=themes, workers=workers)
+
+
+@cli.command("render-theme")
+@click.argument("theme", type=click.Choice(THEME_SLUGS))
+@click.option(
+    "--albums-dir",
+    "-a",
+    default="albums",
+    show_default=True,
+    help="Main directory of albums.",
+)
+@click.option(
+    "--workers",
+    "-w",
+    default=None,
+    type=int,
+    help="Number of processes to use. Defaults to the number of CPUs.",
+)
+@click.option(
+    "--force",
+    "-f",
+    default=False,
+    show_default=True,
+    is_flag=True,
+    help="Render every stain, even the ones whose mask and texture did not change.",
+)
+def render_theme_cmd(theme, albums_dir, workers, force):
+    """Re-render every saved stain for one theme.
+
+    Run this after adding a theme to THEME_LIST or updating its texture in albums/_textures/.
+    """
+    from compositor import render_theme
+
+    render_theme(albums_dir, theme, workers=workers, force=force)
+
+
+@cli.command("export-mapping")
+@click.option(
+    "--albums-dir",
+    "-a",
+    default="albums",
+    show_default=True,
+    help="Main directory of albums.",
+)
+@click.option(
+    "--output",
+    "-o",
+    default=None,
+    help="File to write. Defaults to mapping.json in the albums directory.",
+)
+def export_mapping_cmd(albums_dir, output):
+    """Write mapping.json from the mapping store."""
+    from mapping_store import export_mapping
+
+    export_mapping(albums_dir, output)
+
+
+@cli.command("rebuild-filenames")
+@click.option(
+    "--albums-dir",
+    "-a",
+    default="albums",
+    show_default=True,
+    help="Main directory of albums.",
+)
+def rebuild_filenames(albums_dir):
+    """Reset the next filename of every album from the files on disk.
+
+    Only needed after renumbering or deleting images on purpose, so that their numbers can be used again.
+    """
+    from allocator import FilenameAllocator
+
+    with FilenameAllocator(albums_dir) as allocator:
+        allocator.rebuild()
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,204 @@
+"""Split a sigal build over several processes or machines, and merge the shards into one site.
+
+`run.py sigal-build --shard i/N` builds the i-th of N shards into the usual destination:
+
+* the albums with images are split into N shards, balanced by their total pixel count (from the album index),
+  the same way on every machine: the heaviest album goes first, each album to the lightest shard so far
+* a shard processes the images of its albums and writes their album pages, the pages of albums with sub-albums
+  are left to the merge, as they show thumbnails from every shard
+* plugins see the albums of the shard in the shard_albums setting: zips and the build cache only handle those,
+  and nothing that covers the whole gallery (search index, service worker, pruning caches) happens
+* sigal's compress_assets compresses the page of every album, so it only runs in the merge
+
+Once every shard's output is in one destination, e.g. CI jobs' _build artifacts downloaded into the same
+directory, `run.py sigal-merge` writes the album list pages and runs the plugins that cover the whole gallery.
+The result is the same _build as `sigal build` makes, ready for `run.py azure-deploy`.
+
+Shards running on one machine can share the destination, each writes only its own albums.
+"""
+
+import fnmatch
+import os
+import posixpath
+
+# local
+import metrics
+from album_index import refreshed_index
+from watch import is_ignored
+
+# settings read by the plugins, neither is set in a full build
+SHARD_ALBUMS = "shard_albums"
+SHARD_MERGE = "shard_merge"
+
+
+def parse_shard(value):
+    """(index, count) from "i/N", index counting from 1."""
+    index, _, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"{value!r} isn't of the form i/N") from None
+    if not 1 <= index <= count:
+        raise ValueError(f"shard {index} isn't between 1 and {count}")
+    return index, count
+
+
+def album_weights(settings):
+    """{album: total pixel count of its media}, albums named as sigal names them ("." is the top).
+
+    Files without known dimensions, e.g. videos, weigh their size in bytes.
+    """
+    source = settings["source"]
+    extensions = tuple(settings["img_extensions"]) + tuple(settings["video_extensions"])
+    with refreshed_index(source) as index:
+        entries = index.entries(source)
+
+    weights = {}
+    for path, entry in entries.items():
+        filename = posixpath.basename(path)
+        if not filename.lower().endswith(extensions):
+            continue
+        if is_ignored(path, settings["ignore_directories"]) or any(
+            fnmatch.fnmatch(filename, pattern) for pattern in settings["ignore_files"]
+        ):
+            continue
+        album = posixpath.dirname(path) or "."
+        if entry.width is not None:
+            weight = entry.width * entry.height
+        else:
+            weight = entry.size
+        weights[album] = weights.get(album, 0) + weight
+    return weights
+
+
+def partition(weights, count):
+    """Split albums into count shards of about the same weight, the same way for the same weights.
+
+    :param weights: {album: weight}
+    :return: list of count sets of albums
+    """
+    shards = [set() for _ in range(count)]
+    totals = [0] * count
+    for album, weight in sorted(weights.items(), key=lambda item: (-item[1], item[0])):
+        lightest = min(range(count), key=lambda num: (totals[num], num))
+        shards[lightest].add(album)
+        totals[lightest] += weight
+    return shards
+
+
+def is_full_build(settings):
+    """Whether the build covers every album, i.e. isn't a shard or a merge."""
+    return settings.get(SHARD_ALBUMS) is None
+
+
+def in_build(settings, album):
+    """Whether the build processes the album, sigal's Album or its path."""
+    albums = settings.get(SHARD_ALBUMS)
+    if albums is None:
+        return True
+    path = getattr(album, "path", album)
+    return path.replace("\\", "/") in albums
+
+
+def writes_site_files(settings):
+    """Whether the build writes the files that cover the whole gallery: a full build or the merge."""
+    return is_full_build(settings) or settings.get(SHARD_MERGE, False)
+
+
+def build_shard(settings, index, count, ncpu=None):
+    """Process the images and write the album pages of one shard, like `Gallery.build` does for all albums.
+
+    :param settings: sigal settings from watch.load_settings()
+    :param index: shard to build, from 1 to count
+    :return: number of media that failed to be processed
+    """
+    from sigal import signals
+    from sigal.gallery import Gallery, process_file, worker
+    from sigal.plugins.compress_assets import compress_gallery
+    from sigal.writer import AlbumPageWriter
+
+    weights = album_weights(settings)
+    albums = partition(weights, count)[index - 1]
+    pixels = sum(weights[album] for album in albums)
+    print(
+        f"Shard {index}/{count}: {len(albums)} of {len(weights)} albums, {pixels} pixels"
+    )
+    settings[SHARD_ALBUMS] = albums
+
+    gallery = Gallery(settings, ncpu=ncpu, quiet=True)
+    selected = [album for album in gallery.albums.values() if in_build(settings, album)]
+    with metrics.phase("build"):
+        media_list = [item for album in selected for item in gallery.process_dir(album)]
+        failed = []
+        if gallery.pool:
+            for result in gallery.pool.imap_unordered(worker, media_list):
+                if result:
+                    failed.append(result)
+            gallery.pool.close()
+            gallery.pool.join()
+        else:
+            for item in media_list:
+                result = process_file(item)
+                if result:
+                    failed.append(result)
+        if failed:
+            gallery.remove_files(failed)
+        metrics.count("images.processed", len(media_list) - len(failed))
+
+        if settings["write_html"]:
+            album_writer = AlbumPageWriter(settings, index_title=gallery.title)
+            for album in selected:
+                if not album.albums:
+                    album_writer.write(album)
+        # it would compress pages other shards, or the merge, haven't written yet
+        signals.gallery_build.disconnect(compress_gallery)
+        signals.gallery_build.send(gallery)
+
+    print(f"Processed {len(media_list)} files, {len(failed)} failed")
+    return len(failed)
+
+
+def missing_outputs(gallery):
+    """Album paths with media whose outputs aren't in the destination, i.e. shards that weren't merged in."""
+    return sorted(
+        album.path
+        for album in gallery.albums.values()
+        if any(not os.path.isfile(media.dst_path) for media in album.medias)
+    )
+
+
+def merge(settings):
+    """Write what covers the whole gallery once every shard is in the destination.
+
+    Album list pages, the files_to_copy setting, and the gallery_build plugins with SHARD_MERGE set.
+
+    :param settings: sigal settings from watch.load_settings()
+    :return: sorted album paths with missing outputs, nothing is written when there are any
+    """
+    from sigal import signals
+    from sigal.gallery import Gallery
+    from sigal.utils import copy
+    from sigal.writer import AlbumListPageWriter
+
+    settings[SHARD_ALBUMS] = set()
+    settings[SHARD_MERGE] = True
+    gallery = Gallery(settings, ncpu=1, quiet=True)
+    missing = missing_outputs(gallery)
+    if missing:
+        return missing
+
+    with metrics.phase("merge"):
+        if settings["write_html"]:
+            album_list_writer = AlbumListPageWriter(settings, index_title=gallery.title)
+            for album in gallery.albums.values():
+                if album.albums:
+                    album_list_writer.write(album)
+        for src, dst in settings["files_to_copy"]:
+            copy(
+                os.path.join(settings["source"], src),
+                os.path.join(settings["destination"], dst),
+                symlink=settings["orig_link"],
+                rellink=settings["rel_link"],
+            )
+        signals.gallery_build.send(gallery)
+    return []
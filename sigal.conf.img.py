@@ -2,7 +2,13 @@ source = "albums"
 img_size = (1076, 816)
 make_thumbs = False
 write_html = False
+# masks and textures must stay full size for `run.py render-stains`
+ignore_directories = ["_masks*", "_textures*"]
+plugin_paths = ["."]
 plugins = [
     "sigal.plugins.compress_assets",
+    # no sigal_plugins.fast_resize: without thumbnails, and with stains only about 3 times img_size, there is
+    # nothing for it to save, `benchmarks/resize.py` measured it slower than sigal here
+    "sigal_plugins.build_cache",
 ]
 compress_assets_options = {"method": "brotli"}
@@ -142,7 +142,8 @@ thumb_fit = False
 # The settings take a list of patterns matched with the fnmatch module on the
 # path relative to the source directory:
 # http://docs.python.org/2/library/fnmatch.html
-ignore_directories = []
+# _masks and _textures hold the inputs of `run.py render-stains`
+ignore_directories = ["_masks*", "_textures*"]
 ignore_files = []
 
 # -------------
@@ -250,6 +251,10 @@ google_analytics = 'UA-187978011-1'
 # Another option is to import the plugin and put the module in the list, but
 # this will break with the multiprocessing feature (the settings dict obtained
 # from this file must be serializable).
+# sigal_plugins/ and the modules it uses are found relative to the repository
+# root, which is where `sigal build` and `run.py` are run from
+plugin_paths = ["."]
+
 plugins = [
     # 'sigal.plugins.adjust',
     "sigal.plugins.compress_assets",
@@ -261,7 +266,14 @@ plugins = [
     # 'sigal.plugins.nomedia',
     # 'sigal.plugins.upload_s3',
     # 'sigal.plugins.watermark',
-    "sigal.plugins.zip_gallery",
+    # "sigal.plugins.zip_gallery", replaced by sigal_plugins.album_zips
+    "sigal_plugins.index_sizes",
+    "sigal_plugins.fast_resize",
+    # after fast_resize, so it caches what fast_resize makes
+    "sigal_plugins.build_cache",
+    "sigal_plugins.album_zips",
+    "sigal_plugins.search_index",
+    "sigal_plugins.service_worker",
 ]
 
 # Adjust the image after resizing it. A default value of 1.0 leaves the images
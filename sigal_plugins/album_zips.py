@@ -0,0 +1,191 @@
+"""Album zips that are only rebuilt when the album changes, a drop-in for sigal.plugins.zip_gallery.
+
+zip_gallery writes the zip of every album on every build, and `sigal-build` starts from an empty _build, so
+all of them are compressed again each time, deflating PNGs that don't get any smaller. Here:
+
+* every zip is kept in .cache/album-zips/ under a key made of its name and the BLAKE2b of each member, which
+  the album index or the digest cache already has, so an album only gets a new zip when its files are added, removed or changed
+* PNGs and other already compressed formats are stored as they are, everything else is deflated
+* the zips of all albums are made in a thread pool as soon as sigal has collected the albums, while the images
+  are being processed, and each album page waits for its own zip
+* the zip in _build is a hard link to the cached one (a copy across file systems), and cached zips are never
+  written in place, so the two can't get out of step
+
+The settings are the same as zip_gallery's: zip_gallery (the file name), zip_media_format and .nozip_gallery
+files. Zips of resized media can only be made once the images are, so they are made when the album page needs
+them, unless the resized images are copies of the originals (use_orig).
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from sigal import signals
+from sigal.gallery import Album
+from sigal.utils import cached_property
+
+import metrics
+import shards
+from album_index import CACHE_DIR, refreshed_index
+from digests import file_digest
+
+logger = logging.getLogger(__name__)
+
+ZIP_CACHE_DIR = os.path.join(CACHE_DIR, "album-zips")
+# bump to rebuild every cached zip, e.g. after changing how they are written
+ZIP_FORMAT_VERSION = "1"
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp4", ".webm"}
+
+_executor = None
+_zips = {}
+_used_keys = set()
+_source_digests = {}
+
+
+def zip_name(album):
+    """File name of the album's zip, or None when the album has no zip."""
+    name = album.settings["zip_gallery"]
+    if not name or len(album) == 0:
+        return None
+    if os.path.isfile(os.path.join(album.src_path, ".nozip_gallery")):
+        logger.info(
+            "Ignoring ZIP gallery generation for album '%s' because of present "
+            ".nozip_gallery file",
+            album.name,
+        )
+        return None
+    return name.format(album=album)
+
+
+def uses_sources(settings):
+    """Whether the zips hold the source files, or outputs that are copies of them."""
+    return settings["zip_media_format"] == "orig" or settings["use_orig"]
+
+
+def member_paths(album):
+    """Files going into the album's zip."""
+    attr = "src_path" if uses_sources(album.settings) else "dst_path"
+    return [getattr(media, attr) for media in album]
+
+
+def member_digest(path, source):
+    relative_path = os.path.relpath(path, source).replace("\\", "/")
+    digest = _source_digests.get(relative_path)
+    return digest if digest is not None else file_digest(path).blake2b
+
+
+def cache_key(name, paths, source):
+    sha = hashlib.sha256(f"{ZIP_FORMAT_VERSION}\n{name}\n".encode())
+    for path in paths:
+        arcname = os.path.basename(path)
+        sha.update(f"{arcname}\t{member_digest(path, source)}\n".encode())
+    return sha.hexdigest()
+
+
+def write_zip(archive_path, paths):
+    """Write a zip atomically, storing compressed formats and deflating the rest."""
+    # albums with the same zip name and files share a cache entry, and may be written at the same time
+    tmp_path = f"{archive_path}.{threading.get_ident()}.tmp"
+    with zipfile.ZipFile(tmp_path, "w", allowZip64=True) as archive:
+        for path in paths:
+            ext = os.path.splitext(path)[1].lower()
+            compression = (
+                zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            )
+            try:
+                archive.write(path, os.path.basename(path), compress_type=compression)
+            except OSError as e:
+                logger.warning("Failed to add %s to the ZIP: %s", path, e)
+    os.replace(tmp_path, archive_path)
+
+
+def link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def build_album_zip(album):
+    """Put the album's zip into its output directory, from the cache when its members are unchanged.
+
+    :return: the zip file name, or False when the album has no zip
+    """
+    name = zip_name(album)
+    if name is None:
+        return False
+    paths = member_paths(album)
+    key = cache_key(name, paths, album.settings["source"])
+    cached_path = os.path.join(ZIP_CACHE_DIR, key + ".zip")
+    _used_keys.add(key)
+    if os.path.isfile(cached_path):
+        metrics.count("zips.cached")
+    else:
+        logger.debug("Creating ZIP archive %s", cached_path)
+        write_zip(cached_path, paths)
+        metrics.count("zips.built")
+    link_or_copy(cached_path, os.path.join(album.dst_path, name))
+    return name
+
+
+def start_zips(gallery):
+    """Start making the zips of all albums of the build in the background, when their members already exist."""
+    global _executor
+    settings = gallery.settings
+    if not settings["zip_gallery"]:
+        return
+    os.makedirs(ZIP_CACHE_DIR, exist_ok=True)
+    if uses_sources(settings):
+        _source_digests.clear()
+        with refreshed_index(settings["source"]) as index:
+            for path, entry in index.entries(settings["source"]).items():
+                _source_digests[path] = entry.blake2b
+
+    _zips.clear()
+    _used_keys.clear()
+    if uses_sources(settings):
+        # sigal's own process pool already exists, so threads don't end up in forked workers
+        _executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        for album in gallery.albums.values():
+            if shards.in_build(settings, album):
+                _zips[album.path] = _executor.submit(build_album_zip, album)
+
+
+def album_zip(album):
+    """Album.zip, as the templates use it: the zip file name, or False."""
+    future = _zips.get(album.path)
+    if future is None:
+        return build_album_zip(album)
+    return future.result()
+
+
+def finish_zips(gallery):
+    """Wait for the zips no page asked for, then drop cached zips that no album uses anymore."""
+    global _executor
+    if _executor is None:
+        return
+    for future in _zips.values():
+        future.result()
+    _executor.shutdown()
+    _executor = None
+    if not shards.is_full_build(gallery.settings):
+        return
+
+    # every album had its zip made, so anything else in the cache is stale
+    for entry in os.scandir(ZIP_CACHE_DIR):
+        if os.path.splitext(entry.name)[0] not in _used_keys:
+            os.remove(entry.path)
+
+
+def register(settings):
+    # cached_property keeps the value under the function's name, it has to be the attribute's
+    album_zip.__name__ = "zip"
+    Album.zip = cached_property(album_zip)
+    signals.gallery_initialized.connect(start_zips)
+    signals.gallery_build.connect(finish_zips)
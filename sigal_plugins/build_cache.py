@@ -0,0 +1,262 @@
+"""Reuse resized images and thumbnails across builds and machines, keyed by what they're made from.
+
+Every processed image is kept in .cache/build-cache/ under a key made of the BLAKE2b of the source image, the
+settings that change the outputs (sizes, formats, quality, thumbnail options...), the image processor and the
+Pillow and sigal versions. An image whose key is already there is copied into _build instead of being decoded
+and resized again.
+
+The cache is shared through Digital Ocean Spaces when the DO_* variables are set, under the build_cache_prefix
+setting ("build-cache/" unless set):
+
+* once sigal has collected the albums, the outputs the build needs are downloaded from the Space, if they are
+  there and not in the local cache yet
+* after the build, the outputs this build made are uploaded
+
+So CI, which starts from an empty _build, only processes the images that were added or changed since any
+machine last built them. The Space is never pruned, the local cache keeps what the last full build used, shards
+of a build (see shards.py) only add to it.
+
+Works with sigal's own process_image and with fast_resize, whichever is in place when this plugin is registered,
+so list it after fast_resize. Failures of the Space are logged and the build goes on without it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from dotenv import load_dotenv
+from sigal import gallery, signals
+from sigal.settings import get_thumb
+
+# sigal takes plugin_paths off sys.path once the plugins are registered, so everything is imported here
+import clients
+import metrics
+import shards
+import transfer
+from album_index import CACHE_DIR, refreshed_index
+from digests import file_digest
+
+logger = logging.getLogger(__name__)
+
+BUILD_CACHE_DIR = os.path.join(CACHE_DIR, "build-cache")
+DEFAULT_PREFIX = "build-cache/"
+# bump to make every cached output stale, e.g. after a change to how they are made
+BUILD_CACHE_VERSION = "1"
+# settings that change the outputs of process_image, names of the outputs don't matter
+SETTINGS_KEYS = (
+    "img_processor",
+    "img_size",
+    "img_format",
+    "jpg_options",
+    "autorotate_images",
+    "copy_exif_data",
+    "use_orig",
+    "make_thumbs",
+    "thumb_size",
+    "thumb_fit",
+    "thumb_fit_centering",
+)
+
+_process_image = None
+# (cache key, output) in the Space, from the listing at the start of the build
+_remote = set()
+_used_keys = set()
+
+
+def settings_fingerprint(settings):
+    import PIL
+    import sigal
+
+    values = {key: settings[key] for key in SETTINGS_KEYS}
+    values["processor"] = f"{_process_image.__module__}.{_process_image.__name__}"
+    values["versions"] = [BUILD_CACHE_VERSION, PIL.__version__, sigal.__version__]
+    return json.dumps(values, sort_keys=True, default=list)
+
+
+def cache_key(digest, filename, settings):
+    """Key of the outputs of a source image, the extension is part of it as it decides the output format."""
+    ext = os.path.splitext(filename)[1].lower()
+    sha = hashlib.sha256(f"{settings_fingerprint(settings)}\n{digest}\n{ext}".encode())
+    return sha.hexdigest()
+
+
+def outputs(filename, settings):
+    """{output: path relative to the album's output directory} that process_image makes for an image.
+
+    Outputs that are copies of the source (use_orig, GIFs) aren't cached, they're cheap to make.
+    """
+    paths = {}
+    if not (settings["use_orig"] or filename.endswith(".gif")):
+        paths["image"] = filename
+    if settings["make_thumbs"]:
+        paths["thumbnail"] = get_thumb(settings, filename)
+    return paths
+
+
+def entry_path(key, output):
+    return os.path.join(BUILD_CACHE_DIR, key[:2], f"{key}-{output}")
+
+
+def remote_name(prefix, key, output):
+    return f"{prefix}{key[:2]}/{key}-{output}"
+
+
+def copy_atomic(src, dst):
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def cached_process_image(filepath, outpath, settings):
+    """Drop-in for sigal's process_image that copies the outputs from the build cache when it has them."""
+    from sigal import utils
+    from sigal.settings import Status
+
+    filename = os.path.basename(filepath)
+    key = cache_key(file_digest(filepath).blake2b, filename, settings)
+    paths = outputs(filename, settings)
+    entries = {output: entry_path(key, output) for output in paths}
+
+    if paths and all(os.path.isfile(entry) for entry in entries.values()):
+        logger.info("Copying %s from the build cache", filepath)
+        if "image" not in paths:
+            utils.copy(
+                filepath, os.path.join(outpath, filename), symlink=settings["orig_link"]
+            )
+        for output, relative_path in paths.items():
+            shutil.copyfile(entries[output], os.path.join(outpath, relative_path))
+        return Status.SUCCESS
+
+    status = _process_image(filepath, outpath, settings)
+    if status == Status.SUCCESS:
+        os.makedirs(os.path.dirname(entry_path(key, "")), exist_ok=True)
+        for output, relative_path in paths.items():
+            copy_atomic(os.path.join(outpath, relative_path), entries[output])
+    return status
+
+
+def remote_settings(settings):
+    """(S3 client, Space, prefix) of the shared cache, or None when there are no Spaces credentials."""
+    load_dotenv()
+    if not (
+        os.getenv("DO_SPACE")
+        and os.getenv("DO_ACCESS_KEY_ID")
+        and os.getenv("DO_SECRET_ACCESS_KEY")
+    ):
+        return None
+    client = clients.s3_client(
+        os.getenv("DO_ACCESS_KEY_ID"), os.getenv("DO_SECRET_ACCESS_KEY")
+    )
+    return (
+        client,
+        os.getenv("DO_SPACE"),
+        settings.get("build_cache_prefix", DEFAULT_PREFIX),
+    )
+
+
+def needed_entries(gallery_):
+    """{(cache key, output)} of every image of the albums the build processes."""
+    settings = gallery_.settings
+    source = settings["source"]
+    with refreshed_index(source) as index:
+        digests = {path: entry.blake2b for path, entry in index.entries(source).items()}
+
+    needed = set()
+    for album in gallery_.albums.values():
+        if not shards.in_build(settings, album):
+            continue
+        for media in album.medias:
+            if media.type != "image":
+                continue
+            relative_path = os.path.relpath(media.src_path, source).replace("\\", "/")
+            digest = digests.get(relative_path) or file_digest(media.src_path).blake2b
+            key = cache_key(digest, media.src_filename, settings)
+            _used_keys.add(key)
+            for output in outputs(media.src_filename, settings):
+                needed.add((key, output))
+    return needed
+
+
+def pull(gallery_):
+    """Download the outputs this build needs from the Space, the ones the local cache doesn't have."""
+    _remote.clear()
+    _used_keys.clear()
+    needed = needed_entries(gallery_)
+    try:
+        remote = remote_settings(gallery_.settings)
+        if remote is not None and needed:
+            with metrics.phase("downloading"):
+                transfer.run(download(needed, *remote))
+    except Exception as e:
+        logger.warning("Can't read the shared build cache: %s", e)
+
+
+async def download(needed, client, space, prefix):
+    async with transfer.S3Transfer(client, space) as s3_transfer:
+        for obj in await s3_transfer.list_objects(prefix):
+            name = obj["Key"][len(prefix) :]
+            key, _, output = name.rpartition("/")[2].partition("-")
+            _remote.add((key, output))
+        missing = [
+            (remote_name(prefix, key, output), entry_path(key, output))
+            for key, output in sorted(needed & _remote)
+            if not os.path.isfile(entry_path(key, output))
+        ]
+        if missing:
+            print(f"Downloading {len(missing)} processed images from the build cache")
+        return await transfer.gather_bounded(
+            missing, lambda pair: s3_transfer.download_file(*pair)
+        )
+
+
+def push(gallery_):
+    """Upload the outputs this build made to the Space, and drop local entries a full build didn't use."""
+    try:
+        made = prune_entries(gallery_.settings)
+        remote = remote_settings(gallery_.settings)
+        if remote is not None and made:
+            with metrics.phase("uploading"):
+                transfer.run(upload(made, *remote))
+    except Exception as e:
+        logger.warning("Can't update the shared build cache: %s", e)
+
+
+def prune_entries(settings):
+    """Drop local entries a full build didn't use.
+
+    :return: {(cache key, output)} of the local entries that aren't in the Space
+    """
+    # other shards may be using, or writing, the entries this one doesn't know
+    prune = shards.is_full_build(settings)
+    made = set()
+    if os.path.isdir(BUILD_CACHE_DIR):
+        for directory in os.scandir(BUILD_CACHE_DIR):
+            for entry in os.scandir(directory.path):
+                key, _, output = entry.name.partition("-")
+                if key not in _used_keys or output.endswith(".tmp"):
+                    if prune:
+                        os.remove(entry.path)
+                elif (key, output) not in _remote:
+                    made.add((key, output))
+    return made
+
+
+async def upload(made, client, space, prefix):
+    async with transfer.S3Transfer(client, space) as s3_transfer:
+        print(f"Uploading {len(made)} processed images to the build cache")
+        return await transfer.gather_bounded(
+            sorted(made),
+            lambda pair: s3_transfer.upload_file(
+                entry_path(*pair), remote_name(prefix, *pair)
+            ),
+        )
+
+
+def register(settings):
+    global _process_image
+    _process_image = gallery.process_image
+    gallery.process_image = cached_process_image
+    signals.gallery_initialized.connect(pull)
+    signals.gallery_build.connect(push)
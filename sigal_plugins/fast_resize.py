@@ -0,0 +1,217 @@
+"""Make every output of an image from one decode, shrinking by integer factors before the final resample.
+
+sigal's process_image decodes the source to resize it, then decodes the output again for the thumbnail, and
+every resize is a LANCZOS pass over the full resolution image. Here the source is decoded once (JPEGs at the
+smallest DCT scale that is still big enough), both outputs are made from it in memory, and each resize first
+shrinks the image with Image.reduce, a cheap box average by an integer factor, for as long as it stays at least
+REDUCING_GAP times the target size. Only the last step is a LANCZOS resample. From a gap of 3 the result
+can't be told apart from a full LANCZOS resize, `benchmarks/resize.py` checks it against sigal's own output.
+
+Image.resize (and so Image.thumbnail) ignores reducing_gap for RGBA images, which all our stains are, so sigal
+never gets the cheap reduction for them. Here the alpha is premultiplied first, the way Image.resize does it
+itself, and the premultiplied image is reduced.
+
+Only the default img_processor, ResizeToFit, is handled here, other processors go to sigal's process_image.
+
+The plugin swaps sigal.gallery.process_image when it is registered. Worker processes that are forked from the
+build (Linux) get the swap too. Spawned ones (Windows, macOS) import sigal again and fall back to sigal's
+process_image, which gives the same images, only slower.
+"""
+
+import logging
+import math
+import os
+
+from PIL import Image
+
+from sigal import gallery, signals, utils
+from sigal.image import _has_exif_tags, _read_image
+from sigal.image import process_image as sigal_process_image
+from sigal.settings import Status, get_thumb
+
+# local
+import metrics
+
+logger = logging.getLogger(__name__)
+
+REDUCING_GAP = 3.0
+JPEG_EXTENSIONS = (".jpg", ".jpeg", ".JPG", ".JPEG")
+PREMULTIPLIED_MODES = {"RGBA": "RGBa", "LA": "La"}
+
+
+def fit_size(size, box, upscale=False):
+    """Size that fits in box keeping the aspect ratio, like pilkit's ResizeToFit, or None to keep the image.
+
+    Like pilkit, an image that is larger than box in only one dimension is kept as it is.
+    """
+    width, height = size
+    ratio = min(box[0] / width, box[1] / height)
+    new_size = (int(round(width * ratio)), int(round(height * ratio)))
+    if upscale or (new_size[0] < width and new_size[1] < height):
+        return new_size
+    return None
+
+
+def thumbnail_size(size, box):
+    """Size Image.thumbnail would shrink an image to, or None if it already fits in box."""
+    x, y = math.floor(box[0]), math.floor(box[1])
+    width, height = size
+    if x >= width and y >= height:
+        return None
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def fit_crop(size, box, centering=(0.5, 0.5)):
+    """Part of an image that ImageOps.fit keeps to fill box, as a (left, top, right, bottom) box."""
+    width, height = size
+    output_ratio = box[0] / box[1]
+    if width / height >= output_ratio:
+        crop_width, crop_height = output_ratio * height, height
+    else:
+        crop_width, crop_height = width, width / output_ratio
+    left = (width - crop_width) * centering[0]
+    top = (height - crop_height) * centering[1]
+    return left, top, left + crop_width, top + crop_height
+
+
+def resize(img, size, box=None):
+    """LANCZOS resize of img (or of the box part of it), reducing by integer factors first."""
+    if img.mode == "P":
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+    premultiplied = PREMULTIPLIED_MODES.get(img.mode)
+    if premultiplied:
+        # Image.resize premultiplies the alpha of these itself, but then drops reducing_gap
+        resized = img.convert(premultiplied).resize(
+            size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP
+        )
+        return resized.convert(img.mode)
+    return img.resize(size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+
+
+def make_thumbnail(img, settings):
+    box = settings["thumb_size"]
+    if settings["thumb_fit"]:
+        crop = fit_crop(img.size, box, settings["thumb_fit_centering"])
+        return resize(img, box, crop)
+    size = thumbnail_size(img.size, box)
+    return resize(img, size) if size else img
+
+
+def draft_size(img, settings, use_orig):
+    """Smallest size the outputs can be made from without losing quality."""
+    sizes = []
+    if not use_orig:
+        width, height = settings["img_size"]
+        if img.size[0] < img.size[1]:
+            height, width = width, height
+        sizes.append((width, height))
+    if settings["make_thumbs"]:
+        sizes.append(settings["thumb_size"])
+    return tuple(int(max(size) * REDUCING_GAP) for size in zip(*sizes))
+
+
+def process_image(filepath, outpath, settings):
+    """Drop-in for sigal.image.process_image: resize and make the thumbnail from one decode."""
+    if settings["img_processor"] != "ResizeToFit":
+        with metrics.phase("resizing"):
+            return sigal_process_image(filepath, outpath, settings)
+
+    logger.info("Processing %s", filepath)
+    filename = os.path.split(filepath)[1]
+    outname = os.path.join(outpath, filename)
+    ext = os.path.splitext(filename)[1]
+
+    if ext in JPEG_EXTENSIONS:
+        options = settings["jpg_options"]
+    elif ext == ".png":
+        options = {"optimize": True}
+    else:
+        options = {}
+
+    try:
+        use_orig = settings["use_orig"] or filepath.endswith(".gif")
+        if use_orig:
+            utils.copy(filepath, outname, symlink=settings["orig_link"])
+            if not settings["make_thumbs"]:
+                return Status.SUCCESS
+
+        # a phase of its own for `run.py --profile-phase resizing`, which builds in this process
+        with metrics.phase("resizing"):
+            img = _read_image(filepath)
+            outformat = img.format
+            if ext in JPEG_EXTENSIONS and not settings["autorotate_images"]:
+                # rotating swaps the sizes, so only draft when the image stays as it is
+                img.draft(img.mode, draft_size(img, settings, use_orig))
+
+            if not use_orig:
+                img, outformat, options = resize_image(img, settings, options)
+                save_image(img, outname, outformat, options)
+
+            if settings["make_thumbs"]:
+                thumb_name = os.path.join(outpath, get_thumb(settings, filename))
+                save_image(
+                    make_thumbnail(img, settings), thumb_name, outformat, options
+                )
+    except Exception as e:
+        logger.info("Failed to process: %r", e)
+        if logger.getEffectiveLevel() == logging.DEBUG:
+            raise
+        else:
+            return Status.FAILURE
+
+    return Status.SUCCESS
+
+
+def resize_image(img, settings, options):
+    """What sigal's generate_image does between reading and saving the image.
+
+    :return: (resized image, output format, save options)
+    """
+    from pilkit.processors import Transpose
+
+    original_format = img.format
+    if settings["copy_exif_data"] and _has_exif_tags(img):
+        options = dict(options, exif=img.info["exif"])
+
+    if settings["autorotate_images"]:
+        try:
+            img = Transpose().process(img)
+        except (OSError, IndexError):
+            pass
+
+    width, height = settings["img_size"]
+    if img.size[0] < img.size[1]:
+        # swap target size if image is in portrait mode
+        height, width = width, height
+    size = fit_size(img.size, (width, height))
+    if size:
+        img = resize(img, size)
+
+    # plugins can replace the image, so they are called one by one like sigal does
+    for receiver in signals.img_resized.receivers_for(img):
+        img = receiver(img, settings=settings)
+
+    outformat = settings.get("img_format") or img.format or original_format or "JPEG"
+    return img, outformat, options
+
+
+def save_image(img, outname, outformat, options):
+    from pilkit.utils import save_image as pilkit_save_image
+
+    logger.debug("Save image to %s (%s)", outname, outformat)
+    pilkit_save_image(
+        img, outname, outformat or "JPEG", options=options, autoconvert=True
+    )
+
+
+def register(settings):
+    gallery.process_image = process_image
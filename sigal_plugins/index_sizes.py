@@ -0,0 +1,48 @@
+"""Give sigal the image sizes recorded in the album index.
+
+Sigal reads the size of every image when it picks album thumbnails, by opening the output image again. With
+`use_orig` the output is a copy of the source, so the PNG header dimensions in the album index are the same
+and no image needs to be opened for them.
+"""
+
+import logging
+import os
+
+from sigal import signals
+
+from album_index import refreshed_index
+
+logger = logging.getLogger(__name__)
+_sizes = {}
+
+
+def load_sizes(source):
+    with refreshed_index(source) as index:
+        for path, entry in index.entries(source, suffix=".png").items():
+            if entry.width is not None:
+                _sizes[path] = {"width": entry.width, "height": entry.height}
+    logger.debug("Loaded %d image sizes from the album index", len(_sizes))
+
+
+def set_size(media):
+    settings = media.settings
+    if media.type != "image" or not settings["use_orig"]:
+        return
+    if not _sizes:
+        load_sizes(settings["source"])
+
+    path = os.path.relpath(media.src_path, settings["source"]).replace("\\", "/")
+    size = _sizes.get(path)
+    if size is not None:
+        # Image.size is a cached_property, so setting the attribute skips reading the image
+        media.__dict__["size"] = size
+
+
+def clear_sizes(gallery):
+    # the next gallery built in this process, e.g. by `run.py watch`, reads the index again
+    _sizes.clear()
+
+
+def register(settings):
+    signals.media_initialized.connect(set_size)
+    signals.gallery_build.connect(clear_sizes)
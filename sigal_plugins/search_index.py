@@ -0,0 +1,172 @@
+"""Write a static search index of every stain, so the theme can find stains without loading album pages.
+
+The index is JSON in search/ at the top of the site:
+
+* index.json - the small manifest the page loads first: the themes and locations, the album directory of every
+  theme/location pair, the record fields, and the list of shards with the first and last location in each
+* <theme>-<n>.json - the records of one theme, sorted by location and filename, at most SHARD_SIZE per file
+
+A record is [location, filename, thumbnail, equivalents], the thumbnail relative to the album directory and the
+equivalents {theme: filename} of the same stain in the other themes, from the mapping store (or mapping.json
+when there's no store). Records are sorted and split the same way on every build, so the shards of unchanged
+themes come out byte for byte the same and a deploy leaves them alone.
+
+`my-sigal-theme/static/js/search.js` only fetches the shards a lookup needs, e.g. "bottom-right xgte" loads the
+xgte shards holding bottom-right.
+"""
+
+import json
+import logging
+import os
+
+from sigal import signals
+from sigal.utils import url_from_path
+
+from mapping_store import MAPPING_DB, MappingStore
+from shards import writes_site_files
+from stains import MAPPING_FILE, split_stain_path
+
+logger = logging.getLogger(__name__)
+
+SEARCH_DIR = "search"
+# bump when the layout of the files changes, search.js checks it
+SEARCH_INDEX_VERSION = 1
+SHARD_SIZE = 500
+FIELDS = ["location", "filename", "thumbnail", "equivalents"]
+
+
+def load_mapping(source):
+    """{location: [{theme: filename}, ...]}, from the mapping store if there is one, mapping.json otherwise."""
+    db_file = os.path.join(source, MAPPING_DB)
+    if os.path.exists(db_file):
+        with MappingStore(db_file) as store:
+            return store.to_dict()
+    mapping_file = os.path.join(source, MAPPING_FILE)
+    if os.path.exists(mapping_file):
+        with open(mapping_file, "r") as read_file:
+            return json.load(read_file)
+    return {}
+
+
+def equivalents_lookup(mapping, published):
+    """{(theme, location, filename): {other theme: filename}}, only counting stains that are in the gallery.
+
+    :param published: set of (theme, location, filename) in the gallery
+    """
+    lookup = {}
+    for location, equivalences in mapping.items():
+        for equivalence in equivalences:
+            stains = {
+                theme: filename
+                for theme, filename in equivalence.items()
+                if (theme, location, filename) in published
+            }
+            for theme, filename in stains.items():
+                lookup[theme, location, filename] = {
+                    other: other_filename
+                    for other, other_filename in sorted(stains.items())
+                    if other != theme
+                }
+    return lookup
+
+
+def collect_stains(gallery):
+    """({(theme, location): album directory URL}, [(theme, location, filename, thumbnail)])"""
+    albums = {}
+    stains = []
+    for album in gallery.albums.values():
+        path = album.path.replace("\\", "/")
+        for media in album.medias:
+            if media.type != "image":
+                continue
+            stain = split_stain_path(f"{path}/{media.filename}")
+            if stain is None:
+                continue
+            albums[stain] = url_from_path(album.path) + "/"
+            stains.append(stain + (media.filename, media.thumbnail))
+    return albums, stains
+
+
+def shard_records(records):
+    """Split sorted records into lists of at most SHARD_SIZE."""
+    return [
+        records[start : start + SHARD_SIZE]
+        for start in range(0, len(records), SHARD_SIZE)
+    ]
+
+
+def write_json(path, data):
+    """Write compact JSON, leaving the file alone when it wouldn't change."""
+    content = json.dumps(data, separators=(",", ":"), sort_keys=True)
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as read_file:
+            if read_file.read() == content:
+                return
+    with open(path, "w", encoding="utf-8") as write_file:
+        write_file.write(content)
+
+
+def build_search_index(gallery):
+    settings = gallery.settings
+    # a shard only has some of the stains, the merge writes the index
+    if not writes_site_files(settings):
+        return
+    albums, stains = collect_stains(gallery)
+    published = {(theme, location, filename) for theme, location, filename, _ in stains}
+    equivalents = equivalents_lookup(load_mapping(settings["source"]), published)
+
+    by_theme = {}
+    for theme, location, filename, thumbnail in sorted(stains):
+        by_theme.setdefault(theme, []).append(
+            [
+                location,
+                filename,
+                thumbnail,
+                equivalents.get((theme, location, filename), {}),
+            ]
+        )
+
+    search_dir = os.path.join(settings["destination"], SEARCH_DIR)
+    os.makedirs(search_dir, exist_ok=True)
+    shards = []
+    written = {"index.json"}
+    for theme, records in sorted(by_theme.items()):
+        for num, shard in enumerate(shard_records(records)):
+            name = f"{theme}-{num}.json"
+            write_json(os.path.join(search_dir, name), shard)
+            written.add(name)
+            shards.append(
+                {
+                    "theme": theme,
+                    "file": name,
+                    "first": shard[0][0],
+                    "last": shard[-1][0],
+                    "count": len(shard),
+                }
+            )
+
+    album_dirs = {}
+    for (theme, location), url in sorted(albums.items()):
+        album_dirs.setdefault(theme, {})[location] = url
+    write_json(
+        os.path.join(search_dir, "index.json"),
+        {
+            "version": SEARCH_INDEX_VERSION,
+            "fields": FIELDS,
+            "index": "index.html" if settings["index_in_url"] else "",
+            "themes": sorted(by_theme),
+            "locations": sorted({location for _, location in albums}),
+            "albums": album_dirs,
+            "shards": shards,
+        },
+    )
+
+    # shards of themes that went away or got smaller
+    for entry in os.scandir(search_dir):
+        if entry.name not in written:
+            os.remove(entry.path)
+    logger.info("Search index: %d stains in %d shards", len(stains), len(shards))
+
+
+def register(settings):
+    signals.gallery_build.connect(build_search_index)
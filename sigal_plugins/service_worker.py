@@ -0,0 +1,122 @@
+"""Put the theme's service worker at the top of the site, with the list of shell files it caches.
+
+A service worker only serves pages at or below its own URL, so `static/js/service-worker.js` can't be registered
+from where sigal copies the theme. It is written to sw.js at the top of the destination instead, after
+definitions of:
+
+* SHELL_FILES - every file of the theme in static/, as the service worker caches them on install
+* CACHE_VERSION - a hash of those files, so sw.js changes whenever the theme does, browsers install the new
+  service worker and it drops the old shell
+* MEDIA_VERSION - a hash of every image of the gallery (from the album index) and the settings that make the
+  resized images and thumbnails. The service worker serves them from its cache without asking the network, as
+  long as they were cached under the current MEDIA_VERSION. Others are checked with a conditional request, so
+  after a push only the images that changed are downloaded again
+* THUMB_DIR - the thumb_dir setting, thumbnails are kept apart from the images they lead to
+
+base.html registers sw.js.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from sigal import signals
+
+import shards
+from album_index import refreshed_index
+
+logger = logging.getLogger(__name__)
+
+SERVICE_WORKER = "sw.js"
+TEMPLATE = os.path.join("js", "service-worker.js")
+# the precompressed copies written by compress_assets are never asked for by URL
+SKIPPED_EXTENSIONS = (".gz", ".br", ".zst")
+# settings that change what the image and thumbnail URLs serve
+MEDIA_SETTINGS = (
+    "img_processor",
+    "img_size",
+    "img_format",
+    "jpg_options",
+    "autorotate_images",
+    "copy_exif_data",
+    "use_orig",
+    "thumb_size",
+    "thumb_fit",
+    "thumb_fit_centering",
+)
+
+
+def shell_files(static_dir):
+    """Sorted paths of the theme files, relative to static_dir's parent."""
+    paths = []
+    for directory, _, filenames in os.walk(static_dir):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if filename.endswith(SKIPPED_EXTENSIONS) or path.endswith(TEMPLATE):
+                continue
+            relative_path = os.path.relpath(path, os.path.dirname(static_dir))
+            paths.append(relative_path.replace("\\", "/"))
+    return sorted(paths)
+
+
+def media_version(gallery):
+    """Hash of the source of every media of the gallery and the settings that make their outputs."""
+    settings = gallery.settings
+    source = settings["source"]
+    with refreshed_index(source) as index:
+        entries = index.entries(source)
+    sha = hashlib.sha256(
+        json.dumps([settings[key] for key in MEDIA_SETTINGS], default=list).encode()
+    )
+    paths = sorted(
+        os.path.relpath(media.src_path, source).replace("\\", "/")
+        for album in gallery.albums.values()
+        for media in album.medias
+    )
+    for path in paths:
+        entry = entries.get(path)
+        sha.update(f"{path}\t{entry.blake2b if entry else ''}\n".encode())
+    return sha.hexdigest()[:12]
+
+
+def write_service_worker(gallery):
+    # written once, by the merge, rather than by every shard of a sharded build
+    if not shards.writes_site_files(gallery.settings):
+        return
+    destination = gallery.settings["destination"]
+    static_dir = os.path.join(destination, "static")
+    template = os.path.join(static_dir, TEMPLATE)
+    if not os.path.isfile(template):
+        logger.warning("%s is missing, the site has no service worker", template)
+        return
+
+    files = shell_files(static_dir)
+    sha = hashlib.sha256()
+    for path in files:
+        with open(os.path.join(destination, path), "rb") as read_file:
+            sha.update(f"{path}\n".encode())
+            sha.update(read_file.read())
+    with open(template, "r", encoding="utf-8") as read_file:
+        code = read_file.read()
+    header = (
+        "// Generated by sigal_plugins/service_worker.py from static/js/service-worker.js\n"
+        f"var CACHE_VERSION = {json.dumps(sha.hexdigest()[:12])};\n"
+        f"var MEDIA_VERSION = {json.dumps(media_version(gallery))};\n"
+        f"var SHELL_FILES = {json.dumps(files, indent=2)};\n"
+        f"var THUMB_DIR = {json.dumps(gallery.settings['thumb_dir'])};\n\n"
+    )
+    content = header + code
+
+    # leave it alone when nothing changed, so its mtime doesn't make a deploy upload it
+    path = os.path.join(destination, SERVICE_WORKER)
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as read_file:
+            if read_file.read() == content:
+                return
+    with open(path, "w", encoding="utf-8") as write_file:
+        write_file.write(content)
+
+
+def register(settings):
+    signals.gallery_build.connect(write_service_worker)
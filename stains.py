@@ -0,0 +1,123 @@
+# Shared layout of the stain collection: themes, locations and where their files live.
+# Keep this importable from Python 2 as well, so the GIMP plugin can use it.
+
+import errno
+import os
+
+LOCATION_LOOKUP = {
+    0: ["top-left", "Top-left"],
+    1: ["top", "Top"],
+    2: ["top-right", "Top-right"],
+    3: ["top-and-bottom", "Top & Bottom"],
+    4: ["left", "Left"],
+    5: ["left-and-right", "Left & Right"],
+    6: ["right", "Right"],
+    7: ["bottom-left", "Bottom-left"],
+    8: ["bottom", "Bottom"],
+    9: ["bottom-right", "Bottom-right"],
+    10: ["center-horizontal", "Center-horizontal"],
+    11: ["center-vertical", "Center-vertical"],
+}
+THEME_LIST = [
+    ["phb", "Player's Handbook"],
+    ["dmg", "Dungeon Master's Guide"],
+    ["mm", "Monster Manual"],
+    ["genesys", "Genesys"],
+    ["ee", "Elemental Evil"],
+    ["sword_meow", "/u/swordmeow"],
+    ["xgte", "Xanathar's Guide to Everything"],
+    ["ice", "Generic Ice 1"],
+    ["ice2", "Generic Ice 2"],
+]
+LOCATION_SLUGS = [LOCATION_LOOKUP[key][0] for key in sorted(LOCATION_LOOKUP)]
+THEME_SLUGS = [theme[0] for theme in THEME_LIST]
+
+# these live inside albums/ so they get backed up with everything else,
+# but sigal.conf.py ignores them so they never show up on the website
+MASKS_DIR = "_masks"
+TEXTURES_DIR = "_textures"
+MAPPING_FILE = "mapping.json"
+AUTHOR = "Jared Ondricek (/u/flamableconcrete)"
+
+
+def mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
+
+def theme_album(albums_dir, theme_slug):
+    return os.path.join(albums_dir, theme_slug)
+
+
+def location_album(albums_dir, theme_slug, location_slug):
+    """Album of one theme/location pair, e.g. albums/dmg/dmg_bottom"""
+    return os.path.join(
+        albums_dir, theme_slug, "{}_{}".format(theme_slug, location_slug)
+    )
+
+
+def texture_path(albums_dir, theme_slug):
+    """Full page background of a theme, exported once from its GIMP layer."""
+    return os.path.join(albums_dir, TEXTURES_DIR, "{}.png".format(theme_slug))
+
+
+def mask_path(albums_dir, location_slug, mask_id):
+    """Saved mask, named like the layers in the GIMP `backup_mask` groups."""
+    return os.path.join(
+        albums_dir,
+        MASKS_DIR,
+        location_slug,
+        "{}_{:0>4}.png".format(location_slug, mask_id),
+    )
+
+
+def parse_mask_name(filename):
+    """Split a mask filename such as `bottom-right_0003.png` into its location and id."""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    location_slug, _, mask_id = stem.rpartition("_")
+    if location_slug not in LOCATION_SLUGS or not mask_id.isdigit():
+        raise ValueError("Not a mask filename: {}".format(filename))
+    return location_slug, int(mask_id)
+
+
+def split_stain_path(path):
+    """Theme and location of a stain from its path in albums/, e.g. dmg/dmg_bottom/0001.png -> (dmg, bottom).
+
+    :return: (theme, location), or None for anything that isn't a stain
+    """
+    parts = path.split("/")
+    if len(parts) != 3 or parts[0] in (MASKS_DIR, TEXTURES_DIR, "templates"):
+        return None
+    theme, album, _ = parts
+    location = album[len(theme) + 1 :] if album.startswith(theme + "_") else album
+    return theme, location
+
+
+def create_theme_dirs_if_needed(albums_dir, themes=None):
+    for theme_slug, theme_name in THEME_LIST:
+        if themes is not None and theme_slug not in themes:
+            continue
+        album = theme_album(albums_dir, theme_slug)
+        mkdir_p(album)
+
+        index_file = os.path.join(album, "index.md")
+        file_contents = "Title: {} Stains\nAuthor: {}\n\n## About\n\nThese images are based on the {} theme.".format(
+            theme_name, AUTHOR, theme_name
+        )
+        with open(index_file, "w") as file_:
+            file_.write(file_contents)
+
+        for key in sorted(LOCATION_LOOKUP):
+            location_slug, album_title = LOCATION_LOOKUP[key]
+            album = location_album(albums_dir, theme_slug, location_slug)
+            mkdir_p(album)
+
+            index_file = os.path.join(album, "index.md")
+            file_contents = "Title: {}\nAuthor: {}".format(album_title, AUTHOR)
+            with open(index_file, "w") as file_:
+                file_.write(file_contents)
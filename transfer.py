@@ -0,0 +1,777 @@
+"""asyncio transfer core for Azure Blob Storage and Digital Ocean Spaces.
+
+Listing, upload, download, copy and delete all go through here, with many requests in flight on one thread.
+How many run at once is adapted to throttling, and transient failures are retried, see `retry.py`. The
+synchronous helpers in `utils.py` and `DirectoryClient.py` are thin wrappers that run these coroutines with
+`run()`. They all run in one event loop per thread, kept open until the process exits, so the async Azure client
+made by the first transfer of a command, and its connections, serve every later one (see `clients.py`).
+
+Azure uses the SDK's native async client (`azure.storage.blob.aio`). There is no async boto3 that works with
+the boto3 we pin, so S3 calls run on the shared, thread safe client from `clients.py` in a thread pool that is
+as big as the highest concurrency.
+
+The highest number of concurrent requests defaults to 32 and can be set with TRANSFER_CONCURRENCY.
+
+Azure listings come a page at a time (`AzureTransfer.list_pages`). Deleting a prefix, downloading one and
+backing up a container start on each page as soon as it is listed, and `iterate()` hands the pages to
+synchronous code as they arrive, e.g. `DirectoryClient.iter_file_pages`.
+
+`AzureTransfer.mirror_from_s3` copies a Space into a container without going through the local disk: Azure
+copies each object itself from a presigned URL, and objects it can't fetch are streamed through this process a
+block at a time.
+"""
+
+import asyncio
+import atexit
+import hashlib
+import os
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# local
+import clients
+import manifest
+import metrics
+from retry import AIMDController, error_code, is_transient, status_code
+
+DEFAULT_CONCURRENCY = 32
+S3_DELETE_BATCH = 1000
+# boto3 switches to multipart uploads from here, with its own threads and error wrapping
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+# presigned URLs have to stay valid until Azure has finished copying from them
+PRESIGNED_URL_EXPIRY = 6 * 60 * 60
+# Azure only copies synchronously up to 256 MiB, bigger copies are polled until they're done
+SYNC_COPY_LIMIT = 256 * 1024 * 1024
+COPY_POLL_INTERVAL = 2
+# a relay holds one block in memory, so a mirror never holds more than RELAY_BLOCK_SIZE * RELAY_CONCURRENCY
+RELAY_BLOCK_SIZE = 4 * 1024 * 1024
+RELAY_CONCURRENCY = 8
+# blob metadata holding the ETag of the object a blob was mirrored from
+SOURCE_ETAG = "source_etag"
+
+
+_local = threading.local()
+
+
+def event_loop():
+    """The event loop transfers run in on this thread, made on first use and closed when the process exits."""
+    loop = getattr(_local, "loop", None)
+    if loop is None:
+        loop = _local.loop = asyncio.new_event_loop()
+        atexit.register(close_loop, loop)
+    return loop
+
+
+def close_loop(loop):
+    loop.run_until_complete(clients.close_aio_clients(loop))
+    # async generators left suspended, e.g. listings that were stopped early
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
+
+
+def run(coro):
+    """Run a transfer coroutine from synchronous code."""
+    return event_loop().run_until_complete(coro)
+
+
+def default_concurrency():
+    return int(os.getenv("TRANSFER_CONCURRENCY") or DEFAULT_CONCURRENCY)
+
+
+def walk_files(local_directory):
+    """Yield (local path, relative path with "/" separators) of every file in a directory."""
+    for root, dirs, files in os.walk(local_directory):
+        for filename in files:
+            local_path = os.path.join(root, filename)
+            relative_path = os.path.relpath(local_path, local_directory)
+            yield local_path, relative_path.replace("\\", "/")
+
+
+async def gather_bounded(items, func):
+    """Await func(item) for every item, and return [(item, exception), ...] for the ones that failed.
+
+    One failure doesn't stop the others. Concurrency is bounded by the controller inside func.
+    """
+    failures = []
+
+    async def one(item):
+        try:
+            await func(item)
+        except Exception as ex:
+            print(f"Failed:\t{item}\t{ex}")
+            metrics.count("objects.failed")
+            failures.append((item, ex))
+
+    await asyncio.gather(*(one(item) for item in items))
+    return failures
+
+
+async def gather_pages(pages, func):
+    """Await func(page) for every page of a listing, starting each one as soon as its page arrives.
+
+    The next page is listed while the previous ones are worked on.
+
+    :param pages: async iterator of lists, e.g. AzureTransfer.list_pages()
+    :param func: coroutine function returning a list of failures, like gather_bounded
+    :return: the failures of all pages
+    """
+    tasks = []
+    try:
+        async for page in pages:
+            tasks.append(asyncio.ensure_future(func(page)))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    failures = []
+    for page_failures in await asyncio.gather(*tasks):
+        failures.extend(page_failures)
+    return failures
+
+
+def iterate(agen):
+    """Yield the items of an async generator from synchronous code, running it one item at a time."""
+    loop = event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(agen.aclose())
+
+
+def is_directory(item):
+    """Whether an item of a delimited listing is a directory (BlobPrefix) rather than a blob."""
+    from azure.storage.blob import BlobProperties
+
+    return not isinstance(item, BlobProperties)
+
+
+class AzureTransfer:
+    """Transfers to and from one Azure Blob Storage container.
+
+    Use as `async with AzureTransfer(connection_string, container) as transfer: ...`
+    """
+
+    def __init__(self, connection_string, container, concurrency=None):
+        self.connection_string = connection_string
+        self.container = container
+        self.concurrency = concurrency or default_concurrency()
+
+    async def __aenter__(self):
+        # shared by every transfer in this event loop, and closed with it
+        self.service_client = clients.azure_aio_service_client(self.connection_string)
+        self.client = self.service_client.get_container_client(self.container)
+        self.controller = AIMDController(self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    @property
+    def url(self):
+        return self.client.url
+
+    async def list_pages(self, prefix="", include=None, delimiter=None):
+        """Yield the blobs whose name starts with prefix a page at a time, as the listing returns them.
+
+        :param include: extra details to list, e.g. ["metadata"]
+        :param delimiter: list one level only, e.g. "/". The directories below it are listed as well, as
+            BlobPrefix items whose name ends with the delimiter, see is_directory()
+        """
+        continuation_token = None
+        while True:
+
+            async def list_page():
+                if delimiter:
+                    items = self.client.walk_blobs(
+                        name_starts_with=prefix or None,
+                        include=include,
+                        delimiter=delimiter,
+                    )
+                else:
+                    items = self.client.list_blobs(
+                        name_starts_with=prefix or None, include=include
+                    )
+                pages = items.by_page(continuation_token=continuation_token)
+                page = await pages.__anext__()
+                return [blob async for blob in page], pages.continuation_token
+
+            blobs, continuation_token = await self.controller.call(
+                list_page, "azure.list"
+            )
+            metrics.count("pages.listed")
+            yield blobs
+            if not continuation_token:
+                return
+
+    async def list_blobs(self, prefix="", include=None):
+        """Yield the properties of every blob whose name starts with prefix.
+
+        :param include: extra details to list, e.g. ["metadata"]
+        """
+        async for page in self.list_pages(prefix, include):
+            for blob in page:
+                yield blob
+
+    async def list_properties(self, prefix="", include=None):
+        """Properties (name, size, content settings with Content-MD5...) of every blob under prefix."""
+        with metrics.phase("listing"):
+            return [blob async for blob in self.list_blobs(prefix, include)]
+
+    async def list_names(self, prefix=""):
+        return [blob.name for blob in await self.list_properties(prefix)]
+
+    async def upload_file(
+        self, local_path, blob_name, content_type=None, overwrite=False
+    ):
+        from azure.storage.blob import ContentSettings
+
+        content_settings = ContentSettings(content_type=content_type)
+
+        async def upload():
+            with open(local_path, "rb") as data:
+                await self.client.upload_blob(
+                    name=blob_name,
+                    data=data,
+                    content_settings=content_settings,
+                    overwrite=overwrite,
+                )
+
+        print(f"Uploading:\t{blob_name}")
+        await self.controller.call(upload, "azure.upload")
+        metrics.count("objects.uploaded")
+        metrics.count("bytes.uploaded", os.path.getsize(local_path))
+
+    async def upload_dir(
+        self, local_directory, prefix="", content_type_for=None, overwrite=False
+    ):
+        """Upload every file in a directory, keeping its layout under prefix.
+
+        :param content_type_for: function from a local path to its content type
+        :return: list of (local path, exception) for the files that failed
+        """
+
+        relative_paths = [path for _, path in walk_files(local_directory)]
+        failures = await self.upload_files(
+            local_directory, relative_paths, prefix, content_type_for, overwrite
+        )
+        return [(os.path.join(local_directory, path), ex) for path, ex in failures]
+
+    async def upload_files(
+        self,
+        local_directory,
+        relative_paths,
+        prefix="",
+        content_type_for=None,
+        overwrite=False,
+    ):
+        """Upload some files of a directory, keeping their layout under prefix.
+
+        :param relative_paths: paths of the files in local_directory, with "/" separators
+        :param content_type_for: function from a local path to its content type
+        :return: list of (relative path, exception) for the files that failed
+        """
+
+        async def upload(relative_path):
+            local_path = os.path.join(local_directory, relative_path)
+            blob_name = posixpath.join(prefix, relative_path)
+            content_type = content_type_for(local_path) if content_type_for else None
+            await self.upload_file(local_path, blob_name, content_type, overwrite)
+
+        return await gather_bounded(relative_paths, upload)
+
+    async def download_file(self, blob_name, local_path):
+        async def download():
+            downloader = await self.client.download_blob(blob_name)
+            with open(local_path, "wb") as file:
+                await downloader.readinto(file)
+
+        print(f"Downloading {blob_name} to {local_path}")
+        os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        await self.controller.call(download, "azure.download")
+        metrics.count("objects.downloaded")
+        metrics.count("bytes.downloaded", os.path.getsize(local_path))
+
+    async def download_files(self, pairs):
+        """Download many blobs.
+
+        :param pairs: list of (blob name, local path)
+        :return: list of ((blob name, local path), exception) for the ones that failed
+        """
+        return await gather_bounded(pairs, lambda pair: self.download_file(*pair))
+
+    async def download_prefix(self, prefix, local_directory):
+        """Download every blob under prefix into local_directory, keeping their paths below prefix.
+
+        Every page of the listing is downloaded as soon as it arrives, while the next one is listed.
+
+        :return: the failures, like download_files, or None if there are no blobs under prefix
+        """
+        listed = False
+
+        async def download_page(page):
+            nonlocal listed
+            listed = listed or bool(page)
+            pairs = [
+                (blob.name, os.path.join(local_directory, blob.name[len(prefix) :]))
+                for blob in page
+            ]
+            return await self.download_files(pairs)
+
+        failures = await gather_pages(self.list_pages(prefix), download_page)
+        return failures if listed else None
+
+    async def copy_from_url(self, source_url, blob_name):
+        """Start a server side copy of source_url into this container."""
+        print(f"Start copying: {source_url}")
+        blob_client = self.client.get_blob_client(blob_name)
+        await self.controller.call(
+            lambda: blob_client.start_copy_from_url(source_url), "azure.copy"
+        )
+        metrics.count("objects.copied")
+
+    async def copy_blobs(self, source_container_url, names):
+        """Server side copy of blobs from another container, keeping their names."""
+
+        async def copy(name):
+            await self.copy_from_url(f"{source_container_url}/{name}", name)
+
+        return await gather_bounded(names, copy)
+
+    async def copy_container(self, source):
+        """Server side copy of every blob of another container, starting on each page as it is listed.
+
+        :param source: AzureTransfer of the other container
+        """
+
+        async def copy_page(page):
+            return await self.copy_blobs(source.url, [blob.name for blob in page])
+
+        return await gather_pages(source.list_pages(), copy_page)
+
+    async def copy_and_wait(self, source_url, blob_name, size, metadata=None):
+        """Server side copy of source_url into a blob, waiting until Azure has finished it.
+
+        :param size: size of the source, to choose between a synchronous and a polled copy
+        :raise RuntimeError: when the copy failed or was aborted
+        """
+        blob_client = self.client.get_blob_client(blob_name)
+        result = await self.controller.call(
+            lambda: blob_client.start_copy_from_url(
+                source_url, metadata=metadata, requires_sync=size <= SYNC_COPY_LIMIT
+            ),
+            "azure.copy",
+        )
+        status = result["copy_status"]
+        while status == "pending":
+            await asyncio.sleep(COPY_POLL_INTERVAL)
+            properties = await self.controller.call(
+                blob_client.get_blob_properties, "azure.properties"
+            )
+            status = properties.copy.status
+        if status != "success":
+            raise RuntimeError(f"Copy of {blob_name} ended with status {status}")
+
+    async def relay_from_s3(self, s3_transfer, key, blob_name, metadata=None):
+        """Stream an object from S3 into a blob a block at a time, without touching the disk.
+
+        The Content-MD5 is computed on the way through and set on the blob, as a normal upload would.
+        """
+        from azure.storage.blob import BlobBlock, ContentSettings
+
+        blob_client = self.client.get_blob_client(blob_name)
+        response = await s3_transfer.get_object(key)
+        body = response["Body"]
+        md5 = hashlib.md5()
+        blocks = []
+        size = 0
+        try:
+            while True:
+                data = await s3_transfer.read(body, RELAY_BLOCK_SIZE)
+                if not data:
+                    break
+                md5.update(data)
+                size += len(data)
+                # block ids must all have the same length, the SDK base64 encodes them
+                block_id = f"{len(blocks):08d}"
+                await self.controller.call(
+                    lambda: blob_client.stage_block(block_id, data, len(data)),
+                    "azure.stage_block",
+                )
+                blocks.append(BlobBlock(block_id))
+        finally:
+            body.close()
+
+        content_settings = ContentSettings(
+            content_type=response.get("ContentType"),
+            content_md5=bytearray(md5.digest()),
+        )
+        await self.controller.call(
+            lambda: blob_client.commit_block_list(
+                blocks, content_settings=content_settings, metadata=metadata
+            ),
+            "azure.commit",
+        )
+        metrics.count("bytes.relayed", size)
+
+    async def mirror_from_s3(
+        self, s3_transfer, prefix="", dest_prefix="", server_copy=True
+    ):
+        """Copy every object under prefix in S3 into this container, under dest_prefix.
+
+        Each blob remembers the ETag of its object in its metadata, and objects whose ETag hasn't changed since
+        are skipped. Blobs of objects that are gone from S3 are kept.
+
+        Azure copies objects itself from a presigned URL. When it can't reach the source, e.g. a private
+        endpoint, or server_copy is False, the objects are relayed through this process instead.
+
+        :return: list of (key, exception) for the objects that failed
+        """
+        objects = [
+            obj
+            for obj in await s3_transfer.list_objects(prefix)
+            if not obj["Key"].endswith("/")
+        ]
+        blobs = await self.list_properties(dest_prefix, include=["metadata"])
+        mirrored_etags = {
+            blob.name: (blob.metadata or {}).get(SOURCE_ETAG) for blob in blobs
+        }
+        relays = asyncio.Semaphore(RELAY_CONCURRENCY)
+        # a source Azure can't fetch from fails the same way for every object, so stop trying after the first
+        state = {"server_copy": server_copy}
+
+        async def mirror(obj):
+            key = obj["Key"]
+            etag = obj["ETag"].strip('"')
+            blob_name = dest_prefix + key[len(prefix) :]
+            if mirrored_etags.get(blob_name) == etag:
+                metrics.count("objects.skipped")
+                return
+            metadata = {SOURCE_ETAG: etag}
+            if state["server_copy"]:
+                print(f"Copying:\t{key}")
+                try:
+                    await self.copy_and_wait(
+                        s3_transfer.presigned_url(key), blob_name, obj["Size"], metadata
+                    )
+                    metrics.count("objects.copied")
+                    metrics.count("bytes.copied", obj["Size"])
+                    return
+                except Exception as ex:
+                    if error_code(ex) == "CannotVerifyCopySource":
+                        state["server_copy"] = False
+                    print(f"Server side copy of {key} failed, relaying: {ex}")
+            async with relays:
+                print(f"Relaying:\t{key}")
+                await self.relay_from_s3(s3_transfer, key, blob_name, metadata)
+            metrics.count("objects.relayed")
+
+        return await gather_bounded(objects, mirror)
+
+    async def read_manifest(self):
+        """The container's manifest, see manifest.py.
+
+        :return: ({path: (size, md5, content type)}, ETag), or (None, None) when there is none
+        """
+        from azure.core.exceptions import ResourceNotFoundError
+
+        async def download():
+            downloader = await self.client.download_blob(manifest.MANIFEST_NAME)
+            return await downloader.readall(), downloader.properties.etag
+
+        try:
+            content, etag = await self.controller.call(download, "azure.download")
+        except ResourceNotFoundError:
+            return None, None
+        return manifest.loads(content), etag
+
+    async def write_manifest(self, files, etag=None):
+        """Replace the container's manifest, only if it is still the one with etag (or there's none if etag is None).
+
+        :return: the ETag of the new manifest, or None when another run wrote it in the meantime
+        """
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+        from azure.storage.blob import ContentSettings
+
+        condition = MatchConditions.IfNotModified if etag else MatchConditions.IfMissing
+        try:
+            response = await self.controller.call(
+                lambda: self.client.upload_blob(
+                    name=manifest.MANIFEST_NAME,
+                    data=manifest.dumps(files).encode(),
+                    content_settings=ContentSettings(content_type="application/json"),
+                    overwrite=True,
+                    etag=etag,
+                    match_condition=condition,
+                ),
+                "azure.upload",
+            )
+        except (ResourceExistsError, ResourceModifiedError):
+            return None
+        return response["etag"]
+
+    async def remote_files(self, full_listing=False):
+        """What is in the container, from its manifest when it can be trusted, from a listing otherwise.
+
+        :param full_listing: always list the container
+        :return: ({path: (size, md5, content type)}, ETag of the manifest or None)
+        """
+        files, etag = await self.read_manifest()
+        if (
+            files is not None
+            and not full_listing
+            and etag == manifest.known_etag(self.url)
+        ):
+            print(f"Using the manifest of {self.container}")
+            return files, etag
+
+        if files is None:
+            print(f"No manifest in {self.container}, listing it")
+        elif not full_listing:
+            print(f"The manifest of {self.container} was changed elsewhere, listing it")
+        return manifest.blob_files(await self.list_properties()), etag
+
+    async def save_manifest(self, files, etag):
+        """Write the manifest and remember its ETag, or forget it when another run got there first."""
+        new_etag = await self.write_manifest(files, etag)
+        if new_etag is None:
+            print(
+                f"The manifest of {self.container} was replaced during this run,"
+                " the next run will list the container"
+            )
+        manifest.remember_etag(self.url, new_etag)
+        return new_etag
+
+    async def delete_blob(self, blob_name):
+        print(f"Deleting:\t{blob_name}")
+        await self.controller.call(
+            lambda: self.client.delete_blob(blob_name), "azure.delete"
+        )
+        metrics.count("objects.deleted")
+
+    async def delete_blobs(self, names):
+        return await gather_bounded(names, self.delete_blob)
+
+    async def delete_prefix(self, prefix=""):
+        """Delete every blob whose name starts with prefix, starting on each page as it is listed."""
+
+        async def delete_page(page):
+            if page:
+                print(f"Deleting {len(page)} files")
+            return await self.delete_blobs([blob.name for blob in page])
+
+        return await gather_pages(self.list_pages(prefix), delete_page)
+
+
+class KeyDeleteError(Exception):
+    """One key of an S3 batch delete that failed, although the delete_objects request itself succeeded."""
+
+    def __init__(self, error):
+        super().__init__(f"{error.get('Code')}: {error.get('Message')}")
+        self.key = error.get("Key")
+        # what retry.py looks at to tell throttling and transient errors apart
+        self.error_code = error.get("Code")
+
+
+class S3Transfer:
+    """Transfers to and from one S3 (Digital Ocean Spaces) bucket.
+
+    Use as `async with S3Transfer(client, bucket) as transfer: ...`
+    """
+
+    def __init__(self, client, bucket, concurrency=None):
+        self.client = client
+        self.bucket = bucket
+        self.concurrency = concurrency or default_concurrency()
+
+    async def __aenter__(self):
+        self.controller = AIMDController(self.concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(wait=True)
+
+    async def _call(self, stage, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await self.controller.call(
+            lambda: loop.run_in_executor(self.executor, partial(func, *args, **kwargs)),
+            stage,
+        )
+
+    async def list_objects(self, prefix=""):
+        """All objects whose key starts with prefix, as the dicts list_objects_v2 returns."""
+        objects = []
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        with metrics.phase("listing"):
+            while True:
+                results = await self._call(
+                    "s3.list", self.client.list_objects_v2, **kwargs
+                )
+                objects.extend(results.get("Contents", []))
+                if not results.get("IsTruncated"):
+                    return objects
+                kwargs["ContinuationToken"] = results["NextContinuationToken"]
+
+    async def exists(self, key):
+        """Whether an object exists. Errors other than 404 are raised, not taken as "missing"."""
+        try:
+            await self._call(
+                "s3.head", self.client.head_object, Bucket=self.bucket, Key=key
+            )
+            return True
+        except Exception as ex:
+            if status_code(ex) == 404:
+                return False
+            raise
+
+    def presigned_url(self, key, expires_in=PRESIGNED_URL_EXPIRY):
+        """A URL anyone can GET the object from until it expires. Signing happens locally, without a request."""
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=expires_in,
+        )
+
+    async def get_object(self, key):
+        """The get_object response, with the unread body as a stream, see read()."""
+        return await self._call(
+            "s3.get", self.client.get_object, Bucket=self.bucket, Key=key
+        )
+
+    async def read(self, body, size):
+        """Read up to size bytes from a response body on the thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, body.read, size)
+
+    def _put_file(self, local_path, key, extra_args):
+        with open(local_path, "rb") as data:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data, **extra_args)
+
+    async def upload_file(self, local_path, key, extra_args=None):
+        print(f"Uploading {key}...")
+        if os.path.getsize(local_path) < S3_MULTIPART_THRESHOLD:
+            # a plain PUT, so throttling reaches the controller as a ClientError
+            await self._call(
+                "s3.upload", self._put_file, local_path, key, extra_args or {}
+            )
+        else:
+            await self._call(
+                "s3.upload",
+                self.client.upload_file,
+                local_path,
+                self.bucket,
+                key,
+                ExtraArgs=extra_args,
+            )
+        metrics.count("objects.uploaded")
+        metrics.count("bytes.uploaded", os.path.getsize(local_path))
+
+    async def upload_dir(
+        self, local_directory, prefix="", content_type_for=None, skip_existing=True
+    ):
+        """Upload every file in a directory as public-read objects under prefix.
+
+        :param content_type_for: function from a local path to its content type
+        :param skip_existing: don't upload files whose key already exists
+        :return: list of (local path, exception) for the files that failed
+        """
+
+        async def upload(local_path):
+            relative_path = os.path.relpath(local_path, local_directory)
+            key = posixpath.join(prefix, relative_path.replace("\\", "/"))
+            if skip_existing and await self.exists(key):
+                print(f"Path found on S3! Skipping {key}...")
+                metrics.count("objects.skipped")
+                return
+            extra_args = {"ACL": "public-read"}
+            if content_type_for:
+                extra_args["ContentType"] = content_type_for(local_path)
+            await self.upload_file(local_path, key, extra_args)
+
+        local_paths = [local_path for local_path, _ in walk_files(local_directory)]
+        return await gather_bounded(local_paths, upload)
+
+    async def download_file(self, key, local_path):
+        print(f"Downloading: {key}")
+        os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        await self._call(
+            "s3.download", self.client.download_file, self.bucket, key, local_path
+        )
+        metrics.count("objects.downloaded")
+        metrics.count("bytes.downloaded", os.path.getsize(local_path))
+
+    async def download_prefix(self, prefix, local_directory):
+        """Download every object under prefix into local_directory, keeping the full keys as paths."""
+        objects = await self.list_objects(prefix)
+        pairs = [
+            (obj["Key"], os.path.join(local_directory, obj["Key"]))
+            for obj in objects
+            if not obj["Key"].endswith("/")
+        ]
+        return await gather_bounded(pairs, lambda pair: self.download_file(*pair))
+
+    async def delete_keys(self, keys):
+        """Delete objects, S3_DELETE_BATCH keys per request.
+
+        delete_objects succeeds even when some of its keys fail, each with an error code of its own. The keys
+        that failed with a throttle or a transient error are deleted again through the controller, like a
+        failed request would be, the others fail straight away.
+
+        :return: [(key, exception), ...] of the keys that weren't deleted
+        """
+        loop = asyncio.get_running_loop()
+        batches = [
+            keys[i : i + S3_DELETE_BATCH] for i in range(0, len(keys), S3_DELETE_BATCH)
+        ]
+        failures = []
+
+        def failed(key, ex):
+            print(f"Failed:\t{key}\t{ex}")
+            metrics.count("objects.failed")
+            failures.append((key, ex))
+
+        async def delete(batch):
+            print(f"Deleting {len(batch)} objects")
+            pending = list(batch)
+
+            async def delete_pending():
+                response = await loop.run_in_executor(
+                    self.executor,
+                    partial(
+                        self.client.delete_objects,
+                        Bucket=self.bucket,
+                        Delete={"Objects": [{"Key": key} for key in pending]},
+                    ),
+                )
+                metrics.count("objects.deleted", len(response.get("Deleted", [])))
+                errors = [
+                    KeyDeleteError(error) for error in response.get("Errors", [])
+                ]
+                retries = [ex for ex in errors if is_transient(ex)]
+                for ex in errors:
+                    if ex not in retries:
+                        failed(ex.key, ex)
+                pending[:] = [ex.key for ex in retries]
+                if retries:
+                    # the controller backs off (and slows down on SlowDown) before deleting these again
+                    raise retries[0]
+
+            try:
+                await self.controller.call(delete_pending, "s3.delete")
+            except Exception as ex:
+                for key in pending:
+                    failed(key, ex)
+
+        await asyncio.gather(*(delete(batch) for batch in batches))
+        return failures
+
+    async def delete_prefix(self, prefix):
+        objects = await self.list_objects(prefix)
+        return await self.delete_keys([obj["Key"] for obj in objects])
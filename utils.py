@@ -5,13 +5,14 @@ import zipfile
 from pathlib import Path
 
 # third party
-import boto3
-from azure.storage.blob import BlobServiceClient, ContentSettings
-from boto3 import Session
+# boto3 and the Azure SDK take a while to import, clients.py imports them when a client is first needed
 from dotenv import load_dotenv
 
 # local
-from DirectoryClient import DirectoryClient
+import clients
+import manifest
+import metrics
+import transfer
 
 load_dotenv()
 DO_SPACE = os.getenv("DO_SPACE")
@@ -24,7 +25,7 @@ AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 def azure_get_blob_service_client():
     blob_service_client = None
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(
+        blob_service_client = clients.azure_service_client(
             AZURE_STORAGE_CONNECTION_STRING
         )
     except Exception as ex:
@@ -32,23 +33,41 @@ def azure_get_blob_service_client():
     return blob_service_client
 
 
-def azure_backup_container(src_container, dest_container):
-    blob_service_client = azure_get_blob_service_client()
+def do_get_client():
+    return clients.s3_client(DO_ACCESS_KEY_ID, DO_SECRET_ACCESS_KEY)
 
-    src_container_url = (
-        f"https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net/{src_container}"
-    )
-    src_container_client = DirectoryClient(
-        AZURE_STORAGE_CONNECTION_STRING, src_container
-    )
-    dest_container_client = blob_service_client.get_container_client(dest_container)
 
-    for blob in src_container_client.ls_files(path=""):
-        blob_path = blob.replace("\\", "/")
-        blob_url = f"{src_container_url}/{blob_path}"
-        dest_blob = dest_container_client.get_blob_client(blob_path)
-        print(f"Start copying: {blob_url}")
-        dest_blob.start_copy_from_url(blob_url)
+def azure_backup_container(src_container, dest_container, full_listing=False):
+    """Make dest_container a copy of src_container, only copying the blobs that differ.
+
+    Both sides come from their manifests when those can be trusted, see manifest.py, and the backup gets the
+    manifest of what it now holds.
+
+    :return: list of (name, exception) for the blobs that failed to copy or delete
+    """
+
+    async def backup():
+        async with transfer.AzureTransfer(
+            AZURE_STORAGE_CONNECTION_STRING, src_container
+        ) as src, transfer.AzureTransfer(
+            AZURE_STORAGE_CONNECTION_STRING, dest_container
+        ) as dest:
+            src_files, _ = await src.remote_files(full_listing)
+            dest_files, etag = await dest.remote_files(full_listing)
+            copies, deletes = manifest.diff(src_files, dest_files)
+            print(f"{len(copies)} blobs to copy, {len(deletes)} to delete")
+            # the URL comes from the connection string, so this works against Azurite as well
+            failures = await dest.copy_blobs(src.url, copies)
+            failures += await dest.delete_blobs(deletes)
+
+            files = dict(src_files)
+            for name, _ in failures:
+                # not copied, or not deleted: either way it's unknown what's there now
+                files.pop(name, None)
+            await dest.save_manifest(files, etag)
+            return failures
+
+    return transfer.run(backup())
 
     # containers = blob_service_client.make_blob_url(src_container, "index.html")
     # return containers
@@ -74,12 +93,66 @@ def azure_get_containers(prefix):
     return containers
 
 
+def azure_list_blobs(container, prefix=""):
+    """Properties of every blob in a container (or under prefix), from one paginated listing."""
+
+    async def list_blobs():
+        async with transfer.AzureTransfer(
+            AZURE_STORAGE_CONNECTION_STRING, container
+        ) as azure_transfer:
+            return await azure_transfer.list_properties(prefix)
+
+    return transfer.run(list_blobs())
+
+
+def azure_verify(local_directory, container):
+    """Compare a local directory with a container, without downloading anything.
+
+    Local files are hashed in parallel, and the hashes are cached in the album index by size and mtime, so only
+    changed files are read again. Remote hashes are the Content-MD5 every uploaded blob gets.
+
+    :return: dict of sorted lists of paths:
+        missing - only local, extra - only in the container, mismatched - different content,
+        unverified - the blob has no Content-MD5 (e.g. uploaded in blocks), but the size matches
+    """
+    from album_index import refreshed_index
+
+    with refreshed_index(local_directory) as index:
+        local_files = index.entries(local_directory)
+    # the manifest deploys and backups leave in the container isn't part of the site
+    blobs = {
+        blob.name: blob
+        for blob in azure_list_blobs(container)
+        if blob.name != manifest.MANIFEST_NAME
+    }
+
+    report = {"missing": [], "extra": [], "mismatched": [], "unverified": []}
+    for path, entry in local_files.items():
+        blob = blobs.get(path)
+        if blob is None:
+            report["missing"].append(path)
+            continue
+        content_md5 = blob.content_settings.content_md5
+        if blob.size != entry.size:
+            report["mismatched"].append(path)
+        elif not content_md5:
+            report["unverified"].append(path)
+        elif bytes(content_md5).hex() != entry.md5:
+            report["mismatched"].append(path)
+    report["extra"] = [name for name in blobs if name not in local_files]
+    return {key: sorted(paths) for key, paths in report.items()}
+
+
 def azure_delete_dir(container, prefix):
+    from DirectoryClient import DirectoryClient
+
     client = DirectoryClient(AZURE_STORAGE_CONNECTION_STRING, container)
     client.rmdir(prefix)
 
 
 def azure_download(container, source, dest):
+    from DirectoryClient import DirectoryClient
+
     client = DirectoryClient(AZURE_STORAGE_CONNECTION_STRING, container)
     client.download(source, dest)
 
@@ -91,30 +164,107 @@ def azure_download(container, source, dest):
 
 
 def azure_upload_dir(local_directory, container):
+    async def upload():
+        async with transfer.AzureTransfer(
+            AZURE_STORAGE_CONNECTION_STRING, container
+        ) as azure_transfer:
+            return await azure_transfer.upload_dir(
+                local_directory, content_type_for=guess_mimetype
+            )
+
     try:
-        blob_service_client = azure_get_blob_service_client()
-        container_client = blob_service_client.get_container_client(container)
+        return transfer.run(upload())
+    except Exception as ex:
+        print(ex)
 
-        for root, dirs, files in os.walk(local_directory):
 
-            for filename in files:
-                # construct the full local path
-                local_path = os.path.join(root, filename)
-                mimetype = guess_mimetype(local_path)
+def azure_upload_files(local_directory, relative_paths, container):
+    """Upload some files of a directory, overwriting their blobs.
 
-                # construct the full Dropbox path
-                relative_path = os.path.relpath(local_path, local_directory)
+    :param relative_paths: paths of the files in local_directory, with "/" separators
+    :return: list of (relative path, exception) for the files that failed
+    """
 
-                # Upload the file
-                print("Uploading:\t" + relative_path)
-                content_settings = ContentSettings(content_type=mimetype)
-                with open(local_path, "rb") as data:
-                    container_client.upload_blob(
-                        name=relative_path, data=data, content_settings=content_settings
-                    )
+    async def upload():
+        async with transfer.AzureTransfer(
+            AZURE_STORAGE_CONNECTION_STRING, container
+        ) as azure_transfer:
+            return await azure_transfer.upload_files(
+                local_directory,
+                relative_paths,
+                content_type_for=guess_mimetype,
+                overwrite=True,
+            )
+
+    return transfer.run(upload())
 
-    except Exception as ex:
-        print(ex)
+
+def azure_deploy_dir(local_directory, container, full_listing=False):
+    """Make a container the same as a local directory: upload new and changed files, delete removed ones.
+
+    The container's state comes from its manifest when it can be trusted, see manifest.py, and the new manifest
+    is written at the end.
+
+    :param full_listing: list the container even if its manifest can be trusted
+    :return: list of (path, exception) for the files that failed to upload or delete
+    """
+
+    async def deploy():
+        async with transfer.AzureTransfer(
+            AZURE_STORAGE_CONNECTION_STRING, container
+        ) as azure_transfer:
+            remote, etag = await azure_transfer.remote_files(full_listing)
+            with metrics.phase("hashing"):
+                local = manifest.local_files(local_directory, guess_mimetype)
+            uploads, deletes = manifest.diff(local, remote)
+            print(f"{len(uploads)} files to upload, {len(deletes)} to delete")
+            with metrics.phase("uploading"):
+                failures = await azure_transfer.upload_files(
+                    local_directory,
+                    uploads,
+                    content_type_for=guess_mimetype,
+                    overwrite=True,
+                )
+            with metrics.phase("deleting"):
+                failures += await azure_transfer.delete_blobs(deletes)
+
+            files = dict(remote)
+            files.update((path, local[path]) for path in uploads)
+            for path in deletes:
+                files.pop(path)
+            for path, _ in failures:
+                files.pop(path, None)
+            await azure_transfer.save_manifest(files, etag)
+            return failures
+
+    return transfer.run(deploy())
+
+
+def azure_audit(container, repair=False):
+    """Compare a container with its manifest, from a full listing.
+
+    :param repair: replace the manifest with the listing
+    :return: dict of sorted lists of paths, see manifest.compare, or None if the container has no manifest
+    """
+
+    async def audit():
+        async with transfer.AzureTransfer(
+            AZURE_STORAGE_CONNECTION_STRING, container
+        ) as azure_transfer:
+            files, etag = await azure_transfer.read_manifest()
+            actual = manifest.blob_files(await azure_transfer.list_properties())
+            if repair:
+                await azure_transfer.save_manifest(actual, etag)
+            elif files is not None and not any(
+                manifest.compare(files, actual).values()
+            ):
+                # the listing just confirmed it, whoever wrote it
+                manifest.remember_etag(azure_transfer.url, etag)
+            if files is None:
+                return None
+            return manifest.compare(files, actual)
+
+    return transfer.run(audit())
 
 
 def guess_mimetype(local_file, default_mimetype="binary/octet-stream"):
@@ -139,61 +289,29 @@ def guess_mimetype(local_file, default_mimetype="binary/octet-stream"):
     return mimetype
 
 
+def do_run(method, *args):
+    """Run an S3Transfer method on the Digital Ocean Space and wait for it"""
+
+    async def run():
+        async with transfer.S3Transfer(do_get_client(), DO_SPACE) as s3_transfer:
+            return await method(s3_transfer, *args)
+
+    return transfer.run(run())
+
+
 def do_delete_dir(destination):
-    # enumerate local files recursively
-    s3 = boto3.resource(
-        "s3",
-        region_name="nyc3",
-        endpoint_url="https://nyc3.digitaloceanspaces.com",
-        aws_access_key_id=DO_ACCESS_KEY_ID,
-        aws_secret_access_key=DO_SECRET_ACCESS_KEY,
-    )
-    bucket = s3.Bucket(DO_SPACE)
-    bucket.objects.filter(Prefix=destination).delete()
+    return do_run(transfer.S3Transfer.delete_prefix, destination)
 
 
-def do_download_dir(client, bucket, remote_folder, local_folder):
+def do_download_dir(remote_folder, local_folder):
     """
     params:
-    - client: initialized s3 client object
-    - bucket: s3 bucket with target contents
     - remote_folder: pattern to match in s3
     - local_folder: local path to folder in which to place files
 
     not used now, but could be useful to download the whole _build directory from the Travis CI build to test
-    https://stackoverflow.com/a/56267603
     """
-    keys = []
-    dirs = []
-    next_token = ""
-    base_kwargs = {
-        "Bucket": bucket,
-        "Prefix": remote_folder,
-    }
-    while next_token is not None:
-        kwargs = base_kwargs.copy()
-        if next_token != "":
-            kwargs.update({"ContinuationToken": next_token})
-        results = client.list_objects_v2(**kwargs)
-        contents = results.get("Contents")
-        for i in contents:
-            k = i.get("Key")
-            if k[-1] != "/":
-                keys.append(k)
-            else:
-                dirs.append(k)
-        next_token = results.get("NextContinuationToken")
-
-    for d in dirs:
-        dest_pathname = os.path.join(local_folder, d)
-        if not os.path.exists(os.path.dirname(dest_pathname)):
-            os.makedirs(os.path.dirname(dest_pathname))
-
-    for k in keys:
-        dest_pathname = os.path.join(local_folder, k)
-        if not os.path.exists(os.path.dirname(dest_pathname)):
-            os.makedirs(os.path.dirname(dest_pathname))
-        client.download_file(bucket, k, dest_pathname)
+    return do_run(transfer.S3Transfer.download_prefix, remote_folder, local_folder)
 
 
 def do_download_file(remote_file, local_file, force=False):
@@ -216,75 +334,26 @@ def do_download_file(remote_file, local_file, force=False):
     |--- templates/
     |--- index.md
     """
-    session = Session()
-
-    client = session.client(
-        "s3",
-        region_name="nyc3",
-        endpoint_url="https://nyc3.digitaloceanspaces.com",
-        aws_access_key_id=DO_ACCESS_KEY_ID,
-        aws_secret_access_key=DO_SECRET_ACCESS_KEY,
-    )
-
     file = Path(local_file)
-    if not file.exists():
-        print(f"Downloading: {remote_file}")
-    elif force:
+    if file.exists():
+        if not force:
+            print(f"{local_file} already downloaded, using local copy")
+            return
         print(f"Forcing download, overwriting {local_file}")
-    else:
-        print(f"{local_file} already downloaded, using local copy")
-        return
-    client.download_file(DO_SPACE, remote_file, local_file)
+    do_run(transfer.S3Transfer.download_file, remote_file, local_file)
 
 
 def do_upload_dir(local_directory, destination):
     """
+    Upload a directory as public files, skipping the ones that are already in the Space
 
     :param local_directory:
     :param destination:
-    :return:
+    :return: list of (local path, exception) for the files that failed
     """
-    # Digitalocean Spaces
-    bucket = DO_SPACE
-    session = Session()
-    client = session.client(
-        "s3",
-        region_name="nyc3",
-        endpoint_url="https://nyc3.digitaloceanspaces.com",
-        aws_access_key_id=DO_ACCESS_KEY_ID,
-        aws_secret_access_key=DO_SECRET_ACCESS_KEY,
+    return do_run(
+        transfer.S3Transfer.upload_dir, local_directory, destination, guess_mimetype
     )
-    # enumerate local files recursively
-    for root, dirs, files in os.walk(local_directory):
-
-        for filename in files:
-
-            # construct the full local path
-            local_path = os.path.join(root, filename)
-            mimetype = guess_mimetype(local_path)
-
-            # construct the full Dropbox path
-            relative_path = os.path.relpath(local_path, local_directory)
-            s3_path = os.path.join(destination, relative_path)
-
-            # relative_path = os.path.relpath(os.path.join(root, filename))
-            # print(f"Searching {s3_path} in {bucket}")
-            try:
-                client.head_object(Bucket=bucket, Key=s3_path)
-                print(f"Path found on S3! Skipping {s3_path}...")
-
-                # try:
-                #     client.delete_object(Bucket=bucket, Key=s3_path)
-                # except:
-                #     print(f"Unable to delete {s3_path}...")
-            except:
-                print(f"Uploading {s3_path}...")
-                client.upload_file(
-                    local_path,
-                    bucket,
-                    s3_path,
-                    ExtraArgs={"ACL": "public-read", "ContentType": mimetype},
-                )
 
 
 def do_upload_file(archive_file, upload_location):
@@ -294,17 +363,32 @@ def do_upload_file(archive_file, upload_location):
     :param upload_location:
     :return:
     """
-    session = Session()
-
-    client = session.client(
-        "s3",
-        region_name="nyc3",
-        endpoint_url="https://nyc3.digitaloceanspaces.com",
-        aws_access_key_id=DO_ACCESS_KEY_ID,
-        aws_secret_access_key=DO_SECRET_ACCESS_KEY,
-    )
+    do_run(transfer.S3Transfer.upload_file, archive_file, upload_location)
+
+
+def do_mirror_to_azure(container, prefix="", dest_prefix="", server_copy=True):
+    """
+    Copy objects from the Digital Ocean Space into an Azure container, without downloading them here.
+    Objects that haven't changed since the last mirror are skipped.
+
+    :param container: Azure container to copy into
+    :param prefix: only copy objects whose key starts with this
+    :param dest_prefix: replaces prefix in the blob names
+    :param server_copy: let Azure fetch the objects itself, otherwise they are relayed through this process
+    :return: list of (key, exception) for the objects that failed
+    """
 
-    client.upload_file(archive_file, DO_SPACE, upload_location)
+    async def mirror():
+        async with transfer.S3Transfer(
+            do_get_client(), DO_SPACE
+        ) as s3_transfer, transfer.AzureTransfer(
+            AZURE_STORAGE_CONNECTION_STRING, container
+        ) as azure_transfer:
+            return await azure_transfer.mirror_from_s3(
+                s3_transfer, prefix, dest_prefix, server_copy
+            )
+
+    return transfer.run(mirror())
 
 
 def unzip_file(filename):
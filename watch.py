@@ -0,0 +1,214 @@
+"""Rebuild and deploy just what changed while stains are being saved.
+
+`run.py watch` polls albums/ for new or changed PNGs and index.md files. One GIMP save writes up to one file per
+theme, so changes are collected until nothing has changed for a couple of seconds. Then only the albums with
+changed files, and the albums above them (whose index pages show their thumbnails), are rebuilt:
+
+* changed or new images are processed (resized and thumbnailed) again, on one CPU
+* the album pages are written again, which also writes the album zip
+* sigal's gallery_build plugins run, e.g. compress_assets, which only compresses pages that changed
+
+sigal has no way to build a few albums, so this does what `Gallery.build` does for the affected albums only.
+Every output file whose size or mtime changed is returned, so it can be pushed.
+
+Removed stains are only dropped from the pages, their output images stay until the next full build and deploy.
+"""
+
+import fnmatch
+import os
+import posixpath
+import time
+
+# local
+import metrics
+from album_index import scan_tree
+
+POLL_INTERVAL = 1.0
+# how long files must stay unchanged before a burst of saves counts as finished
+DEBOUNCE = 2.0
+WATCHED_FILES = (".png", "index.md")
+
+
+def load_settings(config):
+    """sigal settings with plugins initialised, like `sigal build` does before building."""
+    import locale
+
+    from sigal import init_plugins
+    from sigal.settings import read_settings
+
+    settings = read_settings(config)
+    locale.setlocale(locale.LC_ALL, settings["locale"])
+    init_plugins(settings)
+    return settings
+
+
+def is_ignored(path, ignore_directories):
+    """Whether a file is in a directory sigal ignores, e.g. albums/_masks/"""
+    directory = posixpath.dirname(path)
+    while directory:
+        if any(fnmatch.fnmatch(directory, pattern) for pattern in ignore_directories):
+            return True
+        directory = posixpath.dirname(directory)
+    return False
+
+
+def snapshot(source, ignore_directories=()):
+    """{relative path: (size, mtime_ns)} of every watched file under source."""
+    return {
+        path: (stat.st_size, stat.st_mtime_ns)
+        for path, stat in scan_tree(source)
+        if path.endswith(WATCHED_FILES) and not is_ignored(path, ignore_directories)
+    }
+
+
+def changed_paths(before, after):
+    """Paths that were added, removed or modified between two snapshots."""
+    return {
+        path
+        for path in before.keys() | after.keys()
+        if before.get(path) != after.get(path)
+    }
+
+
+def wait_for_changes(
+    source, previous, ignore_directories=(), interval=POLL_INTERVAL, debounce=DEBOUNCE
+):
+    """Block until watched files change, and then until they've stopped changing for debounce seconds.
+
+    :return: (the latest snapshot, set of changed paths)
+    """
+    changed = set()
+    last_change = None
+    while True:
+        time.sleep(interval)
+        current = snapshot(source, ignore_directories)
+        new_changes = changed_paths(previous, current)
+        if new_changes:
+            changed |= new_changes
+            previous = current
+            last_change = time.monotonic()
+        elif changed and time.monotonic() - last_change >= debounce:
+            return previous, changed
+
+
+def affected_albums(paths):
+    """Albums (as sigal names them, "." is the top) holding the changed files, and all albums above them."""
+    albums = set()
+    for path in paths:
+        album = posixpath.dirname(path)
+        while album:
+            albums.add(album)
+            album = posixpath.dirname(album)
+        albums.add(".")
+    return albums
+
+
+def output_snapshot(settings, albums):
+    """{path relative to the destination: (size, mtime_ns)} of the files a rebuild of albums can write."""
+    destination = settings["destination"]
+    # the search index is written for the whole gallery, see sigal_plugins/search_index.py
+    directories = [
+        os.path.join(destination, "static"),
+        os.path.join(destination, "search"),
+    ]
+    for album in albums:
+        directories.append(album.dst_path)
+        directories.append(os.path.join(album.dst_path, settings["thumb_dir"]))
+
+    outputs = {}
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                stat = entry.stat()
+                relative_path = os.path.relpath(entry.path, destination)
+                outputs[relative_path.replace("\\", "/")] = (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                )
+    return outputs
+
+
+def rebuild(settings, changed):
+    """Rebuild the albums with changed source files and the albums above them.
+
+    :param changed: changed source paths, relative to the source directory
+    :return: sorted list of the output paths, relative to the destination, that were written
+    """
+    from sigal import signals
+    from sigal.gallery import Gallery, process_file
+    from sigal.writer import AlbumListPageWriter, AlbumPageWriter
+
+    # collecting the albums only lists directories, the album index has the image sizes
+    gallery = Gallery(settings, ncpu=1, quiet=True)
+    names = affected_albums(changed)
+    albums = [
+        album
+        for name, album in gallery.albums.items()
+        if name.replace("\\", "/") in names
+    ]
+    before = output_snapshot(settings, albums)
+
+    with metrics.phase("build"):
+        for album in albums:
+            for media in album.medias:
+                source_path = posixpath.normpath(
+                    posixpath.join(album.path.replace("\\", "/"), media.filename)
+                )
+                if source_path not in changed and os.path.isfile(media.dst_path):
+                    continue
+                print(f"Processing:\t{source_path}")
+                failed = process_file(
+                    (
+                        media.type,
+                        media.path,
+                        media.filename,
+                        media.src_path,
+                        album.dst_path,
+                        settings,
+                    )
+                )
+                if failed:
+                    print(f"Failed:\t{source_path}")
+                else:
+                    metrics.count("images.processed")
+
+        if settings["write_html"]:
+            album_writer = AlbumPageWriter(settings, index_title=gallery.title)
+            album_list_writer = AlbumListPageWriter(settings, index_title=gallery.title)
+            for album in albums:
+                if album.albums:
+                    album_list_writer.write(album)
+                else:
+                    album_writer.write(album)
+        signals.gallery_build.send(gallery)
+
+    after = output_snapshot(settings, albums)
+    return sorted(path for path, stat in after.items() if before.get(path) != stat)
+
+
+def watch(settings, push=None, interval=POLL_INTERVAL, debounce=DEBOUNCE):
+    """Rebuild changed albums until interrupted.
+
+    :param settings: sigal settings from load_settings()
+    :param push: function called with the output paths of every rebuild, e.g. to upload them
+    """
+    source = settings["source"]
+    ignore_directories = settings["ignore_directories"]
+    previous = snapshot(source, ignore_directories)
+    print(f"Watching {source} for changes, press Ctrl+C to stop")
+    while True:
+        previous, changed = wait_for_changes(
+            source, previous, ignore_directories, interval, debounce
+        )
+        started = time.monotonic()
+        print(f"{len(changed)} files changed, rebuilding")
+        outputs = rebuild(settings, changed)
+        if push and outputs:
+            with metrics.phase("uploading"):
+                push(outputs)
+        print(
+            f"Rebuilt {len(outputs)} files in {time.monotonic() - started:.1f}s,"
+            " watching for changes"
+        )